@@ -0,0 +1,118 @@
+"""
+Arranque en frío: cuánto tarda el bot en abrir el puerto, en estar listo y en responder
+el mensaje que despertó la instancia (como cuando Render reactiva el servicio).
+
+Uso:
+    python bench/arranque.py [--repeticiones 5] [--modo webhook|polling] [--edad 30]
+        [--bot ruta/a/bot.py]
+
+Antes de lanzar bot.py se deja un /start pendiente en bench/servidores_falsos.py, con
+`--edad` segundos de antigüedad. Cada corrida usa un CACHE_DIR vacío (disco efímero).
+Con --bot se puede medir otra versión (p. ej. un `git worktree` de un commit anterior).
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ / "bench"))
+from carga import lanzar_servidores, puerto_libre  # noqa: E402
+
+
+def pendiente(edad: float) -> dict:
+    usuario = {"id": 777, "is_bot": False, "first_name": "Dormilón"}
+    return {"update_id": 1, "message": {
+        "message_id": 1, "date": int(time.time() - edad), "chat": {"id": 777, "type": "private"},
+        "from": usuario, "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+
+
+def corrida(args) -> dict:
+    falsos = argparse.Namespace(latencia_telegram=args.latencia_telegram, latencia_openai=0.4,
+                                tokens=300, seg_por_token=0.004)
+    puerto_falsos, puerto = puerto_libre(), puerto_libre()
+    servidores = lanzar_servidores(falsos, puerto_falsos)
+    stats_url = f"http://127.0.0.1:{puerto_falsos}/_stats"
+    try:
+        httpx.post(f"http://127.0.0.1:{puerto_falsos}/_encolar", json=[pendiente(args.edad)])
+        entorno = {
+            **os.environ,
+            "BOT_TOKEN": "123456:bench",
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{puerto_falsos}",
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{puerto_falsos}/v1",
+            "CACHE_DIR": tempfile.mkdtemp(prefix="bench_arranque_"),
+            "COMUNICADOS_DIFUSION": "0",
+            "PORT": str(puerto),
+            "METRICAS_PUERTO": str(puerto),
+            "TRABAJADORES_PUERTO_BASE": str(puerto_libre()),
+        }
+        if args.modo == "webhook":
+            entorno["WEBHOOK_URL"] = f"http://127.0.0.1:{puerto}"
+        salida = tempfile.TemporaryFile(mode="w+")
+        t0 = time.time()
+        bot = subprocess.Popen([sys.executable, args.bot], env=entorno, stdout=salida, stderr=subprocess.STDOUT)
+        puerto_abierto = listo = primera = None
+        limite = t0 + args.limite
+        while time.time() < limite and primera is None:
+            try:
+                r = httpx.get(f"http://127.0.0.1:{puerto}/healthz", timeout=0.5)
+                puerto_abierto = puerto_abierto or time.time()
+                if r.status_code == 200:
+                    listo = listo or time.time()
+            except httpx.HTTPError:
+                pass
+            primera = httpx.get(stats_url).json()["primer_envio"]
+            time.sleep(0.02)
+        descartados = httpx.get(stats_url).json()["descartados"]
+        bot.terminate()
+        bot.wait(30)
+        salida.seek(0)
+        tiempos = next((l.split(":", 1)[1].strip() for l in salida.read().splitlines()
+                        if l.startswith("[BOOT] Tiempos de arranque:")), None)
+    finally:
+        servidores.terminate()
+    return {
+        "puerto": puerto_abierto - t0 if puerto_abierto else None,
+        "listo": listo - t0 if listo else None,
+        "primera_respuesta": primera - t0 if primera else None,
+        "descartados": descartados,
+        "tiempos": tiempos,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--modo", choices=["webhook", "polling"], default="webhook")
+    parser.add_argument("--edad", type=float, default=30, help="antigüedad del mensaje pendiente (segundos)")
+    parser.add_argument("--bot", default=str(RAIZ / "bot.py"))
+    parser.add_argument("--latencia-telegram", type=float, default=0.1)
+    parser.add_argument("--limite", type=float, default=20, help="segundos máximos de espera por corrida")
+    args = parser.parse_args()
+
+    resultados = [corrida(args) for _ in range(args.repeticiones)]
+
+    def mediana(campo):
+        valores = [r[campo] for r in resultados if r[campo] is not None]
+        if len(valores) < len(resultados):
+            return f"sin respuesta en {len(resultados) - len(valores)}/{len(resultados)}"
+        return f"{statistics.median(valores):.2f} s"
+
+    print(f"{args.bot} · modo {args.modo} · {args.repeticiones} corridas · mensaje pendiente de {args.edad:.0f} s")
+    print(f"Puerto abierto (mediana):           {mediana('puerto')}")
+    print(f"Listo, /healthz = 200 (mediana):    {mediana('listo')}")
+    print(f"Respuesta al pendiente (mediana):   {mediana('primera_respuesta')}")
+    print(f"Pendientes descartados:             {sum(r['descartados'] for r in resultados)}")
+    if resultados[-1]["tiempos"]:
+        print(f"Desglose (última corrida):          {resultados[-1]['tiempos']}")
+
+
+if __name__ == "__main__":
+    main()
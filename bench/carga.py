@@ -0,0 +1,314 @@
+"""
+Prueba de carga del bot completo: la Application real de bot.py (start, tutor_cmd,
+on_button, on_text...) contra los servidores falsos de bench/servidores_falsos.py.
+
+Uso:
+    python bench/carga.py [--estudiantes 50] [--preguntas 3] [--modo cola|polling]
+        [--rampa 5] [--pausa 0.5] [--json resultado.json] [--max-p95-ms 0]
+
+Cada estudiante simulado abre el menú, elige una semana, descarga fichas (si hay vista
+previa, a veces pide además el PDF completo), a veces la semana completa, entra al Tutor
+y hace varias preguntas. Se reporta updates/s, latencia p50/p95/p99 por tipo de update
+(desde que llega el update hasta que su handler termina), bytes subidos a Telegram y
+descargados por los estudiantes, llamadas a las APIs y memoria. Las fichas ligeras se
+preparan antes de medir; con FICHAS_LIGERAS=0 se envían los PDF originales.
+
+--modo cola     los updates se entregan en app.update_queue (lo mismo que hace el webhook)
+--modo polling  los updates pasan por getUpdates del servidor falso
+--max-p95-ms    si el p95 global supera este valor el proceso termina con código 1 (para CI)
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+RAIZ = Path(__file__).resolve().parent.parent
+PREGUNTAS_COMUNES = [
+    "¿Cómo diagnostico el alternador si no carga?",
+    "¿Qué es la ley de Ohm?",
+    "¿Cómo se mide la presión de los neumáticos?",
+    "¿Para qué sirve el regulador de voltaje?",
+    "¿Cuáles son las partes de la rueda?",
+]
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def lanzar_servidores(args, puerto: int) -> subprocess.Popen:
+    cmd = [sys.executable, str(RAIZ / "bench" / "servidores_falsos.py"), "--puerto", str(puerto),
+           "--latencia-telegram", str(args.latencia_telegram), "--latencia-openai", str(args.latencia_openai),
+           "--tokens", str(args.tokens), "--seg-por-token", str(args.seg_por_token)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{puerto}/_stats", timeout=0.5)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("No arrancaron los servidores falsos")
+
+
+def preparar_entorno(args, puerto: int):
+    cache = RAIZ / ".cache" / "bench"
+    cache.mkdir(parents=True, exist_ok=True)
+    # Se conservan el índice y las fichas ligeras (tardan en construirse); el resto empieza vacío
+    for nombre in ("tutor_respuestas.json", "estado.sqlite3",
+                   "estado.sqlite3-wal", "estado.sqlite3-shm"):
+        (cache / nombre).unlink(missing_ok=True)
+    shutil.rmtree(cache / "zips", ignore_errors=True)
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{puerto}",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{puerto}/v1",
+        "CACHE_DIR": str(cache),
+        "COMUNICADOS_DIFUSION": "0",
+    })
+    sys.path.insert(0, str(RAIZ))
+
+
+class Registro:
+    """Tiempos por update. Se completa desde los handlers instrumentados."""
+
+    def __init__(self):
+        self.inyectado = {}    # update_id → (tipo, perf_counter)
+        self.pendientes = {}   # update_id → future
+        self.latencias = defaultdict(list)   # tipo → segundos (llegada → fin del handler)
+        self.en_handler = defaultdict(list)  # tipo → segundos dentro del handler
+        self.errores = 0
+
+    def inyectar(self, update_id: int, tipo: str) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.inyectado[update_id] = (tipo, time.perf_counter())
+        self.pendientes[update_id] = fut
+        return fut
+
+    def terminar(self, update_id: int, inicio_handler: float):
+        fin = time.perf_counter()
+        tipo, llegada = self.inyectado.pop(update_id, ("?", inicio_handler))
+        self.latencias[tipo].append(fin - llegada)
+        self.en_handler[tipo].append(fin - inicio_handler)
+        fut = self.pendientes.pop(update_id, None)
+        if fut and not fut.done():
+            fut.set_result(None)
+
+
+def instrumentar(app, registro: Registro):
+    for handler in app.handlers.get(0, []):  # el grupo -1 solo registra métricas de llegada
+        original = handler.callback
+
+        async def envoltura(update, context, _original=original):
+            inicio = time.perf_counter()
+            try:
+                return await _original(update, context)
+            except Exception:
+                registro.errores += 1
+                raise
+            finally:
+                registro.terminar(update.update_id, inicio)
+
+        handler.callback = envoltura
+
+
+class Simulador:
+    def __init__(self, args, app, registro: Registro, puerto: int):
+        self.args = args
+        self.app = app
+        self.registro = registro
+        self.puerto = puerto
+        self.ids = itertools.count(1)
+        self.http = httpx.AsyncClient(timeout=30)
+
+    def _usuario(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"Estudiante{uid}"}
+
+    def mensaje(self, uid: int, texto: str) -> dict:
+        msg = {"message_id": next(self.ids), "date": int(time.time()), "text": texto,
+               "chat": {"id": uid, "type": "private"}, "from": self._usuario(uid)}
+        if texto.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        return {"update_id": next(self.ids), "message": msg}
+
+    def boton(self, uid: int, data: str) -> dict:
+        return {"update_id": next(self.ids), "callback_query": {
+            "id": str(next(self.ids)), "from": self._usuario(uid), "chat_instance": str(uid), "data": data,
+            "message": {"message_id": next(self.ids), "date": int(time.time()), "text": "menú",
+                        "chat": {"id": uid, "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "Bot"}},
+        }}
+
+    @staticmethod
+    def tipo(update: dict) -> str:
+        if "callback_query" in update:
+            return "boton " + update["callback_query"]["data"].split(":")[0]
+        texto = update["message"]["text"]
+        return texto.split()[0] if texto.startswith("/") else "tutor (texto)"
+
+    async def paso(self, update: dict):
+        from telegram import Update
+        fut = self.registro.inyectar(update["update_id"], self.tipo(update))
+        if self.args.modo == "polling":
+            await self.http.post(f"http://127.0.0.1:{self.puerto}/_encolar", json=[update])
+        else:
+            await self.app.update_queue.put(Update.de_json(update, self.app.bot))
+        await asyncio.wait_for(fut, timeout=180)
+        if self.args.pausa:
+            await asyncio.sleep(random.uniform(0, self.args.pausa))
+
+    async def estudiante(self, i: int, curso: str, semanas: list, fichas: dict):
+        import bot
+        await asyncio.sleep(random.uniform(0, self.args.rampa))
+        uid = 100000 + i
+        await self.paso(self.mensaje(uid, "/start"))
+        await self.paso(self.boton(uid, "fichas"))
+        semana = random.choice(semanas)
+        await self.paso(self.boton(uid, f"sem:{curso}:{semana}"))
+        for key in random.sample(fichas[semana], min(2, len(fichas[semana]))):
+            await self.paso(self.boton(uid, f"ficha:{curso}:{semana}:{key}"))
+            ruta = bot.ruta_pdf(bot.catalogo_fichas().cursos[curso], semana, key)
+            if bot.previa_de(ruta) and random.random() < self.args.prob_pdf:
+                await self.paso(self.boton(uid, f"pdf:{curso}:{semana}:{key}"))
+        if random.random() < self.args.prob_semana:
+            await self.paso(self.boton(uid, f"todo:{curso}:{semana}"))
+        await self.paso(self.boton(uid, "tutor"))
+        for n in range(self.args.preguntas):
+            if n == 0:
+                texto = random.choice(PREGUNTAS_COMUNES)
+            else:
+                texto = f"Pregunta de seguimiento {n} del estudiante {uid} sobre {bot.nombre_asignatura(fichas[semana][0])}"
+            await self.paso(self.mensaje(uid, texto))
+
+
+async def ejecutar(args) -> dict:
+    puerto = puerto_libre()
+    servidores = lanzar_servidores(args, puerto)
+    try:
+        preparar_entorno(args, puerto)
+        import bot
+
+        app = bot.crear_aplicacion()
+        registro = Registro()
+        instrumentar(app, registro)
+        await app.initialize()
+        if bot.FICHAS_LIGERAS and bot.preprocesar_fichas.hay_pymupdf():
+            await asyncio.to_thread(bot.preprocesar_fichas.procesar, bot.inventario_fichas(),
+                                    bot.FICHAS_LIGERAS_DIR, dpi_previa=bot.FICHAS_PREVIA_DPI)
+        await bot.post_init(app)
+        await bot.actualizar_indice_fichas()  # estado estable: índice listo antes de medir
+        await app.start()
+        if args.modo == "polling":
+            await app.updater.start_polling(poll_interval=0.0, timeout=1)
+
+        curso = next(iter(bot.catalogo_fichas().cursos.values()))
+        semanas = sorted(bot.semanas_con_fichas(curso))
+        fichas = {s: [k for k, _ in bot.fichas_de_semana(curso, s)] for s in semanas}
+        sim = Simulador(args, app, registro, puerto)
+        inicio = time.perf_counter()
+        await asyncio.gather(*(sim.estudiante(i, curso.codigo, semanas, fichas) for i in range(args.estudiantes)))
+        duracion = time.perf_counter() - inicio
+
+        if args.modo == "polling":
+            await app.updater.stop()
+        await app.stop()
+        await bot.post_shutdown(app)
+        await app.shutdown()
+        await sim.http.aclose()
+        stats = httpx.get(f"http://127.0.0.1:{puerto}/_stats").json()
+    finally:
+        servidores.terminate()
+
+    todas = [x for v in registro.latencias.values() for x in v]
+    return {
+        "estudiantes": args.estudiantes,
+        "modo": args.modo,
+        "updates": len(todas),
+        "duracion_s": duracion,
+        "updates_por_s": len(todas) / duracion,
+        "latencia_ms": {
+            tipo: {"n": len(v), "p50": percentil(v, .5) * 1000, "p95": percentil(v, .95) * 1000,
+                   "p99": percentil(v, .99) * 1000, "handler_p95": percentil(registro.en_handler[tipo], .95) * 1000}
+            for tipo, v in sorted(registro.latencias.items())
+        },
+        "global_ms": {"p50": percentil(todas, .5) * 1000, "p95": percentil(todas, .95) * 1000,
+                      "p99": percentil(todas, .99) * 1000},
+        "bytes_subidos": stats["bytes_subidos"],
+        "bytes_entregados": stats["bytes_entregados"],
+        "llamadas_bot_api": stats["llamadas"],
+        "consultas_openai": stats["consultas_openai"],
+        "memoria_max_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "errores": registro.errores,
+    }
+
+
+def imprimir(r: dict):
+    print(f"\nEstudiantes: {r['estudiantes']} · modo {r['modo']} · {r['updates']} updates en "
+          f"{r['duracion_s']:.1f} s → {r['updates_por_s']:.1f} updates/s")
+    print(f"{'tipo':<20}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'handler p95':>13}")
+    for tipo, v in r["latencia_ms"].items():
+        print(f"{tipo:<20}{v['n']:>6}{v['p50']:>10.0f}{v['p95']:>10.0f}{v['p99']:>10.0f}{v['handler_p95']:>13.0f}")
+    g = r["global_ms"]
+    print(f"{'TOTAL':<20}{r['updates']:>6}{g['p50']:>10.0f}{g['p95']:>10.0f}{g['p99']:>10.0f}")
+    llamadas = ", ".join(f"{m}={n}" for m, n in sorted(r["llamadas_bot_api"].items()))
+    print(f"\nBytes subidos a Telegram: {r['bytes_subidos'] / 1024 / 1024:.1f} MiB · "
+          f"descargados por los estudiantes: {r['bytes_entregados'] / 1024 / 1024:.1f} MiB")
+    print(f"Llamadas a la Bot API: {llamadas}")
+    print(f"Consultas a OpenAI: {r['consultas_openai']}")
+    print(f"Memoria máxima (RSS): {r['memoria_max_mib']:.0f} MiB · errores en handlers: {r['errores']}")
+
+
+def argumentos(lista=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--estudiantes", type=int, default=50)
+    parser.add_argument("--preguntas", type=int, default=3, help="preguntas al Tutor por estudiante")
+    parser.add_argument("--prob-pdf", type=float, default=0.5,
+                        help="probabilidad de pedir el PDF completo después de la vista previa")
+    parser.add_argument("--prob-semana", type=float, default=0.3, help="probabilidad de descargar la semana completa")
+    parser.add_argument("--modo", choices=["cola", "polling"], default="cola")
+    parser.add_argument("--rampa", type=float, default=5.0, help="segundos en los que van llegando los estudiantes")
+    parser.add_argument("--pausa", type=float, default=0.5, help="pausa máxima entre pasos de un estudiante")
+    parser.add_argument("--latencia-telegram", type=float, default=0.03)
+    parser.add_argument("--latencia-openai", type=float, default=0.4)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--seg-por-token", type=float, default=0.004)
+    parser.add_argument("--json", help="guarda el resultado en este archivo")
+    parser.add_argument("--max-p95-ms", type=float, default=0, help="falla si el p95 global lo supera")
+    return parser.parse_args(lista)
+
+
+def main():
+    args = argumentos()
+    random.seed(1234)
+    resultado = asyncio.run(ejecutar(args))
+    imprimir(resultado)
+    if args.json:
+        Path(args.json).write_text(json.dumps(resultado, indent=2, ensure_ascii=False), encoding="utf-8")
+    if args.max_p95_ms and resultado["global_ms"]["p95"] > args.max_p95_ms:
+        print(f"\n❌ p95 global {resultado['global_ms']['p95']:.0f} ms > {args.max_p95_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
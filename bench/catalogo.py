@@ -0,0 +1,113 @@
+"""
+Catálogo de fichas con muchos cursos: un árbol sintético de carpetas y un manifiesto.
+
+Uso:
+    python bench/catalogo.py [--cursos 40] [--semanas 40] [--asignaturas 8]
+
+Genera cursos × semanas × asignaturas PDF vacíos (más una ficha común por semana) con la
+misma estructura que fichas_pedagogicas/, y mide con el código de bot.py:
+- carga y validación del manifiesto,
+- escaneo completo de las carpetas (arranque o cambio en disco),
+- revalidación sin cambios (lo que cuesta, como máximo cada CATALOGO_REVALIDAR_SEG),
+- búsqueda de una ficha por (curso, semana, asignatura) y de las fichas de una semana,
+- armado de los teclados de cursos y semanas (precalentar_teclados) y el callback_data más largo.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+
+def crear_arbol(raiz: Path, cursos: int, semanas: int, asignaturas: int) -> Path:
+    claves = [f"asig{i}" for i in range(asignaturas)]
+    codigos = [f"{g}{p}" for g in range(1, 4) for p in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"][:cursos]
+    for s in range(1, semanas + 1):
+        carpeta = raiz / "fichas" / f"semana{s}"
+        carpeta.mkdir(parents=True)
+        (carpeta / "normas_de_seguridad.pdf").write_bytes(b"%PDF-1.4\n")  # común a todos
+        for codigo in codigos:
+            for clave in claves:
+                (carpeta / f"{clave}_base_{codigo}_s{s}.pdf").write_bytes(b"%PDF-1.4\n")
+    manifiesto = {
+        "carpeta": "fichas",
+        "carpeta_semana": "semana{semana}",
+        "archivo": "{asignatura}_{curso}_s{semana}.pdf",
+        "archivo_comun": "{asignatura}.pdf",
+        "calendario": {"semana1_inicio": "2025-07-28", "total_semanas": semanas},
+        "asignaturas": {**{c: {"nombre": f"Asignatura {c}", "archivo": f"{c}_base"} for c in claves},
+                        "seguridad": {"nombre": "Normas de seguridad", "archivo": "normas_de_seguridad"}},
+        "cursos": {c: {"nombre": f"{c[0]}º {c[1:]}", "asignaturas": claves + ["seguridad"]} for c in codigos},
+    }
+    ruta = raiz / "catalogo.json"
+    ruta.write_text(json.dumps(manifiesto, ensure_ascii=False), encoding="utf-8")
+    return ruta
+
+
+def cronometrar(funcion, repeticiones: int = 1) -> float:
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - t0)
+    return statistics.median(tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cursos", type=int, default=40)
+    parser.add_argument("--semanas", type=int, default=40)
+    parser.add_argument("--asignaturas", type=int, default=8)
+    args = parser.parse_args()
+
+    raiz = Path(tempfile.mkdtemp(prefix="bench_catalogo_"))
+    os.environ["CATALOGO_MANIFIESTO"] = str(crear_arbol(raiz, args.cursos, args.semanas, args.asignaturas))
+    os.environ.setdefault("CACHE_DIR", str(raiz / "cache"))
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import bot
+
+    ruta = Path(os.environ["CATALOGO_MANIFIESTO"])
+    carga = cronometrar(lambda: bot.Catalogo.cargar(ruta), 5)
+    t0 = time.perf_counter()
+    catalogo = bot.catalogo_fichas()
+    escaneo = time.perf_counter() - t0
+    bot.CATALOGO_REVALIDAR_SEG = 0  # fuerza la revisión de firmas en cada llamada
+    revalidar = cronometrar(bot.catalogo_fichas, 20)
+    bot.CATALOGO_REVALIDAR_SEG = 3600
+
+    cursos = list(catalogo.cursos.values())
+    consultas = [(random.choice(cursos), random.randint(1, args.semanas), f"asig{random.randrange(args.asignaturas)}")
+                 for _ in range(100_000)]
+    t0 = time.perf_counter()
+    for curso, semana, asign in consultas:
+        bot.buscar_ficha(curso, semana, asign)
+    una_ficha = (time.perf_counter() - t0) / len(consultas)
+    t0 = time.perf_counter()
+    for curso, semana, _asign in consultas:
+        bot.fichas_de_semana(curso, semana)
+    una_semana = (time.perf_counter() - t0) / len(consultas)
+
+    teclados = cronometrar(bot.precalentar_teclados)
+    bot.kb_asignaturas(cursos[-1], args.semanas)  # el de asignaturas tiene los callback_data más largos
+    largo = max(len(b.callback_data.encode()) for t in bot._teclados.values()
+                for fila in t.inline_keyboard for b in fila)
+
+    print(f"{len(catalogo.cursos)} cursos · {args.semanas} semanas · {len(catalogo.fichas)} fichas "
+          f"({sum(1 for _ in raiz.rglob('*.pdf'))} archivos en disco)")
+    print(f"Carga del manifiesto:            {carga * 1000:8.2f} ms")
+    print(f"Escaneo completo:                {escaneo * 1000:8.2f} ms")
+    print(f"Revalidación sin cambios:        {revalidar * 1000:8.2f} ms")
+    print(f"Búsqueda de una ficha:           {una_ficha * 1e6:8.2f} µs")
+    print(f"Fichas de una semana:            {una_semana * 1e6:8.2f} µs")
+    print(f"Teclados de cursos y semanas:    {teclados * 1000:8.2f} ms")
+    print(f"callback_data más largo:         {largo:8d} bytes (límite {bot.LIMITE_CALLBACK_DATA})")
+
+
+if __name__ == "__main__":
+    main()
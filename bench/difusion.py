@@ -0,0 +1,94 @@
+"""
+Benchmark de la difusión de comunicados con un bot simulado.
+
+Uso:
+    python bench/difusion.py [--suscriptores 3000] [--latencia 0.08] [--tasa 25]
+
+El bot simulado tarda `--latencia` segundos por mensaje, responde RetryAfter en el 1 %
+de los envíos y Forbidden (bot bloqueado) en el 2 % de los chats. Se reporta el
+rendimiento real (msg/s), el tiempo total y que se respeten los límites de Telegram.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def preparar_entorno(args):
+    tmp = Path(tempfile.mkdtemp())
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ["CACHE_DIR"] = str(tmp)
+    os.environ["DIFUSION_MSG_POR_SEG"] = str(args.tasa)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    return tmp
+
+
+class BotSimulado:
+    def __init__(self, telegram, latencia: float, bloqueados: set):
+        self.telegram = telegram
+        self.latencia = latencia
+        self.bloqueados = bloqueados
+        self.envios = []  # (monotonic, chat_id)
+
+    async def send_message(self, chat_id, texto, **kwargs):
+        await asyncio.sleep(self.latencia)
+        if chat_id in self.bloqueados:
+            raise self.telegram.error.Forbidden("Forbidden: bot was blocked by the user")
+        if random.random() < 0.01:
+            raise self.telegram.error.RetryAfter(1)
+        self.envios.append((time.monotonic(), chat_id))
+
+
+async def medir(args):
+    tmp = preparar_entorno(args)
+    import bot  # noqa: E402 (depende de las variables de entorno)
+    import telegram
+
+    bot.RUTA_COMUNICADOS = tmp / "comunicados.txt"
+    bot.RUTA_COMUNICADOS.write_text("📢 Semana 1: inicio de clases\n", encoding="utf-8")
+    difusor = bot.Difusor(tmp / "estado.sqlite3")
+    for chat_id in range(1, args.suscriptores + 1):
+        difusor.suscribir(chat_id)
+    difusor.detectar_nuevos()  # primera vez: solo marca lo existente como visto
+
+    bot.RUTA_COMUNICADOS.write_text("📢 Semana 1: inicio de clases\n📢 Semana 2: feria técnica\n",
+                                    encoding="utf-8")
+    bloqueados = set(random.sample(range(1, args.suscriptores + 1), args.suscriptores // 50))
+    simulado = BotSimulado(telegram, args.latencia, bloqueados)
+
+    t0 = time.monotonic()
+    progreso = await difusor.difundir(simulado)
+    total = time.monotonic() - t0
+
+    # Máximo de mensajes en cualquier ventana de 1 segundo
+    tiempos = [t for t, _ in simulado.envios]
+    pico, j = 0, 0
+    for i, t in enumerate(tiempos):
+        while tiempos[j] < t - 1.0:
+            j += 1
+        pico = max(pico, i - j + 1)
+
+    print(f"Suscriptores: {args.suscriptores} · latencia simulada {args.latencia * 1000:.0f} ms · "
+          f"tasa configurada {args.tasa} msg/s")
+    print(f"Tiempo total: {total:.1f} s · rendimiento {progreso['enviados'] / total:.1f} msg/s · "
+          f"pico en 1 s: {pico} msg")
+    print(f"Enviados {progreso['enviados']} · bloqueados eliminados {progreso['bloqueados']} · "
+          f"RetryAfter {progreso['retry_after']} · fallidos {progreso['fallidos']}")
+    print(f"Suscriptores restantes: {difusor.total_suscriptores()} · pendientes: {len(difusor.pendientes())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suscriptores", type=int, default=3000)
+    parser.add_argument("--latencia", type=float, default=0.08)
+    parser.add_argument("--tasa", type=float, default=25)
+    args = parser.parse_args()
+    asyncio.run(medir(args))
+
+
+if __name__ == "__main__":
+    main()
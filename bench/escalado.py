@@ -0,0 +1,210 @@
+"""
+Rendimiento del modo webhook con 1 y N procesos trabajadores (y sin procesamiento concurrente).
+
+Uso:
+    python bench/escalado.py [--usuarios 200] [--pasos 8] [--trabajadores 1,2,4]
+
+Para cada configuración lanza bot.py de verdad (modo webhook, apuntando a
+bench/servidores_falsos.py), le envía por POST /webhook las sesiones de muchos usuarios
+(menú, semanas, fichas, /buscar) tan rápido como las acepta, y mide cuánto tarda en
+procesarlas todas según su /metrics. Configuraciones:
+
+    secuencial      UPDATES_CONCURRENTES=1, un proceso (como PTB por defecto)
+    concurrente     UPDATES_CONCURRENTES=64, un proceso
+    N trabajadores  UPDATES_CONCURRENTES=64, TRABAJADORES=N (frente + N procesos)
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ / "bench"))
+from carga import lanzar_servidores, puerto_libre  # noqa: E402
+
+BUSQUEDAS = ["alternador", "ley de ohm", "neumáticos", "inyección", "batería", "frenos"]
+
+
+def esperar_salud(url: str, segundos: float = 120):
+    limite = time.monotonic() + segundos
+    while time.monotonic() < limite:
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} no respondió a tiempo")
+
+
+def lanzar_bot(puerto: int, puerto_falsos: int, concurrentes: int, trabajadores: int) -> subprocess.Popen:
+    cache = Path(tempfile.mkdtemp(prefix="bench_escalado_"))
+    for origen in (RAIZ / ".cache" / "bench" / "indice_fichas.json", RAIZ / ".cache" / "indice_fichas.json"):
+        if origen.exists():
+            shutil.copy(origen, cache / "indice_fichas.json")  # evita reconstruir el índice en cada corrida
+            break
+    entorno = {
+        **os.environ,
+        "BOT_TOKEN": "123456:bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{puerto_falsos}",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{puerto_falsos}/v1",
+        "WEBHOOK_URL": f"http://127.0.0.1:{puerto}",
+        "PORT": str(puerto),
+        "CACHE_DIR": str(cache),
+        "COMUNICADOS_DIFUSION": "0",
+        "UPDATES_CONCURRENTES": str(concurrentes),
+        "TRABAJADORES": str(trabajadores),
+    }
+    base = puerto_libre()  # puertos consecutivos libres para los trabajadores
+    while not all(_libre(base + i) for i in range(trabajadores)):
+        base = puerto_libre()
+    entorno["TRABAJADORES_PUERTO_BASE"] = str(base)
+    proc = subprocess.Popen([sys.executable, str(RAIZ / "bot.py")], env=entorno,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    proc.cache = cache
+    return proc
+
+
+def _libre(puerto: int) -> bool:
+    with socket.socket() as s:
+        try:
+            s.bind(("127.0.0.1", puerto))
+            return True
+        except OSError:
+            return False
+
+
+def sesiones(usuarios: int, pasos: int) -> list:
+    """Updates de cada usuario, en orden. Sin Tutor: sus límites por usuario dominarían la medición."""
+    ids = iter(range(1, 10 ** 9))
+    todas = []
+    for u in range(usuarios):
+        uid = 500000 + u
+        usuario = {"id": uid, "is_bot": False, "first_name": f"U{uid}"}
+        chat = {"id": uid, "type": "private"}
+
+        def boton(data):
+            return {"update_id": next(ids), "callback_query": {
+                "id": str(next(ids)), "from": usuario, "chat_instance": str(uid), "data": data,
+                "message": {"message_id": next(ids), "date": int(time.time()), "chat": chat, "text": "menú"}}}
+
+        def comando(texto):
+            return {"update_id": next(ids), "message": {
+                "message_id": next(ids), "date": int(time.time()), "chat": chat, "from": usuario, "text": texto,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]}}
+
+        semana = random.randint(1, 5)
+        opciones = [lambda: boton("fichas"), lambda: boton(f"sem:2B:{semana}"),
+                    lambda: boton(f"ficha:2B:{semana}:{random.choice(['electricidad', 'tren', 'sistemas', 'motores'])}"),
+                    lambda: comando(f"/buscar {random.choice(BUSQUEDAS)}"), lambda: boton("comunicados")]
+        todas.append([comando("/start")] + [random.choice(opciones)() for _ in range(pasos - 1)])
+    return todas
+
+
+def procesados(texto_metricas: str) -> int:
+    return int(sum(float(m) for m in re.findall(r"^bot_handler_segundos_count\S* (\S+)$", texto_metricas, re.M)))
+
+
+def p95_espera(texto_metricas: str) -> str:
+    """Cota superior del p95 de bot_update_cola_segundos (sumando los buckets de todos los trabajadores)."""
+    buckets = {}
+    for le, n in re.findall(r'^bot_update_cola_segundos_bucket\{.*le="([^"]+)"\} (\S+)$', texto_metricas, re.M):
+        buckets[le] = buckets.get(le, 0) + float(n)
+    if not buckets:
+        return "-"
+    total = buckets.get("+Inf", 0)
+    for le, n in sorted(buckets.items(), key=lambda kv: float(kv[0]) if kv[0] != "+Inf" else float("inf")):
+        if n >= total * 0.95:
+            return f"≤ {le} s"
+    return "-"
+
+
+async def enviar(url: str, sesiones_: list, conexiones: int):
+    limites = httpx.Limits(max_connections=conexiones, max_keepalive_connections=conexiones)
+    async with httpx.AsyncClient(timeout=60, limits=limites) as cliente:
+        async def usuario(updates):
+            for update in updates:  # en orden: el siguiente se envía cuando el anterior fue aceptado
+                r = await cliente.post(url, json=update)
+                r.raise_for_status()
+        await asyncio.gather(*(usuario(u) for u in sesiones_))
+
+
+def medir(nombre: str, args, puerto_falsos: int, concurrentes: int, trabajadores: int) -> dict:
+    puerto = puerto_libre()
+    proc = lanzar_bot(puerto, puerto_falsos, concurrentes, trabajadores)
+    base = f"http://127.0.0.1:{puerto}"
+    try:
+        esperar_salud(base + "/healthz")
+        random.seed(7)
+        # Calentamiento: sube cada ficha una vez para que todas las corridas usen file_id
+        asyncio.run(enviar(base + "/webhook", sesiones(20, 4), 20))
+        time.sleep(2)
+        inicial = procesados(httpx.get(base + "/metrics", timeout=10).text)
+
+        carga = sesiones(args.usuarios, args.pasos)
+        total = sum(len(s) for s in carga)
+        t0 = time.perf_counter()
+        asyncio.run(enviar(base + "/webhook", carga, args.conexiones))
+        while True:
+            metricas = httpx.get(base + "/metrics", timeout=10).text
+            if procesados(metricas) - inicial >= total:
+                break
+            if time.perf_counter() - t0 > args.limite:
+                raise RuntimeError(f"{nombre}: no terminó en {args.limite} s")
+            time.sleep(0.05)
+        duracion = time.perf_counter() - t0
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        shutil.rmtree(proc.cache, ignore_errors=True)
+    return {"config": nombre, "updates": total, "segundos": duracion, "updates_por_s": total / duracion,
+            "p95_espera": p95_espera(metricas)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--pasos", type=int, default=8, help="updates por usuario")
+    parser.add_argument("--trabajadores", default="1,2,4", help="valores de TRABAJADORES a probar (además de secuencial)")
+    parser.add_argument("--conexiones", type=int, default=64, help="conexiones HTTP simultáneas hacia el webhook")
+    parser.add_argument("--latencia-telegram", type=float, default=0.03)
+    parser.add_argument("--limite", type=float, default=600, help="segundos máximos por corrida")
+    args = parser.parse_args()
+
+    falsos = argparse.Namespace(latencia_telegram=args.latencia_telegram, latencia_openai=0.4,
+                                tokens=300, seg_por_token=0.004)
+    puerto_falsos = puerto_libre()
+    servidores = lanzar_servidores(falsos, puerto_falsos)
+    resultados = []
+    try:
+        resultados.append(medir("secuencial", args, puerto_falsos, 1, 1))
+        for n in [int(x) for x in args.trabajadores.split(",")]:
+            nombre = "concurrente" if n == 1 else f"{n} trabajadores"
+            resultados.append(medir(nombre, args, puerto_falsos, 64, n))
+            print(f"  … {nombre}: {resultados[-1]['updates_por_s']:.0f} updates/s", flush=True)
+    finally:
+        servidores.terminate()
+
+    print(f"\nCPU disponibles: {os.cpu_count()} · {args.usuarios} usuarios × {args.pasos} updates · "
+          f"latencia Bot API simulada {args.latencia_telegram * 1000:.0f} ms")
+    print(f"{'configuración':<18}{'updates':>9}{'segundos':>10}{'updates/s':>11}{'p95 espera':>13}")
+    for r in resultados:
+        print(f"{r['config']:<18}{r['updates']:>9}{r['segundos']:>10.1f}{r['updates_por_s']:>11.1f}{r['p95_espera']:>13}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark de PersistenciaSQLite con algunos miles de usuarios activos.
+
+Uso:
+    python bench/persistencia.py [--usuarios 3000] [--turnos 10]
+
+Mide lo que la persistencia agrega a cada update:
+- carga perezosa (primer mensaje de cada usuario tras un reinicio),
+- refresco de un usuario ya cargado (resto de mensajes),
+- vaciado en lote: tiempo que ocupa el event loop y tiempo total en el hilo de escritura.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def historial(turnos: int) -> list:
+    hist = []
+    for i in range(turnos):
+        hist.append({"role": "user", "content": f"¿Cómo diagnostico el alternador si no carga? (consulta {i})"})
+        hist.append({"role": "assistant", "content": "1) Resumen rápido: el alternador genera la corriente... " * 8})
+    return hist
+
+
+async def medir(usuarios: int, turnos: int):
+    ruta = Path(tempfile.mkdtemp()) / "estado.sqlite3"
+    datos = {"mode": "tutor", "tutor_history": historial(turnos), "tutor_resumen": "- Consultó sobre carga."}
+
+    # Estado previo: todos los usuarios ya guardados (como tras un redeploy)
+    p = bot.PersistenciaSQLite(ruta)
+    await p.get_user_data()
+    for uid in range(usuarios):
+        await p.update_user_data(uid, datos)
+    await p.flush()
+    tam = ruta.stat().st_size + (ruta.with_name(ruta.name + "-wal").stat().st_size
+                                 if ruta.with_name(ruta.name + "-wal").exists() else 0)
+
+    p = bot.PersistenciaSQLite(ruta)
+    t0 = time.perf_counter()
+    await p.get_user_data()
+    arranque = time.perf_counter() - t0
+
+    en_memoria = {uid: {} for uid in range(usuarios)}
+    frio = []
+    for uid in range(usuarios):
+        t = time.perf_counter()
+        await p.refresh_user_data(uid, en_memoria[uid])
+        frio.append(time.perf_counter() - t)
+
+    caliente = []
+    for uid in range(usuarios):
+        t = time.perf_counter()
+        await p.refresh_user_data(uid, en_memoria[uid])
+        caliente.append(time.perf_counter() - t)
+
+    # Un vaciado con todos los usuarios modificados (peor caso de un intervalo)
+    t = time.perf_counter()
+    for uid in range(usuarios):
+        await p.update_user_data(uid, en_memoria[uid])
+    en_loop = time.perf_counter() - t
+    t = time.perf_counter()
+    await p._vaciado
+    en_hilo = time.perf_counter() - t
+    await p.flush()
+
+    assert en_memoria[usuarios - 1]["tutor_history"] == datos["tutor_history"]
+    us = 1e6
+    print(f"Usuarios: {usuarios} · historial de {turnos} turnos · base: {tam / 1024:.0f} KiB "
+          f"({tam / usuarios:.0f} B/usuario)")
+    print(f"Arranque (sin cargar usuarios):   {arranque * 1000:.1f} ms")
+    print(f"Carga perezosa por usuario:       p50 {percentil(frio, .5) * us:.0f} µs · "
+          f"p99 {percentil(frio, .99) * us:.0f} µs · media {statistics.mean(frio) * us:.0f} µs")
+    print(f"Refresco de usuario ya cargado:   p50 {percentil(caliente, .5) * us:.2f} µs")
+    print(f"Vaciado de {usuarios} usuarios:        event loop {en_loop * 1000:.1f} ms · "
+          f"hilo de escritura {en_hilo * 1000:.0f} ms")
+    print(f"Costo amortizado en el loop:      {en_loop / usuarios * us:.1f} µs por usuario y vaciado")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=3000)
+    parser.add_argument("--turnos", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(medir(args.usuarios, args.turnos))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Servidores locales que imitan la Bot API de Telegram y la API de OpenAI, para
+medir el bot sin tocar los servicios reales.
+
+Uso (normalmente lo lanza bench/carga.py):
+    python bench/servidores_falsos.py --puerto 18080 [--latencia-telegram 0.03]
+        [--latencia-openai 0.4] [--tokens 300] [--seg-por-token 0.004]
+
+Rutas:
+    POST /bot<token>/<método>     Bot API (getMe, getUpdates, sendMessage, editMessageText,
+                                  sendDocument, sendMediaGroup, answerCallbackQuery, ...)
+    POST /v1/chat/completions     OpenAI (con y sin stream)
+    POST /_encolar                agrega updates (lista JSON) a la cola de pendientes: los entrega
+                                  getUpdates, o setWebhook si no se pide drop_pending_updates
+    POST /_webhook                reenvía updates (lista JSON) al webhook configurado con setWebhook
+    GET  /_stats                  llamadas por método, bytes recibidos, subidos y entregados (lo que
+                                  descargan los usuarios, también por file_id), tokens generados,
+                                  pendientes descartados y hora del primer mensaje enviado
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from collections import Counter
+
+import httpx
+import tornado.web
+
+METODOS_SUBIDA = {"sendDocument", "sendMediaGroup", "sendPhoto"}
+
+
+class Estado:
+    def __init__(self, args):
+        self.args = args
+        self.llamadas = Counter()
+        self.bytes_recibidos = 0
+        self.bytes_subidos = 0
+        self.bytes_entregados = 0
+        self.tamaños = {}  # file_id → bytes, para contar lo entregado al reenviar por file_id
+        self.tokens_generados = 0
+        self.consultas_openai = 0
+        self.siguiente_id = 1
+        self.updates = asyncio.Queue()
+        self.webhook_url = None
+        self.descartados = 0
+        self.primer_envio = None  # time.time() del primer mensaje que el bot envía o edita
+        self.cliente = httpx.AsyncClient(timeout=60)
+
+    def nuevo_id(self) -> int:
+        self.siguiente_id += 1
+        return self.siguiente_id
+
+
+def _mensaje(estado: Estado, chat_id, **extra) -> dict:
+    msg = {"message_id": estado.nuevo_id(), "date": int(time.time()),
+           "chat": {"id": int(chat_id), "type": "private"}}
+    msg.update(extra)
+    return msg
+
+
+def _documento(estado: Estado, valor: str, archivo) -> dict:
+    if archivo is not None:
+        file_id = "doc-" + hashlib.sha1(archivo["body"]).hexdigest()[:20]
+        estado.tamaños[file_id] = len(archivo["body"])
+        estado.bytes_entregados += len(archivo["body"])
+        return {"file_id": file_id, "file_unique_id": file_id[4:], "file_name": archivo["filename"],
+                "file_size": len(archivo["body"])}
+    estado.bytes_entregados += estado.tamaños.get(valor, 0)
+    return {"file_id": valor, "file_unique_id": valor[-20:]}
+
+
+class BotAPI(tornado.web.RequestHandler):
+    def initialize(self, estado: Estado):
+        self.estado = estado
+
+    def arg(self, nombre: str, defecto=None):
+        valor = self.get_body_argument(nombre, None)
+        if valor is None:
+            valor = self.get_query_argument(nombre, defecto)
+        return valor
+
+    def archivo(self, nombre: str):
+        partes = self.request.files.get(nombre)
+        return partes[0] if partes else None
+
+    def responder(self, resultado):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"ok": True, "result": resultado}))
+
+    async def post(self, token: str, metodo: str):
+        e = self.estado
+        e.llamadas[metodo] += 1
+        e.bytes_recibidos += len(self.request.body)
+        if metodo in METODOS_SUBIDA:
+            e.bytes_subidos += sum(len(f["body"]) for partes in self.request.files.values() for f in partes)
+        if metodo != "getUpdates" and e.args.latencia_telegram:
+            await asyncio.sleep(e.args.latencia_telegram)
+
+        chat_id = self.arg("chat_id", "0")
+        if metodo == "getMe":
+            return self.responder({"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                                   "can_join_groups": False, "can_read_all_group_messages": False,
+                                   "supports_inline_queries": False})
+        if metodo == "getUpdates":
+            timeout = float(self.arg("timeout", "0") or 0)
+            lote = []
+            try:
+                lote.append(await asyncio.wait_for(e.updates.get(), timeout=max(timeout, 0.01)))
+            except asyncio.TimeoutError:
+                pass
+            while not e.updates.empty() and len(lote) < 100:
+                lote.append(e.updates.get_nowait())
+            return self.responder(lote)
+        if metodo == "setWebhook":
+            e.webhook_url = self.arg("url")
+            if str(self.arg("drop_pending_updates", "")).lower() == "true":
+                while not e.updates.empty():
+                    e.updates.get_nowait()
+                    e.descartados += 1
+            else:
+                asyncio.get_running_loop().create_task(_entregar_pendientes(e))
+            return self.responder(True)
+        if metodo == "deleteWebhook":
+            e.webhook_url = None
+            if str(self.arg("drop_pending_updates", "")).lower() == "true":
+                while not e.updates.empty():
+                    e.updates.get_nowait()
+                    e.descartados += 1
+            return self.responder(True)
+        if metodo == "getWebhookInfo":
+            return self.responder({"url": e.webhook_url or "", "has_custom_certificate": False,
+                                   "pending_update_count": e.updates.qsize()})
+        if metodo in {"sendMessage", "editMessageText", "sendDocument"} and e.primer_envio is None:
+            e.primer_envio = time.time()
+        if metodo in {"sendMessage", "editMessageText"}:
+            return self.responder(_mensaje(e, chat_id, text=self.arg("text", "")))
+        if metodo == "sendDocument":
+            doc = _documento(e, self.arg("document", ""), self.archivo("document"))
+            return self.responder(_mensaje(e, chat_id, document=doc, caption=self.arg("caption", "")))
+        if metodo == "sendPhoto":
+            foto = _documento(e, self.arg("photo", ""), self.archivo("photo"))
+            foto.update(width=320, height=452)
+            return self.responder(_mensaje(e, chat_id, photo=[foto]))
+        if metodo == "sendMediaGroup":
+            mensajes = []
+            for media in json.loads(self.arg("media", "[]")):
+                ref = media["media"]
+                archivo = self.archivo(ref[len("attach://"):]) if ref.startswith("attach://") else None
+                mensajes.append(_mensaje(e, chat_id, document=_documento(e, ref, archivo)))
+            return self.responder(mensajes)
+        return self.responder(True)  # answerCallbackQuery, sendChatAction, ...
+
+
+async def _entregar_pendientes(e: Estado):
+    """Como Telegram: al registrar el webhook entrega los updates que quedaron pendientes."""
+    while not e.updates.empty() and e.webhook_url:
+        await e.cliente.post(e.webhook_url, json=e.updates.get_nowait())
+
+
+class OpenAIAPI(tornado.web.RequestHandler):
+    def initialize(self, estado: Estado):
+        self.estado = estado
+
+    async def post(self):
+        e, a = self.estado, self.estado.args
+        cuerpo = json.loads(self.request.body)
+        e.consultas_openai += 1
+        n = cuerpo.get("max_tokens") or a.tokens
+        n = min(n, a.tokens)
+        palabras = [f"palabra{i % 50}" for i in range(n)]
+        prompt = sum(len(m.get("content") or "") for m in cuerpo.get("messages", [])) // 4
+        uso = {"prompt_tokens": prompt, "completion_tokens": n, "total_tokens": prompt + n,
+               "prompt_tokens_details": {"cached_tokens": 0}}
+        await asyncio.sleep(a.latencia_openai)
+        e.tokens_generados += n
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": cuerpo.get("model", "bench")}
+        if not cuerpo.get("stream"):
+            await asyncio.sleep(a.seg_por_token * n)
+            self.set_header("Content-Type", "application/json")
+            return self.finish(json.dumps({**base, "object": "chat.completion", "usage": uso, "choices": [
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": " ".join(palabras)}}
+            ]}))
+        self.set_header("Content-Type", "text/event-stream")
+        for i in range(0, n, 5):
+            trozo = " ".join(palabras[i:i + 5]) + " "
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": trozo}, "finish_reason": None}]}
+            self.write(f"data: {json.dumps(chunk)}\n\n")
+            await self.flush()
+            await asyncio.sleep(a.seg_por_token * 5)
+        final = {**base, "object": "chat.completion.chunk", "usage": uso,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        self.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n")
+        self.finish()
+
+
+class Encolar(tornado.web.RequestHandler):
+    def initialize(self, estado: Estado):
+        self.estado = estado
+
+    def post(self):
+        for update in json.loads(self.request.body):
+            self.estado.updates.put_nowait(update)
+        self.finish({"ok": True})
+
+
+class Webhook(tornado.web.RequestHandler):
+    def initialize(self, estado: Estado):
+        self.estado = estado
+
+    async def post(self):
+        e = self.estado
+        if not e.webhook_url:
+            raise tornado.web.HTTPError(409, "no hay webhook configurado")
+        for update in json.loads(self.request.body):
+            await e.cliente.post(e.webhook_url, json=update)
+        self.finish({"ok": True})
+
+
+class Stats(tornado.web.RequestHandler):
+    def initialize(self, estado: Estado):
+        self.estado = estado
+
+    def get(self):
+        e = self.estado
+        self.finish({"llamadas": dict(e.llamadas), "bytes_recibidos": e.bytes_recibidos,
+                     "bytes_subidos": e.bytes_subidos, "bytes_entregados": e.bytes_entregados,
+                     "consultas_openai": e.consultas_openai,
+                     "tokens_generados": e.tokens_generados, "descartados": e.descartados,
+                     "primer_envio": e.primer_envio})
+
+
+def crear_app(args) -> tornado.web.Application:
+    estado = Estado(args)
+    kw = {"estado": estado}
+    return tornado.web.Application([
+        (r"/bot([^/]+)/(\w+)", BotAPI, kw),
+        (r"/v1/chat/completions", OpenAIAPI, kw),
+        (r"/_encolar", Encolar, kw),
+        (r"/_webhook", Webhook, kw),
+        (r"/_stats", Stats, kw),
+    ])
+
+
+def argumentos(lista=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--puerto", type=int, default=18080)
+    parser.add_argument("--latencia-telegram", type=float, default=0.03, help="segundos por llamada a la Bot API")
+    parser.add_argument("--latencia-openai", type=float, default=0.4, help="segundos hasta el primer token")
+    parser.add_argument("--tokens", type=int, default=300, help="tokens por respuesta del Tutor")
+    parser.add_argument("--seg-por-token", type=float, default=0.004)
+    return parser.parse_args(lista)
+
+
+async def servir(args):
+    crear_app(args).listen(args.puerto, address="127.0.0.1", max_body_size=200 * 1024 * 1024)
+    print(f"[FALSOS] Telegram y OpenAI simulados en http://127.0.0.1:{args.puerto}", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(servir(argumentos()))
@@ -1,19 +1,41 @@
-
+import time
+_T_ARRANQUE = time.perf_counter()  # referencia para el desglose de tiempos de arranque
+_INICIO_PROCESO = time.time()  # los mensajes anteriores son pendientes de cuando el bot dormía
 from pathlib import Path
 from datetime import date, timedelta
 import os
 import sys
+import threading
 import asyncio
+import bisect
+import contextlib
+import contextvars
 import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import signal
+import sqlite3
+import string
+import subprocess
+import unicodedata
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+
+import preprocesar_fichas  # solo biblioteca estándar; PyMuPDF se usa en un proceso aparte
 
 
 # Telegram
 import telegram
 from telegram.request import HTTPXRequest
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    ContextTypes, MessageHandler, filters
+    ContextTypes, MessageHandler, TypeHandler, filters,
+    BasePersistence, PersistenceInput, BaseUpdateProcessor, ApplicationHandlerStop
 )
 
 # Boot logs (útiles en Render)
@@ -21,15 +43,30 @@ print("[BOOT] Python:", sys.version)
 print("[BOOT] PTB version:", getattr(telegram, "__version__", "unknown"))
 print("[BOOT] UTC:", datetime.datetime.utcnow().isoformat(), "UTC")
 
+_etapas_arranque = []  # (etapa, segundos desde _T_ARRANQUE)
+
+def marcar_arranque(etapa: str):
+    _etapas_arranque.append((etapa, time.perf_counter() - _T_ARRANQUE))
+
+def resumen_arranque() -> str:
+    partes, previo = [], 0.0
+    for etapa, t in _etapas_arranque:
+        partes.append(f"{etapa} +{t - previo:.2f}s")
+        previo = t
+    return " · ".join(partes) + f" · total {previo:.2f}s"
+
+marcar_arranque("importaciones")
+
 # ──────────────────────────────────────────────────────────────────────────────
 # CONFIGURACIÓN DESDE VARIABLES DE ENTORNO
 # ──────────────────────────────────────────────────────────────────────────────
 TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # si está vacío → modo polling
 PORT = int(os.getenv("PORT", "10000"))
-
-if not TOKEN:
-    raise RuntimeError("Falta BOT_TOKEN en variables de entorno.")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # opcional: servidor Bot API propio o de pruebas
+# Al despertar se atienden los mensajes que llegaron mientras el bot dormía, si no son
+# más antiguos que esto (segundos). 0 = descartar todos los pendientes al arrancar.
+PENDIENTES_MAX_EDAD_SEG = float(os.getenv("PENDIENTES_MAX_EDAD_SEG", "600"))
 
 # ── GPT: Configuración de OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -37,77 +74,253 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")  # cambia a gpt-4.1 si
 if not OPENAI_API_KEY:
     print("⚠️ Advertencia: Falta OPENAI_API_KEY. El modo Tutor no funcionará hasta que lo configures.")
 
-# ── GPT: Cliente OpenAI (SDK moderno)
-try:
-    from openai import OpenAI
-    _has_openai = True
-except Exception as e:
-    print(f"⚠️ No se pudo importar openai SDK: {e!r}")
-    _has_openai = False
+# Límite de consultas simultáneas a OpenAI y tamaño del pool de conexiones HTTP
+OPENAI_MAX_CONCURRENCIA = int(os.getenv("OPENAI_MAX_CONCURRENCIA", "8"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+# ── GPT: Cliente OpenAI (SDK moderno, asíncrono)
+# El SDK tarda en importarse, así que no se importa al arrancar: se carga en segundo
+# plano después de que el bot ya atiende (precalentar) o, a más tardar, en la primera consulta.
+# Un solo cliente (y un solo pool de conexiones) para todo el proceso; se cierra en post_shutdown.
+_openai = None
+_openai_sem = asyncio.Semaphore(OPENAI_MAX_CONCURRENCIA)
+_sdk_openai = None  # None = sin intentar; False = no disponible; si no, la clase AsyncOpenAI
+
+def _importar_openai():
+    global _sdk_openai
+    if _sdk_openai is None:
+        try:
+            from openai import AsyncOpenAI
+            _sdk_openai = AsyncOpenAI
+        except Exception as e:
+            print(f"⚠️ No se pudo importar openai SDK: {e!r}")
+            _sdk_openai = False
+    return _sdk_openai
+
+def iniciar_openai():
+    global _openai
+    if _openai is not None or not OPENAI_API_KEY or not _importar_openai():
+        return
+    import httpx
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONCURRENCIA,
+            max_keepalive_connections=OPENAI_MAX_CONCURRENCIA,
+            keepalive_expiry=120.0,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+    )
+    _openai = _sdk_openai(
+        api_key=OPENAI_API_KEY,
+        http_client=http_client,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=OPENAI_TIMEOUT,
+    )
+    print(f"[BOOT] Cliente OpenAI listo (concurrencia={OPENAI_MAX_CONCURRENCIA}, timeout={OPENAI_TIMEOUT}s)")
+
+async def cerrar_openai():
+    global _openai
+    if _openai is not None:
+        await _openai.close()
+        _openai = None
 
 def _openai_client():
-    if not _has_openai:
-        raise RuntimeError("El paquete 'openai' no está instalado en el entorno.")
     if not OPENAI_API_KEY:
         raise RuntimeError("Falta OPENAI_API_KEY en variables de entorno.")
-    return OpenAI(api_key=OPENAI_API_KEY)
+    iniciar_openai()
+    if not _sdk_openai:
+        raise RuntimeError("El paquete 'openai' no está instalado en el entorno.")
+    return _openai
 
 # ──────────────────────────────────────────────────────────────────────────────
-# PILOTO DE FICHAS (tus valores)
+# MÉTRICAS (formato de texto de Prometheus en /metrics)
 # ──────────────────────────────────────────────────────────────────────────────
-TOTAL_SEMANAS = 11
-SEMANA1_INICIO = date(2025, 7, 28)
+# Todas se actualizan desde el event loop (un solo hilo), así que no hay candados:
+# registrar una observación es un bisect y dos sumas. En modo webhook se sirven en
+# el mismo puerto (PORT); en modo polling, en METRICAS_PUERTO si se define.
+METRICAS_PUERTO = int(os.getenv("METRICAS_PUERTO", "0"))  # 0 = sin listener en modo polling
+LIMITES_SEG = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_metricas = []
+
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _etiquetas(nombres: tuple, valores: tuple, extra: str = "") -> str:
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+class Contador:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, etiquetas
+        self.valores = {}  # valores de etiquetas → total
+        _metricas.append(self)
+
+    def inc(self, *etiquetas, valor: float = 1):
+        self.valores[etiquetas] = self.valores.get(etiquetas, 0) + valor
+
+    def exponer(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} counter"
+        for clave, total in list(self.valores.items()):
+            yield f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {total}"
+
+class Histograma:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), limites: tuple = LIMITES_SEG):
+        self.nombre, self.ayuda, self.etiquetas, self.limites = nombre, ayuda, etiquetas, limites
+        self.series = {}  # valores de etiquetas → [conteos por intervalo (+Inf al final), suma]
+        _metricas.append(self)
 
+    def observar(self, valor: float, *etiquetas):
+        serie = self.series.get(etiquetas)
+        if serie is None:
+            serie = self.series[etiquetas] = [[0] * (len(self.limites) + 1), 0.0]
+        serie[0][bisect.bisect_left(self.limites, valor)] += 1
+        serie[1] += valor
+
+    def exponer(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} histogram"
+        for clave, (conteos, suma) in list(self.series.items()):
+            acumulado = 0
+            for limite, n in zip((*self.limites, "+Inf"), conteos):
+                acumulado += n
+                le = 'le="%s"' % limite
+                yield f"{self.nombre}_bucket{_etiquetas(self.etiquetas, clave, le)} {acumulado}"
+            yield f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {suma}"
+            yield f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {acumulado}"
+
+class Medidor:
+    """Valor instantáneo que se calcula al momento de exponer (tamaño de colas, etc.)."""
+
+    def __init__(self, nombre: str, ayuda: str, funcion):
+        self.nombre, self.ayuda, self.funcion = nombre, ayuda, funcion
+        _metricas.append(self)
+
+    def exponer(self):
+        try:
+            valor = self.funcion()
+        except Exception:
+            return
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} gauge"
+        yield f"{self.nombre} {valor}"
+
+def exponer_metricas() -> str:
+    return "\n".join(linea for m in _metricas for linea in m.exponer()) + "\n"
+
+M_HANDLER_SEG = Histograma("bot_handler_segundos", "Duración de cada handler (por rama en los botones).", ("handler", "rama"))
+M_UPDATE_EDAD = Histograma("bot_update_edad_segundos", "Antigüedad de cada mensaje al empezar a procesarlo, según su fecha en Telegram.",
+                           limites=(0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600))
+M_UPDATE_COLA = Histograma("bot_update_cola_segundos", "Espera entre la llegada al webhook y el inicio del procesamiento.")
+M_TUTOR_SEG = Histograma("bot_tutor_segundos", "Duración de cada llamada a OpenAI.", ("modo",))
+M_TUTOR_PRIMER_TOKEN = Histograma("bot_tutor_primer_token_segundos", "Tiempo hasta el primer fragmento en streaming.")
+M_TUTOR_TOKENS = Contador("bot_tutor_tokens_total", "Tokens informados por OpenAI.", ("tipo",))
+M_TUTOR_RESPUESTAS = Contador("bot_tutor_respuestas_total", "Respuestas del Tutor por origen.", ("origen",))
+M_SUBIDA_BYTES = Contador("bot_subida_bytes_total", "Bytes de fichas subidos a Telegram.", ("tipo",))
+M_SUBIDA_SEG = Histograma("bot_subida_segundos", "Duración de cada envío de fichas.", ("tipo", "via"))
+M_ERRORES = Contador("bot_errores_total", "Errores por origen y tipo de excepción.", ("origen", "tipo"))
+M_DESCARTADOS = Contador("bot_updates_descartados_total", "Mensajes pendientes descartados por antiguos al arrancar.")
+Medidor("bot_arranque_segundos", "Segundos desde el inicio del proceso hasta atender updates.",
+        lambda: dict(_etapas_arranque)["listo"])
+Medidor("bot_tutor_en_cola", "Consultas al Tutor esperando turno.", lambda: planificador.en_cola)
+Medidor("bot_openai_activas", "Llamadas a OpenAI en curso.", lambda: planificador.activas)
+Medidor("bot_tutor_cache_entradas", "Respuestas guardadas en la caché del Tutor.", lambda: len(cache_respuestas.entradas))
+
+def contar_error(origen: str, error: BaseException):
+    M_ERRORES.inc(origen, type(error).__name__)
+
+_RAMAS_PREFIJO = ("back:subjects:", "sem:", "ficha:", "pdf:", "todo:", "curso:")
+_RAMAS_FIJAS = {"menu", "start", "back:main", "fichas", "back:weeks", "cursos", "comunicados", "evaluaciones",
+                "tutor", "tutor:ask", "tutor:reset", "tutor:exit"}
+
+def rama_boton(data: str) -> str:
+    """Etiqueta de cardinalidad acotada para un callback_data."""
+    for prefijo in _RAMAS_PREFIJO:
+        if data.startswith(prefijo):
+            return prefijo
+    return data if data in _RAMAS_FIJAS else "otro"
+
+_primer_update_atendido = False
+
+def medir_handler(callback, nombre: str):
+    """Envuelve un handler para registrar su duración; los botones se separan por rama."""
+    async def envoltura(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        global _primer_update_atendido
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            fin = time.perf_counter()
+            rama = rama_boton(update.callback_query.data or "") if update.callback_query else ""
+            M_HANDLER_SEG.observar(fin - t0, nombre, rama)
+            if not _primer_update_atendido:
+                _primer_update_atendido = True
+                print(f"[BOOT] Primer update atendido a los {fin - _T_ARRANQUE:.2f}s del inicio del proceso")
+    return envoltura
+
+_llegadas = {}  # update_id → perf_counter al llegar al webhook
+
+async def registrar_llegada(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Grupo -1: corre antes que los demás handlers y mide cuánto esperó el update."""
+    llegada = _llegadas.pop(update.update_id, None)
+    if llegada is not None:
+        M_UPDATE_COLA.observar(time.perf_counter() - llegada)
+    mensaje = update.message  # un mensaje editado conserva la fecha del original
+    if mensaje is not None and mensaje.date is not None:
+        edad = (datetime.datetime.now(datetime.timezone.utc) - mensaje.date).total_seconds()
+        M_UPDATE_EDAD.observar(max(0.0, edad))
+        # Solo se descartan pendientes del arranque, nunca los que llegan con el bot funcionando
+        pendiente = mensaje.date.timestamp() < _INICIO_PROCESO
+        if pendiente and PENDIENTES_MAX_EDAD_SEG > 0 and edad > PENDIENTES_MAX_EDAD_SEG:
+            M_DESCARTADOS.inc()
+            print(f"[BOOT] Mensaje {update.update_id} descartado: {edad:.0f}s de antigüedad")
+            raise ApplicationHandlerStop
+
+# ──────────────────────────────────────────────────────────────────────────────
+# RUTAS
+# ──────────────────────────────────────────────────────────────────────────────
 ROOT_DIR = Path(__file__).parent
-RUTA_FICHAS = ROOT_DIR / "fichas_pedagogicas"
-
-GRADO = 2
-PARALELO = "B"
-USAR_SUFIJO = True
-
-ASIGNATURAS = {
-    "electricidad": "Electricidad, Electromagnetismo y Electrónica",
-    "tren": "Tren de Rodaje",
-    "sistemas": "Sistemas Eléctricos y Electrónicos",
-    "motores": "Motores de Combustión Interna",
-}
-
-ARCHIVOS_BASE = {
-    "electricidad": "electricidad_electromagnetismo.pdf",
-    "tren": "tren_de_rodaje.pdf",
-    "sistemas": "sistemas_electricos_y_electronicos.pdf",
-    "motores": "motores_combustion_interna.pdf",
-}
+
+# Cursos, asignaturas, calendario de semanas y estructura de carpetas de las fichas
+# (ver CATÁLOGO DE FICHAS)
+RUTA_MANIFIESTO = Path(os.getenv("CATALOGO_MANIFIESTO", str(ROOT_DIR / "catalogo.json")))
 
 RUTA_COMUNICADOS = ROOT_DIR / "comunicados.txt"
 
+# Carpeta para cachés persistentes (file_id de Telegram, etc.)
+CACHE_DIR = Path(os.getenv("CACHE_DIR", str(ROOT_DIR / ".cache")))
+RUTA_CACHE_FILE_IDS = CACHE_DIR / "file_ids.json"  # formato anterior; se migra a SQLite
+
 MESES_ES = {1:"Enero",2:"Febrero",3:"Marzo",4:"Abril",5:"Mayo",6:"Junio",7:"Julio",8:"Agosto",9:"Septiembre",10:"Octubre",11:"Noviembre",12:"Diciembre"}
-MESES_ABR = {1:"Ene",2:"Feb",3:"Mar",4:"Abr",5:"May",6:"Jun",7:"Jul",8:"Ago",9:"Sep",10:"Oct",11:"Dic"}
+MESES_ABR = {1:"Ene",2:"Feb",3:"Mar",4:"Abr",5:"May",6:"Jun",7:"Jul",8:"Ago",9:"Sep",10:"Oct",11:"Nov",12:"Dic"}
 
 # ──────────────────────────────────────────────────────────────────────────────
-# FECHAS POR SEMANA
+# FECHAS POR SEMANA (según el calendario de cada curso)
 # ──────────────────────────────────────────────────────────────────────────────
-def rango_semana(n_semana: int):
-    inicio = SEMANA1_INICIO + timedelta(days=(n_semana - 1) * 7)
+def rango_semana(curso, n_semana: int):
+    inicio = curso.semana1_inicio + timedelta(days=(n_semana - 1) * 7)
     fin = inicio + timedelta(days=4)
     return inicio, fin
 
-def texto_rango_semana_solo_fecha(n_semana: int) -> str:
-    ini, fin = rango_semana(n_semana)
+def texto_rango_semana_solo_fecha(curso, n_semana: int) -> str:
+    ini, fin = rango_semana(curso, n_semana)
     if ini.month == fin.month:
         return f"Del {ini.day} al {fin.day} de {MESES_ES[fin.month]} de {fin.year}"
     else:
         return f"Del {ini.day} de {MESES_ES[ini.month]} al {fin.day} de {MESES_ES[fin.month]} de {fin.year}"
 
-def texto_rango_semana_abreviado(n_semana: int) -> str:
-    ini, fin = rango_semana(n_semana)
+def texto_rango_semana_abreviado(curso, n_semana: int) -> str:
+    ini, fin = rango_semana(curso, n_semana)
     if ini.month == fin.month:
         return f"{ini.day} {MESES_ABR[ini.month]}–{fin.day} {MESES_ABR[fin.month]}"
     else:
         return f"{ini.day} {MESES_ABR[ini.month]}–{fin.day} {MESES_ABR[fin.month]}"
 
-def texto_encabezado_semana(n_semana: int) -> str:
-    rango = texto_rango_semana_solo_fecha(n_semana)
+def texto_encabezado_semana(curso, n_semana: int) -> str:
+    rango = texto_rango_semana_solo_fecha(curso, n_semana)
     return f"Semana {n_semana}: {rango}\nSeleccione la asignatura:"
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -163,12 +376,8 @@ Formato breve para dudas rápidas:
 # ──────────────────────────────────────────────────────────────────────────────
 # HELPERS DE UI
 # ──────────────────────────────────────────────────────────────────────────────
-def hay_pdf_disponible(semana: int, asign_key: str) -> bool:
-    p = ruta_pdf(semana, asign_key)
-    return bool(p) and p.exists()
-
-def etiqueta_grado_paralelo() -> str:
-    return f"{GRADO}º {PARALELO}"
+def hay_pdf_disponible(curso, semana: int, asign_key: str) -> bool:
+    return buscar_ficha(curso, semana, asign_key) is not None
 
 def kb_menu_principal() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
@@ -178,25 +387,77 @@ def kb_menu_principal() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("🤖 Tutor Virtual", callback_data="tutor")],
     ])
 
-def kb_semanas() -> InlineKeyboardMarkup:
+# Los teclados de cursos, semanas y asignaturas solo cambian con el catálogo de fichas;
+# se guardan mientras no cambie su firma (InlineKeyboardMarkup es inmutable y se puede reutilizar).
+_teclados = {}
+_teclados_firma = None
+
+def _teclado_en_cache(construir, *args) -> InlineKeyboardMarkup:
+    global _teclados_firma
+    catalogo_fichas()  # revalida la firma si ya pasó CATALOGO_REVALIDAR_SEG
+    if _teclados_firma != _catalogo_firma:
+        _teclados.clear()  # teclados del catálogo anterior
+        _teclados_firma = _catalogo_firma
+    clave = (construir.__name__, args)
+    teclado = _teclados.get(clave)
+    if teclado is None:
+        teclado = _teclados[clave] = construir(*args)
+    return teclado
+
+def precalentar_teclados():
+    """Cursos y semanas de cada curso; los de asignaturas se arman al primer uso."""
+    kb_cursos()
+    for curso in list(catalogo_fichas().cursos.values()):
+        kb_semanas(curso)
+
+def kb_cursos() -> InlineKeyboardMarkup:
+    return _teclado_en_cache(_construir_kb_cursos)
+
+def kb_semanas(curso) -> InlineKeyboardMarkup:
+    return _teclado_en_cache(_construir_kb_semanas, curso.codigo)
+
+def kb_asignaturas(curso, semana: int) -> InlineKeyboardMarkup:
+    return _teclado_en_cache(_construir_kb_asignaturas, curso.codigo, semana)
+
+def _construir_kb_cursos() -> InlineKeyboardMarkup:
+    botones = [InlineKeyboardButton(curso.nombre, callback_data=datos_boton("curso", curso.codigo))
+               for curso in _catalogo.cursos.values()]
+    filas = [botones[i:i + 3] for i in range(0, len(botones), 3)]
+    filas.append([InlineKeyboardButton("🔙 Regresar al Menú Principal", callback_data="back:main")])
+    return InlineKeyboardMarkup(filas)
+
+def _construir_kb_semanas(codigo: str) -> InlineKeyboardMarkup:
+    curso = _catalogo.cursos[codigo]
     keyboard = []
-    for n in range(1, TOTAL_SEMANAS + 1):
-        etiqueta = f"Semana {n} ({texto_rango_semana_abreviado(n)})"
-        keyboard.append([InlineKeyboardButton(etiqueta, callback_data=f"sem:{n}")])
+    con_fichas = semanas_con_fichas(curso)
+    for n in range(1, max([curso.total_semanas, *con_fichas]) + 1):
+        etiqueta = f"Semana {n} ({texto_rango_semana_abreviado(curso, n)})"
+        if n not in con_fichas:
+            etiqueta += " · sin fichas"
+        keyboard.append([InlineKeyboardButton(etiqueta, callback_data=datos_boton("sem", codigo, n))])
+    if len(_catalogo.cursos) > 1:
+        keyboard.append([InlineKeyboardButton("🔁 Cambiar de curso", callback_data="cursos")])
     keyboard.append([InlineKeyboardButton("🔙 Regresar al Menú Principal", callback_data="back:main")])
     return InlineKeyboardMarkup(keyboard)
 
-def kb_asignaturas(semana: int) -> InlineKeyboardMarkup:
-    filas = []
-    orden = ["electricidad", "tren", "sistemas", "motores"]
-    for key in orden:
-        if hay_pdf_disponible(semana, key):
-            filas.append([InlineKeyboardButton(ASIGNATURAS[key], callback_data=f"ficha:{semana}:{key}")])
+def _construir_kb_asignaturas(codigo: str, semana: int) -> InlineKeyboardMarkup:
+    curso = _catalogo.cursos[codigo]
+    fichas = fichas_de_semana(curso, semana)
+    filas = [[InlineKeyboardButton(nombre_asignatura(key), callback_data=datos_boton("ficha", codigo, semana, key))]
+             for key, _ruta in fichas]
+    if len(fichas) > 1:
+        filas.append([InlineKeyboardButton("📦 Descargar toda la semana", callback_data=datos_boton("todo", codigo, semana))])
     filas.append([InlineKeyboardButton("🔙 Regresar a Selección de Semanas", callback_data="back:weeks")])
     return InlineKeyboardMarkup(filas)
 
-def kb_volver_asignaturas(semana: int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Regresar a Asignaturas", callback_data=f"back:subjects:{semana}")]])
+def texto_semanas(curso) -> str:
+    if len(_catalogo.cursos) > 1:
+        return f"Curso {curso.nombre} · Selecciona la semana:"
+    return "Selecciona la semana:"
+
+def kb_volver_asignaturas(curso, semana: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(
+        "🔙 Regresar a Asignaturas", callback_data=datos_boton("back:subjects", curso.codigo, semana))]])
 
 def kb_tutor_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
@@ -208,59 +469,2037 @@ def kb_tutor_menu() -> InlineKeyboardMarkup:
 def leer_comunicados() -> str:
     if not RUTA_COMUNICADOS.exists():
         return "No hay comunicados aún. (Crea el archivo comunicados.txt para agregarlos)"
-    contenido = RUTA_COMUNICADOS.read_text(encoding="utf-8").strip()
+    contenido = comunicados_actuales()["texto"]
     return contenido if contenido else "No hay comunicados por el momento."
 
-def ruta_pdf(semana: int, asign_key: str) -> Path:
-    carpeta = RUTA_FICHAS / f"semana{semana}"
-    base = ARCHIVOS_BASE.get(asign_key)
-    if not base:
-        return Path("")
-    if USAR_SUFIJO:
-        base_sin_ext = base[:-4] if base.lower().endswith(".pdf") else base
-        candidatos = []
-        for letra in (PARALELO, PARALELO.upper(), PARALELO.lower()):
-            candidatos.append(f"{base_sin_ext}_{GRADO}{letra}_S{semana}.pdf")
-            candidatos.append(f"{base_sin_ext}_{GRADO}{letra}_s{semana}.pdf")
-        for nombre in candidatos:
-            ruta = carpeta / nombre
-            if ruta.exists():
-                return ruta
-    return carpeta / base
+# ──────────────────────────────────────────────────────────────────────────────
+# CATÁLOGO DE FICHAS (manifiesto de cursos + índice en memoria de los PDF)
+# ──────────────────────────────────────────────────────────────────────────────
+# catalogo.json describe las asignaturas (nombre y nombre base del archivo), los cursos
+# (nombre, asignaturas, calendario y carpeta) y la estructura de carpetas con plantillas:
+#     "carpeta_semana": "semana{semana}",  "archivo": "{asignatura}_{curso}_s{semana}.pdf"
+# Las carpetas se escanean una sola vez y quedan en un diccionario
+# (curso, semana, asignatura) → ruta; después solo se revisan las fechas de modificación
+# del manifiesto y de las carpetas (como máximo cada CATALOGO_REVALIDAR_SEG).
+CATALOGO_REVALIDAR_SEG = float(os.getenv("CATALOGO_REVALIDAR_SEG", "10"))
+LIMITE_CALLBACK_DATA = 64  # bytes (límite de Telegram)
+
+_PATRON_CODIGO = re.compile(r"^[0-9A-Za-z-]{1,12}$")          # códigos de curso y sufijos de archivo
+_PATRON_ASIGNATURA = re.compile(r"^[0-9a-z]{1,16}$")          # claves de asignatura
+_CAMPOS_PLANTILLA = {"semana": r"(?P<semana>\d+)", "asignatura": r"(?P<asignatura>.+?)", "curso": r"(?P<curso>[^_/]+)"}
+
+def datos_boton(*partes) -> str:
+    """callback_data compacto: partes separadas por ':' (p. ej. ficha:2B:6:tren)."""
+    datos = ":".join(str(p) for p in partes)
+    if len(datos.encode()) > LIMITE_CALLBACK_DATA:
+        raise ValueError(f"callback_data de más de {LIMITE_CALLBACK_DATA} bytes: {datos!r}")
+    return datos
+
+def _plantilla_a_regex(plantilla: str) -> re.Pattern:
+    """'semana{semana}' → ^semana(?P<semana>\\d+)$, sin distinguir mayúsculas."""
+    patron, vistos = "", set()
+    for literal, campo, _formato, _conversion in string.Formatter().parse(plantilla):
+        patron += re.escape(literal)
+        if campo is None:
+            continue
+        if campo not in _CAMPOS_PLANTILLA or campo in vistos:
+            raise ValueError(f"campo {{{campo}}} desconocido o repetido en {plantilla!r}")
+        vistos.add(campo)
+        patron += _CAMPOS_PLANTILLA[campo]
+    return re.compile(f"^{patron}$", re.IGNORECASE)
+
+def _mtime(ruta: Path):
+    try:
+        return ruta.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+class Curso:
+    def __init__(self, codigo: str, nombre: str, asignaturas: list, carpeta: Path, sufijo: str,
+                 semana1_inicio: date, total_semanas: int):
+        self.codigo = codigo                # aparece en callback_data
+        self.nombre = nombre                # p. ej. "2º B"
+        self.asignaturas = asignaturas      # claves, en el orden de los botones
+        self.carpeta = carpeta
+        self.sufijo = sufijo                # {curso} en el nombre de archivo (por defecto, el código)
+        self.semana1_inicio = semana1_inicio
+        self.total_semanas = total_semanas
+
+class Catalogo:
+    """Manifiesto de cursos y fichas encontradas en disco, con búsqueda O(1) por
+    (curso, semana, asignatura)."""
+
+    def __init__(self, manifiesto: dict, base: Path):
+        self.asignaturas = {}   # clave → nombre visible
+        self._por_archivo = {}  # nombre base del archivo (minúsculas) → clave
+        for clave, datos in manifiesto["asignaturas"].items():
+            if not _PATRON_ASIGNATURA.match(clave):
+                raise ValueError(f"clave de asignatura inválida: {clave!r}")
+            self.asignaturas[clave] = datos["nombre"]
+            self._por_archivo[datos["archivo"].lower()] = clave
+
+        self.plantilla_carpeta = manifiesto.get("carpeta_semana", "semana{semana}")
+        self.plantilla_archivo = manifiesto["archivo"]
+        self.plantilla_comun = manifiesto.get("archivo_comun")  # ficha compartida por todos los cursos
+        self._patron_carpeta = _plantilla_a_regex(self.plantilla_carpeta)
+        self._patrones_archivo = [_plantilla_a_regex(p) for p in (self.plantilla_archivo, self.plantilla_comun) if p]
+        if "semana" not in self._patron_carpeta.groupindex:
+            raise ValueError("carpeta_semana debe incluir {semana}")
+        if any("asignatura" not in p.groupindex for p in self._patrones_archivo):
+            raise ValueError("archivo y archivo_comun deben incluir {asignatura}")
+
+        calendario = manifiesto.get("calendario", {})
+        self.cursos = {}        # código → Curso, en el orden del manifiesto
+        sufijos = set()
+        for codigo, datos in manifiesto["cursos"].items():
+            if not _PATRON_CODIGO.match(codigo):
+                raise ValueError(f"código de curso inválido: {codigo!r}")
+            propio = {**calendario, **datos.get("calendario", {})}
+            curso = Curso(
+                codigo=codigo,
+                nombre=datos.get("nombre", codigo),
+                asignaturas=list(datos.get("asignaturas", self.asignaturas)),
+                carpeta=base / datos.get("carpeta", manifiesto["carpeta"]),
+                sufijo=datos.get("sufijo", codigo),
+                semana1_inicio=date.fromisoformat(propio["semana1_inicio"]),
+                total_semanas=int(propio["total_semanas"]),
+            )
+            desconocidas = [a for a in curso.asignaturas if a not in self.asignaturas]
+            if desconocidas:
+                raise ValueError(f"el curso {codigo} usa asignaturas que no están en el manifiesto: {desconocidas}")
+            if (curso.carpeta, curso.sufijo.lower()) in sufijos:
+                raise ValueError(f"sufijo {curso.sufijo!r} repetido en {curso.carpeta}")
+            sufijos.add((curso.carpeta, curso.sufijo.lower()))
+            for clave in curso.asignaturas:  # el callback_data más largo debe caber
+                datos_boton("back:subjects", codigo, max(curso.total_semanas, 999), clave)
+            self.cursos[codigo] = curso
+        if not self.cursos:
+            raise ValueError("el manifiesto no define cursos")
+
+        self.fichas = {}        # (curso, semana, asignatura) → ruta
+        self._semanas = {}      # curso → semanas con fichas
+        self._por_semana = {}   # (curso, semana) → [(asignatura, ruta)] en el orden del curso
+
+    @classmethod
+    def cargar(cls, ruta: Path) -> "Catalogo":
+        try:
+            return cls(json.loads(ruta.read_text(encoding="utf-8")), ruta.parent)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Manifiesto de cursos inválido ({ruta}): {e!r}") from e
+
+    def carpetas(self) -> list:
+        return sorted({curso.carpeta for curso in self.cursos.values()})
+
+    def firma_carpetas(self) -> tuple:
+        """mtime de cada carpeta y de sus carpetas de semana: cambia al agregar/quitar archivos."""
+        firma = []
+        for carpeta in self.carpetas():
+            firma.append((str(carpeta), _mtime(carpeta)))
+            try:
+                with os.scandir(carpeta) as it:
+                    for entrada in it:
+                        if entrada.is_dir() and self._patron_carpeta.match(entrada.name):
+                            firma.append((entrada.path, entrada.stat().st_mtime_ns))
+            except FileNotFoundError:
+                pass
+        return tuple(sorted(firma))
+
+    def escanear(self):
+        """Recorre las carpetas del manifiesto y reemplaza los índices de una vez."""
+        especificas, comunes = {}, {}
+        for carpeta in self.carpetas():
+            por_sufijo = {c.sufijo.lower(): c for c in self.cursos.values() if c.carpeta == carpeta}
+            try:
+                with os.scandir(carpeta) as it:
+                    subcarpetas = [e for e in it if e.is_dir()]
+            except FileNotFoundError:
+                continue
+            for sub in subcarpetas:
+                m_carpeta = self._patron_carpeta.match(sub.name)
+                if not m_carpeta:
+                    continue
+                semana = int(m_carpeta.group("semana"))
+                try:
+                    with os.scandir(sub.path) as it:
+                        entradas = list(it)
+                except FileNotFoundError:
+                    continue  # se borró durante el escaneo
+                for entrada in entradas:
+                    m = next(filter(None, (p.match(entrada.name) for p in self._patrones_archivo)), None)
+                    if not m:
+                        continue
+                    grupos = m.groupdict()
+                    asign = self._por_archivo.get(grupos["asignatura"].lower())
+                    if asign is None or int(grupos.get("semana") or semana) != semana:
+                        continue
+                    if grupos.get("curso") is not None:
+                        destino, cursos = especificas, [por_sufijo.get(grupos["curso"].lower())]
+                    else:
+                        destino, cursos = comunes, por_sufijo.values()
+                    for curso in cursos:
+                        if curso is not None and asign in curso.asignaturas:
+                            destino[(curso.codigo, semana, asign)] = Path(entrada.path)
+        fichas = {**comunes, **especificas}  # la ficha propia del curso tiene prioridad
+        semanas = {}
+        for codigo, semana, _asign in fichas:
+            semanas.setdefault(codigo, set()).add(semana)
+        por_semana = {}
+        for codigo, semanas_curso in semanas.items():
+            curso = self.cursos[codigo]
+            for semana in semanas_curso:
+                por_semana[(codigo, semana)] = [(a, fichas[(codigo, semana, a)]) for a in curso.asignaturas
+                                                if (codigo, semana, a) in fichas]
+        self.fichas, self._semanas, self._por_semana = fichas, semanas, por_semana
+
+    def ficha(self, curso: Curso, semana: int, asign: str):
+        return self.fichas.get((curso.codigo, semana, asign))
+
+    def semanas(self, curso: Curso) -> set:
+        return self._semanas.get(curso.codigo, set())
+
+    def de_semana(self, curso: Curso, semana: int) -> list:
+        return self._por_semana.get((curso.codigo, semana), [])
+
+    def ruta_esperada(self, curso: Curso, semana: int, asign: str) -> Path:
+        base = next((b for b, clave in self._por_archivo.items() if clave == asign), asign)
+        return (curso.carpeta / self.plantilla_carpeta.format(semana=semana)
+                / self.plantilla_archivo.format(asignatura=base, curso=curso.sufijo, semana=semana))
+
+_catalogo = Catalogo.cargar(RUTA_MANIFIESTO)
+_catalogo_firma = None
+_catalogo_revisado = 0.0
+
+def catalogo_fichas() -> Catalogo:
+    """Devuelve el catálogo; relee el manifiesto o reescanea las carpetas solo si cambiaron."""
+    global _catalogo, _catalogo_firma, _catalogo_revisado
+    ahora = time.monotonic()
+    if _catalogo_firma is not None and ahora - _catalogo_revisado < CATALOGO_REVALIDAR_SEG:
+        return _catalogo
+    _catalogo_revisado = ahora
+    catalogo = _catalogo
+    mtime_manifiesto = _mtime(RUTA_MANIFIESTO)
+    if _catalogo_firma is not None and mtime_manifiesto != _catalogo_firma[0]:
+        try:
+            catalogo = Catalogo.cargar(RUTA_MANIFIESTO)
+            print(f"[CATALOGO] Manifiesto recargado: {len(catalogo.cursos)} cursos")
+        except ValueError as e:
+            print(f"⚠️ {e}; se mantiene el catálogo anterior")
+    firma = (mtime_manifiesto, catalogo.firma_carpetas())
+    if firma != _catalogo_firma:
+        catalogo.escanear()
+        _catalogo, _catalogo_firma = catalogo, firma
+        print(f"[CATALOGO] {len(catalogo.fichas)} fichas indexadas para {len(catalogo.cursos)} cursos")
+    return _catalogo
+
+def curso_de(user_data: dict):
+    """Curso elegido por el usuario (user_data["curso"]); si el manifiesto tiene uno solo, ese."""
+    cursos = catalogo_fichas().cursos
+    curso = cursos.get(user_data.get("curso"))
+    if curso is None and len(cursos) == 1:
+        curso = next(iter(cursos.values()))
+    return curso
+
+def curso_de_boton(partes: list, campos: int, user_data: dict) -> tuple:
+    """(curso, resto) de un callback_data con curso (sem:2B:6) o sin él, del formato
+    anterior (sem:6): los botones viejos se atienden con el curso del usuario."""
+    if len(partes) > campos:
+        return catalogo_fichas().cursos.get(partes[0]), partes[1:]
+    return curso_de(user_data), partes
+
+def codigo_curso(user_data: dict):
+    curso = curso_de(user_data)
+    return curso.codigo if curso else None
+
+def nombre_asignatura(asign_key: str) -> str:
+    return _catalogo.asignaturas.get(asign_key, asign_key)
+
+def semanas_con_fichas(curso: Curso) -> set:
+    return catalogo_fichas().semanas(curso)
+
+def buscar_ficha(curso: Curso, semana: int, asign_key: str):
+    return catalogo_fichas().ficha(curso, semana, asign_key)
+
+def fichas_de_semana(curso: Curso, semana: int) -> list:
+    return catalogo_fichas().de_semana(curso, semana)
+
+def ruta_pdf(curso: Curso, semana: int, asign_key: str) -> Path:
+    """Ruta de la ficha; si no está en el catálogo, la ruta esperada (para mensajes de error)."""
+    return buscar_ficha(curso, semana, asign_key) or _catalogo.ruta_esperada(curso, semana, asign_key)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# CACHÉ DE FILE_ID (cada PDF se sube una sola vez a Telegram)
+# ──────────────────────────────────────────────────────────────────────────────
+# Tabla file_ids de la base compartida (RUTA_ESTADO_DB), así todos los procesos
+# trabajadores reutilizan lo que subió cualquiera de ellos. _file_ids es la copia
+# local: solo se consulta la base cuando la copia no tiene el archivo o cambió.
+# clave: ruta relativa del PDF → {"firma": "tamaño:mtime", "file_id": "..."}
+_file_ids: dict = {}
+_con_file_ids = None
+
+def _clave_archivo(ruta: Path) -> str:
+    try:
+        return ruta.resolve().relative_to(ROOT_DIR.resolve()).as_posix()
+    except ValueError:
+        return ruta.resolve().as_posix()
+
+def _firma_archivo(ruta: Path) -> str:
+    st = ruta.stat()
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def _conexion_file_ids() -> sqlite3.Connection:
+    global _con_file_ids
+    if _con_file_ids is None:
+        _con_file_ids = abrir_sqlite(RUTA_ESTADO_DB)
+        _con_file_ids.execute("CREATE TABLE IF NOT EXISTS file_ids ("
+                              " clave TEXT PRIMARY KEY, firma TEXT NOT NULL, file_id TEXT NOT NULL)")
+        _migrar_file_ids_json(_con_file_ids)
+    return _con_file_ids
+
+def _migrar_file_ids_json(con: sqlite3.Connection):
+    """Importa una sola vez la caché anterior en JSON (file_ids.json)."""
+    try:
+        anteriores = json.loads(RUTA_CACHE_FILE_IDS.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"⚠️ Caché de file_id ilegible, se ignora: {e!r}")
+        anteriores = {}
+    con.executemany("INSERT OR IGNORE INTO file_ids (clave, firma, file_id) VALUES (?, ?, ?)",
+                    [(k, v["firma"], v["file_id"]) for k, v in anteriores.items()])
+    RUTA_CACHE_FILE_IDS.rename(RUTA_CACHE_FILE_IDS.with_suffix(".json.migrado"))
+    print(f"[CACHE] {len(anteriores)} file_id migrados de {RUTA_CACHE_FILE_IDS.name} a SQLite")
+
+def file_id_en_cache(ruta: Path):
+    """Devuelve el file_id guardado si el archivo no cambió desde que se subió."""
+    clave = _clave_archivo(ruta)
+    firma = _firma_archivo(ruta)
+    entrada = _file_ids.get(clave)
+    if entrada and entrada["firma"] == firma:
+        return entrada["file_id"]
+    fila = _conexion_file_ids().execute("SELECT firma, file_id FROM file_ids WHERE clave = ?", (clave,)).fetchone()
+    if fila and fila[0] == firma:
+        _file_ids[clave] = {"firma": fila[0], "file_id": fila[1]}
+        return fila[1]
+    return None
+
+def recordar_file_id(ruta: Path, file_id: str):
+    clave = _clave_archivo(ruta)
+    entrada = _file_ids[clave] = {"firma": _firma_archivo(ruta), "file_id": file_id}
+    try:
+        _conexion_file_ids().execute("INSERT OR REPLACE INTO file_ids (clave, firma, file_id) VALUES (?, ?, ?)",
+                                     (clave, entrada["firma"], file_id))
+    except sqlite3.Error as e:
+        print(f"⚠️ No se pudo guardar el file_id de {ruta.name}: {e!r}")
+
+def olvidar_file_id(ruta: Path):
+    clave = _clave_archivo(ruta)
+    _file_ids.pop(clave, None)
+    try:
+        _conexion_file_ids().execute("DELETE FROM file_ids WHERE clave = ?", (clave,))
+    except sqlite3.Error as e:
+        print(f"⚠️ No se pudo olvidar el file_id de {ruta.name}: {e!r}")
+
+async def _enviar_con_cache(enviar, ruta: Path, tipo: str, **kwargs):
+    """Envía un archivo (enviar = message.reply_document o reply_photo) reutilizando el file_id
+    de Telegram; si no hay o lo rechaza, lo sube de nuevo."""
+    file_id = file_id_en_cache(ruta)
+    if file_id:
+        t0 = time.perf_counter()
+        try:
+            enviado = await enviar(file_id, **kwargs)
+            M_SUBIDA_SEG.observar(time.perf_counter() - t0, tipo, "file_id")
+            return enviado
+        except telegram.error.BadRequest as e:
+            print(f"[CACHE] file_id rechazado para {ruta.name} ({e}); se vuelve a subir")
+            olvidar_file_id(ruta)
+
+    t0 = time.perf_counter()
+    with ruta.open("rb") as f:
+        enviado = await enviar(f, filename=ruta.name, **kwargs)
+    M_SUBIDA_SEG.observar(time.perf_counter() - t0, tipo, "archivo")
+    M_SUBIDA_BYTES.inc(tipo, valor=ruta.stat().st_size)
+    adjunto = enviado and (enviado.photo[-1] if enviado.photo else enviado.document)
+    if adjunto:
+        recordar_file_id(ruta, adjunto.file_id)
+    return enviado
+
+async def enviar_documento(message, ruta: Path, caption: str, reply_markup=None):
+    return await _enviar_con_cache(message.reply_document, ruta, "documento", caption=caption, reply_markup=reply_markup)
+
+async def enviar_previa(message, ruta: Path, caption: str, reply_markup=None):
+    return await _enviar_con_cache(message.reply_photo, ruta, "previa", caption=caption, reply_markup=reply_markup)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# FICHAS LIGERAS (PDF optimizado y vista previa, ver preprocesar_fichas.py)
+# ──────────────────────────────────────────────────────────────────────────────
+# preprocesar_fichas.py deja en FICHAS_LIGERAS_DIR un PDF más liviano y una imagen de la
+# primera página por ficha. Al tocar una ficha se envía primero la imagen (unos 100 KB)
+# con un botón para descargar el PDF; el PDF, el álbum y el zip usan la versión
+# optimizada. Si falta o la ficha cambió desde que se procesó, se usa el original.
+# Con FICHAS_LIGERAS=1 el proceso principal lo ejecuta en segundo plano, con baja
+# prioridad, al arrancar y cada vez que cambia el catálogo.
+FICHAS_LIGERAS = os.getenv("FICHAS_LIGERAS", "1") == "1"
+FICHAS_LIGERAS_DIR = Path(os.getenv("FICHAS_LIGERAS_DIR", str(CACHE_DIR / "ligeras")))
+FICHAS_PREVIA = os.getenv("FICHAS_PREVIA", "1") == "1"
+FICHAS_PREVIA_DPI = int(os.getenv("FICHAS_PREVIA_DPI", "90"))
+_ligeras: dict = {}  # manifiesto de preprocesar_fichas.py; se relee si cambia en disco
+_ligeras_mtime = None
+
+def _manifiesto_ligeras() -> dict:
+    global _ligeras, _ligeras_mtime
+    mtime = _mtime(FICHAS_LIGERAS_DIR / preprocesar_fichas.NOMBRE_MANIFIESTO)
+    if mtime != _ligeras_mtime or not _ligeras:
+        _ligeras = preprocesar_fichas.cargar_manifiesto(FICHAS_LIGERAS_DIR)
+        _ligeras_mtime = mtime
+    return _ligeras
+
+def _entradas_ligeras() -> dict:
+    return _manifiesto_ligeras()["fichas"]
+
+def _versiones_ligeras(ruta: Path) -> tuple:
+    """(PDF optimizado, vista previa) vigentes de una ficha; None donde no hay."""
+    if not FICHAS_LIGERAS:
+        return None, None
+    entrada = _entradas_ligeras().get(_clave_archivo(ruta))
+    try:
+        if entrada is None or entrada["firma"] != _firma_archivo(ruta):
+            return None, None
+    except FileNotFoundError:
+        return None, None
+    return tuple(r if r is not None and r.exists() else None
+                 for r in preprocesar_fichas.rutas_salida(FICHAS_LIGERAS_DIR, entrada))
+
+def variante_ligera(ruta: Path) -> Path:
+    return _versiones_ligeras(ruta)[0] or ruta
+
+def previa_de(ruta: Path):
+    return _versiones_ligeras(ruta)[1] if FICHAS_PREVIA else None
+
+def inventario_fichas() -> list:
+    """[(clave, ruta, semana)] de cada PDF del catálogo, sin repetir los comunes a varios cursos."""
+    vistas = {}
+    for (_codigo, semana, _asign), ruta in catalogo_fichas().fichas.items():
+        vistas.setdefault(_clave_archivo(ruta), (ruta, semana))
+    return [(clave, ruta, semana) for clave, (ruta, semana) in vistas.items()]
+
+def fichas_ligeras_al_dia() -> bool:
+    """True si todas las fichas del catálogo ya se procesaron con los ajustes actuales."""
+    manifiesto = _manifiesto_ligeras()
+    if manifiesto["ajustes"] != preprocesar_fichas.ajustes(FICHAS_PREVIA_DPI):
+        return False
+    try:
+        return all(clave in manifiesto["fichas"] and manifiesto["fichas"][clave]["firma"] == _firma_archivo(ruta)
+                   for clave, ruta, _semana in inventario_fichas())
+    except FileNotFoundError:
+        return False
+
+def kb_descargar_pdf(curso, semana: int, asign_key: str, ruta: Path) -> InlineKeyboardMarkup:
+    kib = ruta.stat().st_size / 1024
+    tamaño = f"{kib / 1024:.1f} MB" if kib >= 1024 else f"{kib:.0f} KB"
+    return InlineKeyboardMarkup([[InlineKeyboardButton(
+        f"⬇️ Descargar PDF completo ({tamaño})", callback_data=datos_boton("pdf", curso.codigo, semana, asign_key))]])
+
+async def preprocesar_en_fondo():
+    """Ejecuta preprocesar_fichas.py (otro proceso, con su propio pool) cuando cambia el catálogo."""
+    if not preprocesar_fichas.hay_pymupdf():
+        print("[FICHAS] PyMuPDF no está instalado: se envían los PDF originales, sin vista previa")
+        return
+    procesado = None
+    while True:
+        catalogo_fichas()
+        firma = _catalogo_firma
+        if firma != procesado and await asyncio.to_thread(fichas_ligeras_al_dia):
+            procesado = firma  # nada que hacer (p. ej. al reiniciar con el disco intacto)
+        if firma != procesado:
+            proceso = await asyncio.create_subprocess_exec(
+                sys.executable, str(ROOT_DIR / "preprocesar_fichas.py"),
+                "--procesos", str(max(1, (os.cpu_count() or 1) - 1)), "--prioridad", "10")
+            try:
+                if await proceso.wait() == 0:
+                    procesado = firma
+                else:
+                    print(f"⚠️ preprocesar_fichas.py terminó con código {proceso.returncode}")
+            finally:
+                if proceso.returncode is None:
+                    proceso.terminate()
+        await asyncio.sleep(INDICE_REVISAR_SEG)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# SEMANA COMPLETA (todas las fichas en un solo envío)
+# ──────────────────────────────────────────────────────────────────────────────
+# Por defecto se envía un álbum de documentos (sendMediaGroup) reutilizando los
+# file_id en caché. Con FICHAS_ZIP=1 se envía un .zip por semana, generado en
+# segundo plano y guardado en CACHE_DIR/zips/<firma>/.
+FICHAS_ZIP = os.getenv("FICHAS_ZIP", "0") == "1"
+_zips_en_construccion = set()
+
+def ruta_zip_semana(curso, semana: int, fichas: list) -> Path:
+    firma = hashlib.sha1("|".join(f"{_clave_archivo(r)}:{_firma_archivo(r)}" for _k, r in fichas).encode()).hexdigest()[:12]
+    return CACHE_DIR / "zips" / firma / f"Fichas_Semana_{semana}_{curso.codigo}.zip"
+
+def _construir_zip(destino: Path, fichas: list):
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    tmp = destino.with_suffix(f".{os.getpid()}.tmp")
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for _key, ruta in fichas:
+            zf.write(ruta, arcname=ruta.name)
+    os.replace(tmp, destino)
+    # Zips anteriores de la misma semana (con otra firma) ya no sirven. Solo se borra el
+    # archivo: otro curso con las mismas fichas comparte la carpeta de la firma.
+    for viejo in (CACHE_DIR / "zips").glob(f"*/{destino.name}"):
+        if viejo != destino:
+            viejo.unlink(missing_ok=True)
+            with contextlib.suppress(OSError):
+                viejo.parent.rmdir()  # solo si quedó vacía
+
+def fichas_para_enviar(curso, semana: int) -> list:
+    """Fichas de la semana con la versión optimizada de cada PDF, si la hay."""
+    return [(key, variante_ligera(ruta)) for key, ruta in fichas_de_semana(curso, semana)]
+
+async def preparar_zip_semana(curso, semana: int):
+    fichas = fichas_para_enviar(curso, semana)
+    if not fichas:
+        return
+    destino = ruta_zip_semana(curso, semana, fichas)
+    if destino.exists() or destino in _zips_en_construccion:
+        return
+    _zips_en_construccion.add(destino)
+    try:
+        await asyncio.to_thread(_construir_zip, destino, fichas)
+        print(f"[ZIP] {destino.name} listo ({destino.stat().st_size // 1024} KiB)")
+    finally:
+        _zips_en_construccion.discard(destino)
+
+async def preparar_zips():
+    for curso in list(catalogo_fichas().cursos.values()):
+        for semana in sorted(semanas_con_fichas(curso)):
+            try:
+                await preparar_zip_semana(curso, semana)
+            except Exception as e:
+                print(f"⚠️ No se pudo generar el zip de la semana {semana} de {curso.nombre}: {e!r}")
+
+def _caption_ficha(semana: int, asign_key: str) -> str:
+    return f"📄 Semana {semana} · {nombre_asignatura(asign_key)}"
+
+def _caption_ficha_completa(curso, semana: int, asign_key: str) -> str:
+    return (f"📄 Ficha Pedagógica\nSemana {semana} · {nombre_asignatura(asign_key)}\n"
+            f"{texto_rango_semana_solo_fecha(curso, semana)}\nCurso: {curso.nombre}")
+
+async def _enviar_album(message, semana: int, fichas: list, usar_cache: bool = True):
+    abiertos = []
+    subidos = 0
+    try:
+        medias = []
+        for key, ruta in fichas:
+            file_id = file_id_en_cache(ruta) if usar_cache else None
+            if file_id:
+                medias.append(InputMediaDocument(media=file_id, caption=_caption_ficha(semana, key)))
+            else:
+                f = ruta.open("rb")
+                abiertos.append(f)
+                subidos += ruta.stat().st_size
+                medias.append(InputMediaDocument(media=f, filename=ruta.name, caption=_caption_ficha(semana, key)))
+        t0 = time.perf_counter()
+        enviados = await message.reply_media_group(media=medias)
+        M_SUBIDA_SEG.observar(time.perf_counter() - t0, "album", "archivo" if abiertos else "file_id")
+        M_SUBIDA_BYTES.inc("album", valor=subidos)
+    finally:
+        for f in abiertos:
+            f.close()
+    for (_key, ruta), msg in zip(fichas, enviados):
+        if msg.document and file_id_en_cache(ruta) != msg.document.file_id:
+            recordar_file_id(ruta, msg.document.file_id)
+
+async def enviar_semana_completa(message, curso, semana: int):
+    fichas = fichas_para_enviar(curso, semana)
+    if not fichas:
+        await message.reply_text(f"⚠️ No hay fichas disponibles para la semana {semana}.")
+        return
+    if len(fichas) == 1:
+        key, ruta = fichas[0]
+        await enviar_documento(message, ruta, _caption_ficha(semana, key))
+        return
+
+    if FICHAS_ZIP:
+        destino = ruta_zip_semana(curso, semana, fichas)
+        if destino.exists():
+            caption = (f"📦 Fichas Pedagógicas · Semana {semana}\n{texto_rango_semana_solo_fecha(curso, semana)}\n"
+                       f"Curso: {curso.nombre}")
+            await enviar_documento(message, destino, caption)
+            return
+        lanzar_en_fondo(preparar_zip_semana(curso, semana), f"zip_{curso.codigo}_semana{semana}")  # la próxima vez ya estará
+
+    # Un álbum admite hasta 10 documentos
+    for i in range(0, len(fichas), 10):
+        grupo = fichas[i:i + 10]
+        try:
+            await _enviar_album(message, semana, grupo)
+        except telegram.error.BadRequest as e:
+            print(f"[CACHE] álbum rechazado para la semana {semana} ({e}); se vuelven a subir los archivos")
+            for _key, ruta in grupo:
+                olvidar_file_id(ruta)
+            await _enviar_album(message, semana, grupo, usar_cache=False)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# BÚSQUEDA EN FICHAS (índice BM25 local sobre el texto de los PDF)
+# ──────────────────────────────────────────────────────────────────────────────
+# El texto de cada PDF se extrae una sola vez (en un hilo, fuera del event loop),
+# se divide en pasajes cortos y se guarda un índice invertido en CACHE_DIR.
+# Solo se reprocesan los archivos nuevos o modificados.
+RUTA_INDICE_FICHAS = CACHE_DIR / "indice_fichas.json"
+INDICE_REVISAR_SEG = float(os.getenv("INDICE_REVISAR_SEG", "300"))
+TUTOR_CONTEXTO_TOKENS = int(os.getenv("TUTOR_CONTEXTO_TOKENS", "500"))  # 0 = sin contexto de fichas
+LARGO_PASAJE = 700  # caracteres por pasaje
+BM25_K1, BM25_B = 1.5, 0.75
+
+STOPWORDS_ES = set("""
+a al algo ante antes como con contra cual cuando de del desde donde durante e el ella ellas ellos en entre era es esa
+ese eso esta este esto estos estas fue ha hay la las le les lo los mas me mi muy no nos o otra otro para pero por que
+se sea segun ser si sin sobre son su sus tambien te tiene todo tu un una uno unos unas y ya
+""".split())
+
+def _plegar(c: str) -> str:
+    """Un carácter → su versión en minúscula y sin tilde (conserva la longitud del texto)."""
+    base = unicodedata.normalize("NFKD", c.lower())
+    return base[0] if base else c
+
+def terminos(texto: str) -> list:
+    salida = []
+    for palabra in normalizar_texto(texto).split():
+        if palabra in STOPWORDS_ES or len(palabra) < 2:
+            continue
+        if len(palabra) > 5 and palabra.endswith("es"):
+            palabra = palabra[:-2]
+        elif len(palabra) > 4 and palabra.endswith("s"):
+            palabra = palabra[:-1]
+        salida.append(palabra)
+    return salida
+
+def _pasajes(texto: str) -> list:
+    texto = " ".join(texto.split())
+    pasajes = []
+    while texto:
+        if len(texto) <= LARGO_PASAJE:
+            pasajes.append(texto)
+            break
+        corte = texto.rfind(". ", 0, LARGO_PASAJE)
+        if corte < LARGO_PASAJE // 2:
+            corte = texto.rfind(" ", 0, LARGO_PASAJE)
+        corte = corte + 1 if corte > 0 else LARGO_PASAJE
+        pasajes.append(texto[:corte].strip())
+        texto = texto[corte:].strip()
+    return pasajes
+
+def _extraer_texto_pdf(ruta: Path) -> list:
+    """Texto de cada página del PDF (requiere pypdf)."""
+    from pypdf import PdfReader
+    return [(pagina.extract_text() or "") for pagina in PdfReader(str(ruta)).pages]
+
+VERSION_INDICE = 2  # cambia si cambia el formato guardado; los índices de otra versión se reconstruyen
+
+class IndiceFichas:
+    def __init__(self):
+        self.archivos = {}   # clave de archivo → {"firma", "semana", "asign", "cursos", "docs": [doc_id]}
+        self.docs = {}       # doc_id → {"archivo", "semana", "asign", "pagina", "texto", "largo"}
+        self.postings = {}   # término → {doc_id: frecuencia}
+        self.largo_total = 0
+        self.firma = ""      # identifica el contenido indexado (la usa la caché de respuestas)
+
+    def _calcular_firma(self):
+        self.firma = hashlib.sha1(json.dumps(sorted((c, a["firma"]) for c, a in self.archivos.items()))
+                                  .encode()).hexdigest()[:16] if self.archivos else ""
+
+    def copia(self) -> "IndiceFichas":
+        nuevo = IndiceFichas()
+        nuevo.archivos = {k: dict(v) for k, v in self.archivos.items()}
+        nuevo.docs = dict(self.docs)
+        nuevo.postings = {t: dict(p) for t, p in self.postings.items()}
+        nuevo.largo_total = self.largo_total
+        nuevo.firma = self.firma
+        return nuevo
+
+    def _agregar_doc(self, doc_id: str, doc: dict):
+        tf = {}
+        for t in terminos(doc["texto"]):
+            tf[t] = tf.get(t, 0) + 1
+        doc["largo"] = sum(tf.values())
+        self.docs[doc_id] = doc
+        self.largo_total += doc["largo"]
+        for t, n in tf.items():
+            self.postings.setdefault(t, {})[doc_id] = n
+
+    def _quitar_archivo(self, clave: str):
+        info = self.archivos.pop(clave, None)
+        if not info:
+            return
+        ids = set(info["docs"])
+        for doc_id in ids:
+            self.largo_total -= self.docs.pop(doc_id, {}).get("largo", 0)
+        for t in list(self.postings):
+            p = self.postings[t]
+            for doc_id in ids & p.keys():
+                del p[doc_id]
+            if not p:
+                del self.postings[t]
+
+    def actualizar(self, fichas: dict) -> bool:
+        """fichas: {(curso, semana, asign): ruta}. Reindexa solo lo que cambió. Devuelve True si hubo cambios.
+        Una ficha común a varios cursos se indexa una sola vez."""
+        cambios = False
+        vigentes = {}  # clave de archivo → (ruta, semana, asign, cursos)
+        for (curso, semana, asign), ruta in fichas.items():
+            clave = _clave_archivo(ruta)
+            vigentes.setdefault(clave, (ruta, semana, asign, set()))[3].add(curso)
+        for clave, (ruta, semana, asign, cursos) in vigentes.items():
+            cursos = sorted(cursos)
+            try:
+                firma = _firma_archivo(ruta)
+            except FileNotFoundError:
+                continue
+            previo = self.archivos.get(clave, {})
+            if previo.get("firma") == firma:
+                if previo.get("cursos") != cursos:
+                    self.archivos[clave] = {**previo, "cursos": cursos}
+                    cambios = True
+                continue
+            self._quitar_archivo(clave)
+            try:
+                paginas = _extraer_texto_pdf(ruta)
+            except Exception as e:
+                print(f"⚠️ No se pudo extraer texto de {ruta.name}: {e!r}")
+                paginas = []
+            ids = []
+            prefijo = hashlib.sha1(clave.encode()).hexdigest()[:8]  # doc_id corto y único por archivo
+            for n_pag, texto_pag in enumerate(paginas, start=1):
+                for n_pas, pasaje in enumerate(_pasajes(texto_pag)):
+                    doc_id = f"{prefijo}:{n_pag}:{n_pas}"
+                    self._agregar_doc(doc_id, {"archivo": clave, "semana": semana, "asign": asign,
+                                               "pagina": n_pag, "texto": pasaje})
+                    ids.append(doc_id)
+            self.archivos[clave] = {"firma": firma, "semana": semana, "asign": asign, "cursos": cursos, "docs": ids}
+            cambios = True
+            print(f"[INDICE] {ruta.name}: {len(ids)} pasajes")
+        for clave in [c for c in self.archivos if c not in vigentes]:
+            self._quitar_archivo(clave)
+            cambios = True
+        self._calcular_firma()
+        return cambios
+
+    def buscar(self, consulta: str, limite: int = 5, curso: str = None) -> list:
+        """Lista de (puntaje, doc_id) ordenada por BM25; con curso, solo sus fichas."""
+        n_docs = len(self.docs)
+        if not n_docs:
+            return []
+        promedio = self.largo_total / n_docs or 1.0
+        puntajes = {}
+        for t in set(terminos(consulta)):
+            p = self.postings.get(t)
+            if not p:
+                continue
+            idf = math.log(1 + (n_docs - len(p) + 0.5) / (len(p) + 0.5))
+            for doc_id, tf in p.items():
+                norma = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.docs[doc_id]["largo"] / promedio)
+                puntajes[doc_id] = puntajes.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norma
+        if curso is not None:
+            puntajes = {d: p for d, p in puntajes.items()
+                        if curso in self.archivos[self.docs[d]["archivo"]]["cursos"]}
+        return sorted(((p, d) for d, p in puntajes.items()), reverse=True)[:limite]
+
+    def fragmento(self, doc_id: str, consulta: str, largo: int = 160) -> str:
+        texto = self.docs[doc_id]["texto"]
+        plegado = "".join(_plegar(c) for c in texto)
+        pos = min((i for i in (plegado.find(normalizar_texto(p)) for p in consulta.split()) if i >= 0), default=0)
+        ini = max(0, pos - largo // 3)
+        frag = texto[ini:ini + largo].strip()
+        return ("…" if ini else "") + frag + ("…" if ini + largo < len(texto) else "")
+
+    # ── persistencia
+    def guardar(self, ruta: Path):
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = ruta.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"version": VERSION_INDICE, "archivos": self.archivos, "docs": self.docs,
+                                   "postings": self.postings}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, ruta)
+
+    @classmethod
+    def cargar(cls, ruta: Path) -> "IndiceFichas":
+        indice = cls()
+        try:
+            datos = json.loads(ruta.read_text(encoding="utf-8"))
+            if datos.get("version") != VERSION_INDICE:
+                print("[INDICE] Índice guardado con un formato anterior; se reconstruirá")
+                return indice
+            indice.archivos, indice.docs, indice.postings = datos["archivos"], datos["docs"], datos["postings"]
+            indice.largo_total = sum(d["largo"] for d in indice.docs.values())
+            indice._calcular_firma()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Índice de fichas ilegible, se reconstruirá: {e!r}")
+            indice = cls()
+        return indice
+
+indice_fichas = IndiceFichas()
+_indice_firma = None
+
+def _reindexar(actual: IndiceFichas, fichas: dict):
+    """Se ejecuta en un hilo: trabaja sobre una copia y la devuelve si hubo cambios."""
+    if actual is None:
+        actual = IndiceFichas.cargar(RUTA_INDICE_FICHAS)
+        nuevo, cambios = actual, True
+    else:
+        nuevo, cambios = actual.copia(), False
+    if nuevo.actualizar(fichas):
+        cambios = True
+        try:
+            nuevo.guardar(RUTA_INDICE_FICHAS)
+        except Exception as e:
+            print(f"⚠️ No se pudo guardar el índice de fichas: {e!r}")
+    return nuevo if cambios else None
+
+async def actualizar_indice_fichas():
+    """Actualiza el índice si cambió el catálogo de fichas. No bloquea el event loop."""
+    global indice_fichas, _indice_firma
+    catalogo = catalogo_fichas()
+    if _catalogo_firma == _indice_firma:
+        return
+    firma = _catalogo_firma
+    t0 = time.perf_counter()
+    nuevo = await asyncio.to_thread(_reindexar, indice_fichas if _indice_firma else None, catalogo.fichas)
+    if nuevo is not None:
+        indice_fichas = nuevo
+        print(f"[INDICE] {len(nuevo.docs)} pasajes de {len(nuevo.archivos)} fichas "
+              f"({time.perf_counter() - t0:.1f}s)")
+    _indice_firma = firma
+
+async def vigilar_indice_fichas():
+    while True:
+        try:
+            await actualizar_indice_fichas()
+        except Exception as e:
+            print(f"⚠️ Error actualizando el índice de fichas: {e!r}")
+        await asyncio.sleep(INDICE_REVISAR_SEG)
+
+_indice_mtime = None
+
+async def recargar_indice_fichas():
+    """Los demás trabajadores no extraen texto de los PDF: releen el índice que guarda el
+    proceso principal cuando cambia el archivo."""
+    global indice_fichas, _indice_mtime
+    try:
+        mtime = RUTA_INDICE_FICHAS.stat().st_mtime_ns
+    except FileNotFoundError:
+        return
+    if mtime == _indice_mtime:
+        return
+    nuevo = await asyncio.to_thread(IndiceFichas.cargar, RUTA_INDICE_FICHAS)
+    indice_fichas, _indice_mtime = nuevo, mtime
+    print(f"[INDICE] Recargado: {len(nuevo.docs)} pasajes de {len(nuevo.archivos)} fichas")
+
+async def seguir_indice_fichas():
+    while True:
+        try:
+            await recargar_indice_fichas()
+        except Exception as e:
+            print(f"⚠️ Error recargando el índice de fichas: {e!r}")
+        await asyncio.sleep(INDICE_REVISAR_SEG)
+
+def contexto_fichas(pregunta: str, curso: str = None) -> str:
+    """Pasajes de las fichas (del curso, si se indica) más relevantes para la pregunta,
+    dentro de TUTOR_CONTEXTO_TOKENS."""
+    if TUTOR_CONTEXTO_TOKENS <= 0:
+        return ""
+    presupuesto = TUTOR_CONTEXTO_TOKENS
+    partes = []
+    for _puntaje, doc_id in indice_fichas.buscar(pregunta, limite=4, curso=curso):
+        doc = indice_fichas.docs[doc_id]
+        bloque = f"[Semana {doc['semana']} · {nombre_asignatura(doc['asign'])}]\n{doc['texto']}"
+        costo = contar_tokens(bloque)
+        if costo > presupuesto:
+            break
+        partes.append(bloque)
+        presupuesto -= costo
+    return "\n\n".join(partes)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# GPT: Planificador de consultas (concurrencia, colas por usuario, límites de tasa)
+# ──────────────────────────────────────────────────────────────────────────────
+TUTOR_TASA_USUARIO = float(os.getenv("TUTOR_TASA_USUARIO", "4"))    # consultas por minuto por estudiante
+TUTOR_RAFAGA_USUARIO = int(os.getenv("TUTOR_RAFAGA_USUARIO", "3"))  # consultas seguidas permitidas
+TUTOR_TASA_GLOBAL = float(os.getenv("TUTOR_TASA_GLOBAL", "120"))    # llamadas por minuto a OpenAI (total)
+TUTOR_REINTENTOS_429 = int(os.getenv("TUTOR_REINTENTOS_429", "3"))
+TUTOR_AVISO_COLA_SEG = float(os.getenv("TUTOR_AVISO_COLA_SEG", "2"))
+
+class CubetaTokens:
+    """Token bucket. reservar() consume un token y devuelve los segundos que hay que
+    esperar para respetar la tasa (los tokens pueden quedar "en deuda", así el orden es FIFO)."""
+
+    def __init__(self, tasa_por_seg: float, capacidad: float):
+        self.tasa = tasa_por_seg
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.ultimo = time.monotonic()
+
+    def reservar(self) -> float:
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+        self.ultimo = ahora
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.tasa
+
+def _segundos_retry_after(error) -> float:
+    respuesta = getattr(error, "response", None)
+    cabeceras = getattr(respuesta, "headers", None) or {}
+    try:
+        if cabeceras.get("retry-after-ms"):
+            return float(cabeceras["retry-after-ms"]) / 1000
+        if cabeceras.get("retry-after"):
+            return float(cabeceras["retry-after"])
+    except ValueError:
+        pass
+    return 0.0
+
+# Consulta del Tutor que se está atendiendo en esta tarea. La fija PlanificadorTutor.consulta
+# y la lee cupo(), que se llama más adentro (ask_gpt, ask_gpt_stream): así la espera por la
+# tasa global y por el tope de llamadas simultáneas también cuenta como tiempo en cola.
+_turno_tutor = contextvars.ContextVar("turno_tutor", default=None)
+
+class PlanificadorTutor:
+    """Se interpone entre los estudiantes y ask_gpt:
+    - una consulta a la vez por usuario (tutor_history se actualiza en orden),
+    - consultas idénticas en curso se comparten en lugar de repetirse,
+    - token bucket por usuario y global, y tope de llamadas simultáneas a OpenAI,
+    - reintentos con espera ante 429 (respeta Retry-After)."""
+
+    def __init__(self):
+        self.cubeta_global = CubetaTokens(TUTOR_TASA_GLOBAL / 60, max(1.0, TUTOR_TASA_GLOBAL / 6))
+        self.cubetas = {}     # user_id → CubetaTokens
+        self.candados = {}    # user_id → asyncio.Lock
+        self.pendientes = {}  # user_id → consultas esperando o en curso
+        self.en_vuelo = {}    # clave → (future, user_id)
+        self.esperas = deque(maxlen=500)  # segundos en cola de las últimas consultas
+        self.en_cola = 0
+        self.activas = 0
+        self.atendidas = 0
+        self.compartidas = 0
+        self.reintentos_429 = 0
+
+    # ── por usuario
+    async def consulta(self, user_id: int, clave, ejecutar, avisar):
+        """Ejecuta `ejecutar()` respetando el orden del usuario.
+        Devuelve (respuesta, origen) con origen "propia", "compartida" (otra consulta idéntica
+        en curso) o "duplicada" (el mismo usuario ya la había enviado)."""
+        previa = self.en_vuelo.get(clave)
+        if previa:
+            fut, propietario = previa
+            self.compartidas += 1
+            respuesta = await asyncio.shield(fut)
+            return respuesta, ("duplicada" if propietario == user_id else "compartida")
+
+        fut = asyncio.get_running_loop().create_future()
+        self.en_vuelo[clave] = (fut, user_id)
+        candado = self.candados.setdefault(user_id, asyncio.Lock())
+        self.pendientes[user_id] = self.pendientes.get(user_id, 0) + 1
+        self.en_cola += 1
+        # Sigue "en cola" hasta que cupo() consigue lugar para llamar a OpenAI
+        turno = {"user_id": user_id, "t0": time.monotonic(), "avisar": avisar, "avisado": False, "en_cola": True}
+        respuesta = None
+        try:
+            if candado.locked():
+                await self._avisar(turno)
+            async with candado:
+                cubeta = self.cubetas.setdefault(
+                    user_id, CubetaTokens(TUTOR_TASA_USUARIO / 60, TUTOR_RAFAGA_USUARIO))
+                espera = cubeta.reservar()
+                if espera > 0:
+                    if espera >= TUTOR_AVISO_COLA_SEG:
+                        await self._avisar(turno)
+                    await asyncio.sleep(espera)
+                marca = _turno_tutor.set(turno)
+                try:
+                    respuesta = await ejecutar()
+                finally:
+                    _turno_tutor.reset(marca)
+                self.atendidas += 1
+            return respuesta, "propia"
+        finally:
+            if turno["en_cola"]:  # terminó sin llegar a llamar a OpenAI
+                self.en_cola -= 1
+            if not fut.done():
+                fut.set_result(respuesta)
+            if self.en_vuelo.get(clave, (None,))[0] is fut:
+                del self.en_vuelo[clave]
+            self.pendientes[user_id] -= 1
+            if not self.pendientes[user_id]:
+                del self.pendientes[user_id]
+                del self.candados[user_id]
+
+    async def _avisar(self, turno: dict):
+        if not turno["avisado"]:
+            turno["avisado"] = True
+            await turno["avisar"]()
+
+    def _salir_de_cola(self, turno: dict):
+        turno["en_cola"] = False
+        self.en_cola -= 1
+        self._registrar_espera(turno["user_id"], time.monotonic() - turno["t0"])
+
+    def _registrar_espera(self, user_id: int, segundos: float):
+        self.esperas.append(segundos)
+        if segundos >= TUTOR_AVISO_COLA_SEG:
+            print(f"[COLA] usuario {user_id} esperó {segundos:.1f}s (en cola: {self.en_cola}, activas: {self.activas})")
+
+    # ── global (cada llamada a OpenAI)
+    @contextlib.asynccontextmanager
+    async def cupo(self):
+        turno = _turno_tutor.get()
+        if turno is not None and not turno["en_cola"]:
+            turno = None  # segunda llamada del mismo turno (p. ej. el resumen al compactar)
+        espera = self.cubeta_global.reservar()
+        if espera > 0:
+            if turno and espera >= TUTOR_AVISO_COLA_SEG:
+                await self._avisar(turno)
+            await asyncio.sleep(espera)
+        await self._adquirir(turno)
+        try:
+            if turno:
+                self._salir_de_cola(turno)
+            self.activas += 1
+            try:
+                yield
+            finally:
+                self.activas -= 1
+        finally:
+            _openai_sem.release()
+
+    async def _adquirir(self, turno):
+        """Toma un lugar de _openai_sem; si tarda más de TUTOR_AVISO_COLA_SEG, avisa al estudiante."""
+        if turno is None or not _openai_sem.locked():
+            await _openai_sem.acquire()
+            return
+        adquirir = asyncio.ensure_future(_openai_sem.acquire())
+        try:
+            listo, _ = await asyncio.wait({adquirir}, timeout=TUTOR_AVISO_COLA_SEG)
+            if not listo:
+                await self._avisar(turno)
+                await adquirir
+        except asyncio.CancelledError:
+            if adquirir.done() and not adquirir.cancelled():
+                _openai_sem.release()
+            else:
+                adquirir.cancel()
+            raise
+
+    async def con_reintentos(self, fabrica):
+        """Llama a `fabrica()` y reintenta ante 429 con espera exponencial o la indicada por Retry-After."""
+        intento = 0
+        while True:
+            try:
+                return await fabrica()
+            except Exception as e:
+                if getattr(e, "status_code", None) != 429 or intento >= TUTOR_REINTENTOS_429:
+                    raise
+                espera = _segundos_retry_after(e) or min(30.0, 2.0 ** intento) * (1 + random.random() / 2)
+                intento += 1
+                self.reintentos_429 += 1
+                print(f"[COLA] OpenAI devolvió 429; reintento {intento}/{TUTOR_REINTENTOS_429} en {espera:.1f}s")
+                await asyncio.sleep(espera)
+
+    def resumen(self) -> str:
+        esperas = sorted(self.esperas)
+        p50 = esperas[len(esperas) // 2] if esperas else 0.0
+        p95 = esperas[int(len(esperas) * 0.95)] if esperas else 0.0
+        return (f"En cola: {self.en_cola}\n"
+                f"Llamadas activas a OpenAI: {self.activas}/{OPENAI_MAX_CONCURRENCIA}\n"
+                f"Atendidas: {self.atendidas}\n"
+                f"Compartidas (deduplicadas): {self.compartidas}\n"
+                f"Reintentos por 429: {self.reintentos_429}\n"
+                f"Espera en cola p50/p95: {p50:.1f}s / {p95:.1f}s")
+
+planificador = PlanificadorTutor()
 
 # ──────────────────────────────────────────────────────────────────────────────
 # GPT: Lógica
 # ──────────────────────────────────────────────────────────────────────────────
+# ── Presupuesto de tokens
+# El prompt siempre tiene la misma forma para que OpenAI reutilice el prefijo en caché:
+#   [SYSTEM_PROMPT] [resumen de turnos antiguos] [turnos recientes] [fragmentos de fichas] [pregunta]
+# SYSTEM_PROMPT no cambia nunca, y el resumen y los turnos solo cambian al compactar,
+# no en cada consulta como ocurría con una ventana deslizante. OpenAI solo cachea prefijos
+# de 1024 tokens o más: SYSTEM_PROMPT (~800) no alcanza solo, el prefijo estable con el
+# resumen y los turnos anteriores sí, siempre que no se compacte en cada consulta.
+# Con el presupuesto por defecto caben varias respuestas largas (max_tokens=900) entre
+# una compactación y la siguiente.
+TUTOR_PRESUPUESTO_TOKENS = int(os.getenv("TUTOR_PRESUPUESTO_TOKENS", "6000"))  # entrada máxima por consulta
+TUTOR_RESUMEN_TOKENS = int(os.getenv("TUTOR_RESUMEN_TOKENS", "250"))
+OPENAI_MODEL_RESUMEN = os.getenv("OPENAI_MODEL_RESUMEN", "gpt-4.1-nano")  # resumir no requiere el modelo principal
+MAX_MENSAJES_HISTORIAL = 40  # tope de seguridad; el límite real lo da el presupuesto
+RESERVA_PREGUNTA_TOKENS = 300
+COMPACTAR_HOLGURA = 1.5  # se compacta al superar el espacio; quedan turnos por espacio / 1.5
+
+_codificador = None
+
+def contar_tokens(texto: str) -> int:
+    """Tokens reales con tiktoken; si no está disponible, una aproximación (~4 caracteres por token)."""
+    global _codificador
+    if _codificador is None:
+        try:
+            import tiktoken
+            try:
+                _codificador = tiktoken.encoding_for_model(OPENAI_MODEL)
+            except KeyError:
+                _codificador = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"⚠️ tiktoken no disponible, se estiman los tokens: {e!r}")
+            _codificador = False
+    if _codificador:
+        return len(_codificador.encode(texto))
+    return len(texto) // 4 + 1
+
+def tokens_mensajes(messages: list) -> int:
+    return sum(contar_tokens(m["content"]) + 4 for m in messages) + 3
+
+def tutor_sin_contexto(user_data: dict) -> bool:
+    return not user_data.get("tutor_history") and not user_data.get("tutor_resumen")
+
+def _mensajes_tutor(texto: str, hist: list, resumen: str = "", curso: str = None, ventana: list = ()) -> tuple:
+    """Devuelve (messages, tokens_sin_presupuesto, tokens_contexto) — lo segundo es lo que
+    habría costado el esquema anterior (SYSTEM_PROMPT + últimos 8 mensajes sin compactar,
+    sin resumen), para registrar el ahorro; `ventana` son los tokens de esos 8 mensajes
+    (tutor_ventana). Lo tercero son los tokens de fragmentos de fichas agregados (o 0)."""
+    base = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if resumen:
+        base.append({"role": "system", "content": "Resumen de la conversación anterior con el estudiante:\n" + resumen})
+    # El contexto de las fichas va al final para no alterar el prefijo del prompt
+    final = []
+    contexto = contexto_fichas(texto, curso)
+    if contexto:
+        final.append({"role": "system", "content":
+                      "Fragmentos de las fichas pedagógicas del curso (úsalos si son pertinentes "
+                      "y menciona la semana):\n\n" + contexto})
+    final.append({"role": "user", "content": texto})
+
+    # Turnos recientes que caben en el presupuesto (pares pregunta/respuesta completos)
+    disponible = TUTOR_PRESUPUESTO_TOKENS - tokens_mensajes(base) - tokens_mensajes(final)
+    inicio = len(hist)
+    while inicio >= 2:
+        costo = tokens_mensajes(hist[inicio - 2:inicio]) - 3
+        if costo > disponible:
+            break
+        disponible -= costo
+        inicio -= 2
+    messages = base + hist[inicio:] + final
+
+    ingenuo = tokens_mensajes([{"role": "system", "content": SYSTEM_PROMPT}] + final) + sum(ventana)
+    return messages, ingenuo, tokens_mensajes(final[:-1]) - 3 if contexto else 0
+
+def _registrar_turno(context: ContextTypes.DEFAULT_TYPE, texto: str, content: str):
+    hist = context.user_data.setdefault("tutor_history", [])
+    hist.append({"role": "user", "content": texto})
+    hist.append({"role": "assistant", "content": content})
+    if len(hist) > MAX_MENSAJES_HISTORIAL:
+        context.user_data["tutor_history"] = hist[-MAX_MENSAJES_HISTORIAL:]
+    # Tokens de los últimos 8 mensajes tal como los habría enviado el esquema anterior
+    # (compactar no los toca); solo sirven para medir el ahorro en _registrar_uso.
+    ventana = context.user_data.get("tutor_ventana", []) + [contar_tokens(texto) + 4, contar_tokens(content) + 4]
+    context.user_data["tutor_ventana"] = ventana[-8:]
+
+def _registrar_uso(messages: list, ingenuo: int, usage):
+    enviados = tokens_mensajes(messages)
+    linea = f"[TOKENS] entrada≈{enviados} (esquema anterior≈{ingenuo}, ahorro={ingenuo - enviados})"
+    if usage is not None:
+        detalles = getattr(usage, "prompt_tokens_details", None)
+        cacheados = getattr(detalles, "cached_tokens", None) or 0
+        M_TUTOR_TOKENS.inc("entrada", valor=usage.prompt_tokens)
+        M_TUTOR_TOKENS.inc("cacheados", valor=cacheados)
+        M_TUTOR_TOKENS.inc("salida", valor=usage.completion_tokens)
+        linea += f" | OpenAI: entrada={usage.prompt_tokens} cacheados={cacheados} salida={usage.completion_tokens}"
+    print(linea)
+
+async def compactar_historial(context: ContextTypes.DEFAULT_TYPE):
+    """Si el historial ya no cabe en el presupuesto, resume los turnos más antiguos
+    en `tutor_resumen` y deja solo los recientes. Se llama después de responder."""
+    hist = context.user_data.get("tutor_history") or []
+    resumen = context.user_data.get("tutor_resumen", "")
+    # Los fragmentos de fichas solo se descuentan si la última consulta los llevó
+    contexto = context.user_data.get("tutor_contexto", 0)
+    fijo = contar_tokens(SYSTEM_PROMPT) + TUTOR_RESUMEN_TOKENS + contexto + RESERVA_PREGUNTA_TOKENS
+    limite = TUTOR_PRESUPUESTO_TOKENS - fijo
+    if len(hist) <= 2 or tokens_mensajes(hist) <= limite:
+        return
+    # Histéresis: se conservan turnos recientes solo hasta limite / COMPACTAR_HOLGURA, así
+    # quedan varias consultas seguidas con el mismo prefijo antes de volver a compactar.
+    disponible = limite / COMPACTAR_HOLGURA
+    corte = len(hist)
+    usado = 0
+    while corte >= 2:
+        costo = tokens_mensajes(hist[corte - 2:corte])
+        if usado + costo > disponible:
+            break
+        usado += costo
+        corte -= 2
+    # Al menos el último turno queda textual: la pregunta siguiente suele referirse a él
+    # ("¿y el paso 3?") aunque una respuesta larga ocupe más de la mitad del espacio.
+    corte = min(max(corte, 2), len(hist) - 2)
+    viejos, recientes = hist[:corte], hist[corte:]
+    antes = tokens_mensajes(hist)
+    try:
+        nuevo_resumen = await _resumir(resumen, viejos)
+    except Exception as e:
+        print(f"⚠️ No se pudo resumir el historial del Tutor: {e!r}")
+        # Sin resumen: al menos se conservan las preguntas anteriores, recortadas
+        preguntas = "; ".join(m["content"][:120] for m in viejos if m["role"] == "user")
+        nuevo_resumen = (resumen + "\nPreguntas previas: " + preguntas).strip()[-TUTOR_RESUMEN_TOKENS * 4:]
+    context.user_data["tutor_history"] = recientes
+    context.user_data["tutor_resumen"] = nuevo_resumen
+    print(f"[TOKENS] historial compactado: {len(viejos)} mensajes → resumen de "
+          f"{contar_tokens(nuevo_resumen)} tokens (antes {antes}, ahora {tokens_mensajes(recientes)})")
+
+async def _resumir(resumen_previo: str, mensajes: list) -> str:
+    transcripcion = "\n".join(
+        f"{'Estudiante' if m['role'] == 'user' else 'Tutor'}: {m['content']}" for m in mensajes
+    )
+    instrucciones = (
+        "Resume en español, en viñetas breves, lo esencial de esta conversación entre un estudiante "
+        "y su tutor de Electromecánica Automotriz: temas consultados, datos del vehículo o del caso, "
+        f"conclusiones y dudas pendientes. Máximo {TUTOR_RESUMEN_TOKENS} tokens."
+    )
+    contenido = (f"Resumen previo:\n{resumen_previo}\n\n" if resumen_previo else "") + "Conversación:\n" + transcripcion
+    client = _openai_client()
+    async with planificador.cupo():
+        t0 = time.perf_counter()
+        resp = await planificador.con_reintentos(lambda: client.chat.completions.create(
+            model=OPENAI_MODEL_RESUMEN,
+            messages=[{"role": "system", "content": instrucciones}, {"role": "user", "content": contenido}],
+            temperature=0.1,
+            max_tokens=TUTOR_RESUMEN_TOKENS,
+        ))
+        M_TUTOR_SEG.observar(time.perf_counter() - t0, "resumen")
+    return resp.choices[0].message.content.strip()
+
 async def ask_gpt(texto: str, context: ContextTypes.DEFAULT_TYPE) -> str:
     hist = context.user_data.setdefault("tutor_history", [])
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    trimmed = hist[-8:] if len(hist) > 8 else hist
-    messages.extend(trimmed)
-    messages.append({"role": "user", "content": texto})
+    messages, ingenuo, context.user_data["tutor_contexto"] = _mensajes_tutor(
+        texto, hist, context.user_data.get("tutor_resumen", ""), codigo_curso(context.user_data),
+        context.user_data.get("tutor_ventana", []))
 
     try:
         client = _openai_client()
-        def _call():
-            return client.chat.completions.create(
+        async with planificador.cupo():
+            t0 = time.perf_counter()
+            resp = await planificador.con_reintentos(lambda: client.chat.completions.create(
                 model=OPENAI_MODEL,
                 messages=messages,
                 temperature=0.25,
                 max_tokens=900,
-            )
-        resp = await asyncio.to_thread(_call)
+            ))
+            M_TUTOR_SEG.observar(time.perf_counter() - t0, "completo")
         content = resp.choices[0].message.content.strip()
-        hist.append({"role": "user", "content": texto})
-        hist.append({"role": "assistant", "content": content})
-        if len(hist) > 20:
-            context.user_data["tutor_history"] = hist[-20:]
+        _registrar_uso(messages, ingenuo, resp.usage)
+        _registrar_turno(context, texto, content)
         return content
     except Exception as e:
+        contar_error("tutor", e)
         return f"⚠️ Ocurrió un error consultando al Tutor: {e}"
 
+async def ask_gpt_stream(texto: str, context: ContextTypes.DEFAULT_TYPE):
+    """Igual que ask_gpt, pero entrega la respuesta en fragmentos a medida que llega.
+    Los errores se propagan al llamador."""
+    hist = context.user_data.setdefault("tutor_history", [])
+    messages, ingenuo, context.user_data["tutor_contexto"] = _mensajes_tutor(
+        texto, hist, context.user_data.get("tutor_resumen", ""), codigo_curso(context.user_data),
+        context.user_data.get("tutor_ventana", []))
+
+    client = _openai_client()
+    # El stream se lee en otra tarea, dentro del cupo de OpenAI, y los fragmentos pasan por
+    # una cola: las ediciones en Telegram (y sus RetryAfter) ocurren fuera del cupo.
+    cola = asyncio.Queue()
+    fin = object()
+    usage = None
+
+    async def leer():
+        nonlocal usage
+        try:
+            async with planificador.cupo():
+                t0 = time.perf_counter()
+                primer_token = None
+                stream = await planificador.con_reintentos(lambda: client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=messages,
+                    temperature=0.25,
+                    max_tokens=900,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                ))
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if primer_token is None:
+                            primer_token = time.perf_counter() - t0
+                            M_TUTOR_PRIMER_TOKEN.observar(primer_token)
+                        cola.put_nowait(chunk.choices[0].delta.content)
+                M_TUTOR_SEG.observar(time.perf_counter() - t0, "stream")
+            cola.put_nowait(fin)
+        except Exception as e:
+            cola.put_nowait(e)
+
+    lector = asyncio.get_running_loop().create_task(leer())
+    partes = []
+    try:
+        while (delta := await cola.get()) is not fin:
+            if isinstance(delta, Exception):
+                raise delta
+            partes.append(delta)
+            yield delta
+    finally:
+        if not lector.done():
+            lector.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await lector
+    _registrar_uso(messages, ingenuo, usage)
+    _registrar_turno(context, texto, "".join(partes).strip())
+
+# ──────────────────────────────────────────────────────────────────────────────
+# GPT: Respuestas en streaming (edición progresiva del mensaje)
+# ──────────────────────────────────────────────────────────────────────────────
+TUTOR_STREAMING = os.getenv("TUTOR_STREAMING", "1") == "1"
+TUTOR_EDIT_INTERVALO = float(os.getenv("TUTOR_EDIT_INTERVALO", "1.5"))  # seg. entre ediciones
+LIMITE_MENSAJE = 4000  # Telegram admite 4096; dejamos margen para el cursor
+CURSOR = " ▌"
+
+def partir_mensaje(texto: str, limite: int = LIMITE_MENSAJE) -> list:
+    """Divide un texto largo en trozos que Telegram acepte, cortando en saltos de línea o espacios."""
+    partes = []
+    while len(texto) > limite:
+        corte = texto.rfind("\n", 0, limite)
+        if corte < limite // 2:
+            corte = texto.rfind(" ", 0, limite)
+        if corte < limite // 2:
+            corte = limite
+        partes.append(texto[:corte].rstrip())
+        texto = texto[corte:].lstrip()
+    partes.append(texto)
+    return partes
+
+async def _editar_mensaje(mensaje, texto: str, forzar: bool = False) -> float:
+    """Edita un mensaje respetando los límites de Telegram.
+    Devuelve los segundos que hay que esperar antes de volver a editar (0 si no hay que esperar)."""
+    while True:
+        try:
+            await mensaje.edit_text(texto, disable_web_page_preview=True)
+            return 0.0
+        except telegram.error.RetryAfter as e:
+            espera = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            if not forzar:
+                return espera
+            await asyncio.sleep(espera)
+        except telegram.error.BadRequest as e:
+            if "not modified" in str(e).lower():
+                return 0.0
+            raise
+
+async def responder_en_streaming(message, texto: str, context: ContextTypes.DEFAULT_TYPE):
+    """Publica un mensaje provisional y lo va completando con la respuesta del Tutor.
+    Devuelve la respuesta completa, o None si hubo un error."""
+    actual = await message.reply_text("✍️ …")
+    buffer = ""
+    completa = None
+    mostrado = "✍️ …"
+    proximo_edit = 0.0
+    try:
+        async for delta in ask_gpt_stream(texto, context):
+            buffer += delta
+            # Si ya no cabe en un mensaje, se cierra el actual y se continúa en uno nuevo
+            while len(buffer) > LIMITE_MENSAJE:
+                parte = partir_mensaje(buffer)[0]
+                buffer = buffer[len(parte):].lstrip()
+                await _editar_mensaje(actual, parte, forzar=True)
+                actual = await message.reply_text(buffer[:LIMITE_MENSAJE] or "…", disable_web_page_preview=True)
+                mostrado = buffer[:LIMITE_MENSAJE] or "…"
+                proximo_edit = time.monotonic() + TUTOR_EDIT_INTERVALO
+            ahora = time.monotonic()
+            if ahora >= proximo_edit and buffer.strip() and buffer + CURSOR != mostrado:
+                espera = await _editar_mensaje(actual, buffer + CURSOR)
+                mostrado = buffer + CURSOR
+                proximo_edit = ahora + max(TUTOR_EDIT_INTERVALO, espera)
+        completa = context.user_data["tutor_history"][-1]["content"]
+    except Exception as e:
+        contar_error("tutor", e)
+        aviso = f"⚠️ Ocurrió un error consultando al Tutor: {e}"
+        buffer = f"{buffer}\n\n{aviso}" if buffer.strip() else aviso
+        if len(buffer) > LIMITE_MENSAJE:
+            buffer = aviso
+
+    await _editar_mensaje(actual, buffer.strip() or "(El Tutor no devolvió texto.)", forzar=True)
+    return completa
+
+# ──────────────────────────────────────────────────────────────────────────────
+# GPT: Caché de respuestas (preguntas repetidas sin contexto previo)
+# ──────────────────────────────────────────────────────────────────────────────
+# Solo se usa para la primera pregunta de una conversación (sin historial ni resumen),
+# porque ahí la respuesta depende solo de la pregunta y de los pasajes de las fichas que
+# se agregan como contexto. Por eso cada entrada guarda la firma del índice de fichas
+# con que se respondió (si las fichas cambian, la entrada deja de servir) y la clave
+# lleva el código del curso: los pasajes de contexto son los de las fichas de ese curso.
+TUTOR_CACHE = os.getenv("TUTOR_CACHE", "1") == "1"
+TUTOR_CACHE_MAX = int(os.getenv("TUTOR_CACHE_MAX", "500"))
+TUTOR_CACHE_TTL_HORAS = float(os.getenv("TUTOR_CACHE_TTL_HORAS", "168"))
+TUTOR_CACHE_SIMILITUD = float(os.getenv("TUTOR_CACHE_SIMILITUD", "0.88"))
+TUTOR_CACHE_GUARDAR_SEG = 5.0  # las respuestas nuevas se escriben en disco en lote, en un hilo
+RUTA_CACHE_RESPUESTAS = CACHE_DIR / "tutor_respuestas.json"
+# Palabras vacías que sí cambian el sentido de una pregunta ("si no carga" ≠ "si carga")
+NEGACIONES = {"no", "sin", "contra", "nunca", "ni"}
+
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+def es_admin(update: Update) -> bool:
+    return bool(update.effective_user) and update.effective_user.id in ADMIN_IDS
+
+def normalizar_texto(texto: str) -> str:
+    """Minúsculas, sin tildes ni signos, espacios simples."""
+    sin_tildes = unicodedata.normalize("NFKD", texto)
+    sin_tildes = "".join(c for c in sin_tildes if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w]+", " ", sin_tildes.lower()).split())
+
+def palabras_clave(normalizado: str) -> frozenset:
+    """Palabras de contenido de una pregunta (términos del buscador más las negaciones)."""
+    return frozenset(terminos(normalizado)) | (NEGACIONES & set(normalizado.split()))
+
+def _clave_cache(pregunta: str, curso: str = None) -> str:
+    """"<curso>|<pregunta normalizada>"; normalizar_texto nunca deja un "|"."""
+    normalizado = normalizar_texto(pregunta)
+    return f"{curso or ''}|{normalizado}" if normalizado else ""
+
+def _texto_clave(clave: str) -> str:
+    return clave.rpartition("|")[2]
+
+def _trigramas(normalizado: str) -> dict:
+    t = f"  {normalizado} "
+    conteo = {}
+    for i in range(len(t) - 2):
+        g = t[i:i + 3]
+        conteo[g] = conteo.get(g, 0) + 1
+    return conteo
+
+class CacheRespuestas:
+    """LRU + TTL de respuestas del Tutor, con búsqueda de preguntas casi iguales
+    por similitud coseno TF-IDF sobre trigramas de caracteres (sin servicios externos).
+    Una pregunta parecida solo se acepta si además tiene exactamente las mismas palabras
+    de contenido: "dos tiempos" y "cuatro tiempos" se parecen mucho en trigramas."""
+
+    def __init__(self, ruta: Path, maximo: int, ttl_seg: float, umbral: float):
+        self.ruta = ruta
+        self.maximo = maximo
+        self.ttl_seg = ttl_seg
+        self.umbral = umbral
+        self.entradas = OrderedDict()  # "<curso>|<pregunta normalizada>" → entrada (más reciente al final)
+        self.trigramas = {}            # clave → {trigrama: conteo}
+        self.indice = {}               # trigrama → set(claves)
+        self.aciertos_exactos = 0
+        self.aciertos_similares = 0
+        self.fallos = 0
+        self.sincronizado = 0.0        # time.time() de la última lectura/escritura del archivo
+        self.pendiente = False         # hay respuestas nuevas sin escribir en disco
+        self._guardado = None          # tarea que escribe el lote pendiente
+        self._escribiendo = threading.Lock()  # el hilo de un lote cancelado puede seguir escribiendo
+
+    # ── índice de similitud
+    def _indexar(self, clave: str):
+        tg = _trigramas(_texto_clave(clave))
+        self.trigramas[clave] = tg
+        for g in tg:
+            self.indice.setdefault(g, set()).add(clave)
+
+    def _desindexar(self, clave: str):
+        for g in self.trigramas.pop(clave, {}):
+            claves = self.indice.get(g)
+            if claves:
+                claves.discard(clave)
+                if not claves:
+                    del self.indice[g]
+
+    def _idf(self, g: str) -> float:
+        return math.log((len(self.entradas) + 1) / (len(self.indice.get(g, ())) + 1)) + 1.0
+
+    def _vector(self, tg: dict) -> dict:
+        return {g: n * self._idf(g) for g, n in tg.items()}
+
+    def _mas_parecida(self, clave: str):
+        """Solo entre las preguntas del mismo curso."""
+        curso = clave.rpartition("|")[0]
+        consulta = self._vector(_trigramas(_texto_clave(clave)))
+        norma_c = math.sqrt(sum(v * v for v in consulta.values()))
+        candidatas = set()
+        for g in consulta:
+            candidatas |= self.indice.get(g, set())
+        candidatas = {c for c in candidatas if c.rpartition("|")[0] == curso}
+        mejor, mejor_sim = None, 0.0
+        for cand in candidatas:
+            vec = self._vector(self.trigramas[cand])
+            norma = math.sqrt(sum(v * v for v in vec.values()))
+            producto = sum(peso * vec.get(g, 0.0) for g, peso in consulta.items())
+            sim = producto / (norma_c * norma) if norma_c and norma else 0.0
+            if sim > mejor_sim:
+                mejor, mejor_sim = cand, sim
+        return mejor, mejor_sim
+
+    # ── operaciones
+    def _vigente(self, entrada: dict) -> bool:
+        return entrada.get("modelo") == OPENAI_MODEL and time.time() - entrada["creado"] < self.ttl_seg
+
+    def _mismas_fichas(self, entrada: dict) -> bool:
+        # No se valida al cargar del disco: el índice todavía no está cargado en ese momento
+        return entrada.get("fichas") == indice_fichas.firma
+
+    def _quitar(self, clave: str):
+        self.entradas.pop(clave, None)
+        self._desindexar(clave)
+
+    def buscar(self, pregunta: str, curso: str = None):
+        clave = _clave_cache(pregunta, curso)
+        if not clave:
+            return None
+        entrada = self.entradas.get(clave)
+        if entrada and not self._vigente(entrada):
+            self._quitar(clave)
+            entrada = None
+        if entrada and not self._mismas_fichas(entrada):
+            entrada = None  # se reemplaza al guardar la respuesta nueva
+        if entrada:
+            self.aciertos_exactos += 1
+        elif len(_texto_clave(clave)) >= 12 and self.entradas:
+            similar, sim = self._mas_parecida(clave)
+            if (similar and sim >= self.umbral
+                    and palabras_clave(_texto_clave(similar)) == palabras_clave(_texto_clave(clave))
+                    and self._vigente(self.entradas[similar]) and self._mismas_fichas(self.entradas[similar])):
+                clave, entrada = similar, self.entradas[similar]
+                self.aciertos_similares += 1
+        if not entrada:
+            self.fallos += 1
+            return None
+        self.entradas.move_to_end(clave)
+        return entrada["respuesta"]
+
+    def guardar_respuesta(self, pregunta: str, respuesta: str, curso: str = None):
+        clave = _clave_cache(pregunta, curso)
+        if not clave or not respuesta:
+            return
+        self._quitar(clave)
+        self.entradas[clave] = {"pregunta": pregunta, "respuesta": respuesta,
+                                "modelo": OPENAI_MODEL, "fichas": indice_fichas.firma, "creado": time.time()}
+        self._indexar(clave)
+        while len(self.entradas) > self.maximo:
+            self._quitar(next(iter(self.entradas)))
+        self.pendiente = True
+        if self._guardado is None or self._guardado.done():
+            self._guardado = lanzar_en_fondo(self._guardar_en_lote(), "cache_respuestas")
+
+    def purgar(self, filtro: str = "") -> int:
+        filtro = normalizar_texto(filtro)
+        claves = [c for c in self.entradas if filtro in _texto_clave(c)] if filtro else list(self.entradas)
+        for clave in claves:
+            self._quitar(clave)
+        self.guardar()
+        return len(claves)
+
+    def resumen(self) -> str:
+        consultas = self.aciertos_exactos + self.aciertos_similares + self.fallos
+        tasa = (self.aciertos_exactos + self.aciertos_similares) / consultas * 100 if consultas else 0.0
+        return (f"Entradas: {len(self.entradas)}/{self.maximo}\n"
+                f"Aciertos exactos: {self.aciertos_exactos}\n"
+                f"Aciertos similares: {self.aciertos_similares}\n"
+                f"Fallos: {self.fallos}\n"
+                f"Tasa de aciertos: {tasa:.1f}%")
+
+    # ── persistencia
+    def _leer_disco(self) -> list:
+        try:
+            return json.loads(self.ruta.read_text(encoding="utf-8")).get("entradas", [])
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            print(f"⚠️ Caché de respuestas ilegible, se ignora: {e!r}")
+            return []
+
+    def _agregar(self, entradas: list):
+        for clave, entrada in entradas:
+            # Las claves sin "|" son de antes de separar por curso: no se sabe con qué fichas se respondió
+            if clave not in self.entradas and "|" in clave and self._vigente(entrada):
+                self.entradas[clave] = entrada
+                self._indexar(clave)
+        while len(self.entradas) > self.maximo:
+            self._quitar(next(iter(self.entradas)))
+
+    def cargar(self):
+        self.sincronizado = time.time()
+        self._agregar(self._leer_disco())
+        if self.entradas:
+            print(f"[CACHE] {len(self.entradas)} respuestas del Tutor cargadas de {self.ruta}")
+
+    def _nuevas_en_disco(self) -> list:
+        """Con varios procesos trabajadores: las respuestas que otro guardó desde nuestra
+        última lectura (las más antiguas que faltan se quitaron a propósito)."""
+        if self.ruta.exists() and self.ruta.stat().st_mtime > self.sincronizado:
+            return [(c, e) for c, e in self._leer_disco() if e.get("creado", 0) > self.sincronizado]
+        return []
+
+    def _escribir(self, entradas: list):
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = self.ruta.with_suffix(f".{os.getpid()}.tmp")
+        with self._escribiendo:
+            tmp.write_text(json.dumps({"entradas": entradas}, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.ruta)
+            self.sincronizado = time.time()
+
+    async def _guardar_en_lote(self):
+        """Espera TUTOR_CACHE_GUARDAR_SEG para juntar respuestas y escribe el archivo en un hilo.
+        El diccionario solo se toca en el event loop; el hilo recibe una copia."""
+        while self.pendiente:  # lo que llegue mientras se escribe va en el lote siguiente
+            await asyncio.sleep(TUTOR_CACHE_GUARDAR_SEG)
+            self.pendiente = False
+            try:
+                self._agregar(await asyncio.to_thread(self._nuevas_en_disco))
+                await asyncio.to_thread(self._escribir, list(self.entradas.items()))
+            except asyncio.CancelledError:
+                self.pendiente = True  # cierre a mitad del lote: lo escribe guardar() en post_shutdown
+                raise
+            except Exception as e:
+                self.pendiente = True
+                print(f"⚠️ No se pudo guardar la caché de respuestas: {e!r}")
+
+    def guardar(self):
+        """Escritura inmediata (purga desde /cache y cierre del proceso)."""
+        try:
+            self._agregar(self._nuevas_en_disco())
+            self._escribir(list(self.entradas.items()))
+            self.pendiente = False
+        except Exception as e:
+            print(f"⚠️ No se pudo guardar la caché de respuestas: {e!r}")
+
+cache_respuestas = CacheRespuestas(RUTA_CACHE_RESPUESTAS, TUTOR_CACHE_MAX,
+                                   TUTOR_CACHE_TTL_HORAS * 3600, TUTOR_CACHE_SIMILITUD)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# PERSISTENCIA (estado de usuarios y chats en SQLite)
+# ──────────────────────────────────────────────────────────────────────────────
+# - Cada usuario se carga de la base la primera vez que escribe (no todos al arrancar).
+# - Los cambios se escriben en lote cada PERSISTENCIA_INTERVALO segundos, en un hilo.
+# - Las conversaciones sin actividad por PERSISTENCIA_INACTIVIDAD_DIAS se eliminan.
+PERSISTENCIA = os.getenv("PERSISTENCIA", "1") == "1"
+RUTA_ESTADO_DB = Path(os.getenv("PERSISTENCIA_DB", str(CACHE_DIR / "estado.sqlite3")))
+PERSISTENCIA_INTERVALO = float(os.getenv("PERSISTENCIA_INTERVALO", "30"))
+PERSISTENCIA_INACTIVIDAD_DIAS = float(os.getenv("PERSISTENCIA_INACTIVIDAD_DIAS", "30"))
+
+def _empaquetar(datos: dict) -> bytes:
+    crudo = json.dumps(datos, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(crudo) > 256:
+        return b"z" + zlib.compress(crudo, 6)
+    return b"j" + crudo
+
+def _desempaquetar(blob: bytes) -> dict:
+    if blob[:1] == b"z":
+        return json.loads(zlib.decompress(blob[1:]))
+    return json.loads(blob[1:])
+
+def abrir_sqlite(ruta: Path) -> sqlite3.Connection:
+    ruta.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(ruta), timeout=30, check_same_thread=False, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    return con
+
+class PersistenciaSQLite(BasePersistence):
+    """Persistencia de user_data y chat_data. bot_data, callback_data y conversaciones no se usan."""
+
+    def __init__(self, ruta: Path, update_interval: float = 30):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.ruta = ruta
+        self._lectura = None    # conexión del event loop (lecturas puntuales)
+        self._escritura = None  # conexión usada desde el hilo de escritura
+        self._cargados = set()  # (tipo, id) ya leídos de la base
+        self._pendientes = {}   # (tipo, id) → dict a guardar, o None para borrar
+        self._vaciado = None
+        self._candado_escritura = threading.Lock()
+        self.escrituras = 0
+        self.lotes = 0
+
+    def _conexion(self) -> sqlite3.Connection:
+        if self._lectura is None:
+            self._lectura = abrir_sqlite(self.ruta)
+            self._lectura.execute(
+                "CREATE TABLE IF NOT EXISTS estado ("
+                " tipo TEXT NOT NULL, id INTEGER NOT NULL, datos BLOB NOT NULL, actualizado REAL NOT NULL,"
+                " PRIMARY KEY (tipo, id)) WITHOUT ROWID"
+            )
+            self._lectura.execute("CREATE INDEX IF NOT EXISTS estado_actualizado ON estado (actualizado)")
+            self._escritura = abrir_sqlite(self.ruta)
+        return self._lectura
+
+    # ── carga perezosa
+    async def get_user_data(self) -> dict:
+        self._conexion()
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    def _cargar(self, tipo: str, id_: int, destino: dict):
+        clave = (tipo, id_)
+        if clave in self._cargados:
+            return
+        self._cargados.add(clave)
+        fila = self._conexion().execute(
+            "SELECT datos FROM estado WHERE tipo = ? AND id = ?", clave).fetchone()
+        if fila:
+            for k, v in _desempaquetar(fila[0]).items():
+                destino.setdefault(k, v)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._cargar("u", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        self._cargar("c", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    # ── escritura en lote
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._encolar(("u", user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._encolar(("c", chat_id), data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._encolar(("u", user_id), None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._encolar(("c", chat_id), None)
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    def _encolar(self, clave: tuple, datos):
+        # Application llama a update_*_data para todos los usuarios modificados a la vez;
+        # la tarea de vaciado arranca después y los escribe en una sola transacción.
+        self._pendientes[clave] = datos
+        if self._vaciado is None or self._vaciado.done():
+            self._vaciado = asyncio.get_running_loop().create_task(self._vaciar())
+
+    async def _vaciar(self):
+        lote, self._pendientes = self._pendientes, {}
+        if lote:
+            await asyncio.to_thread(self._escribir, lote)
+
+    def _escribir(self, lote: dict):
+        ahora = time.time()
+        guardar = [(t, i, _empaquetar(d), ahora) for (t, i), d in lote.items() if d is not None]
+        borrar = [clave for clave, d in lote.items() if d is None]
+        with self._candado_escritura:
+            con = self._escritura
+            con.execute("BEGIN")
+            try:
+                con.executemany("INSERT OR REPLACE INTO estado (tipo, id, datos, actualizado) VALUES (?, ?, ?, ?)", guardar)
+                con.executemany("DELETE FROM estado WHERE tipo = ? AND id = ?", borrar)
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+        self.escrituras += len(lote)
+        self.lotes += 1
+
+    async def flush(self) -> None:
+        if self._vaciado is not None:
+            await self._vaciado
+        await self._vaciar()
+        for con in (self._lectura, self._escritura):
+            if con is not None:
+                con.close()
+        self._lectura = self._escritura = None
+
+    # ── limpieza
+    def podar(self, inactividad_seg: float) -> list:
+        """Borra las conversaciones sin cambios desde hace `inactividad_seg`. Devuelve [(tipo, id)].
+        Se ejecuta en un hilo, con la conexión de escritura."""
+        limite = time.time() - inactividad_seg
+        with self._candado_escritura:
+            con = self._escritura
+            viejos = con.execute("SELECT tipo, id FROM estado WHERE actualizado < ?", (limite,)).fetchall()
+            con.execute("DELETE FROM estado WHERE actualizado < ?", (limite,))
+        return [tuple(c) for c in viejos]
+
+    def olvidar(self, claves: list):
+        self._cargados.difference_update(claves)
+
+async def podar_estado(app: Application):
+    """Tarea de fondo: elimina de la base y de la memoria las conversaciones inactivas."""
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            viejos = await asyncio.to_thread(app.persistence.podar, PERSISTENCIA_INACTIVIDAD_DIAS * 86400)
+            app.persistence.olvidar(viejos)
+            for tipo, id_ in viejos:
+                (app.drop_user_data if tipo == "u" else app.drop_chat_data)(id_)
+            if viejos:
+                print(f"[ESTADO] {len(viejos)} conversaciones inactivas eliminadas")
+        except Exception as e:
+            print(f"⚠️ Error podando el estado: {e!r}")
+
+# ──────────────────────────────────────────────────────────────────────────────
+# COMUNICADOS (lectura en caché, suscriptores y difusión)
+# ──────────────────────────────────────────────────────────────────────────────
+# comunicados.txt se vuelve a leer solo si cambió su mtime. Cada línea "Semana N: ..."
+# es un comunicado; las líneas siguientes sin "Semana" se agregan al anterior.
+# Los chats que usan /start quedan suscritos y reciben los comunicados nuevos.
+COMUNICADOS_DIFUSION = os.getenv("COMUNICADOS_DIFUSION", "1") == "1"
+COMUNICADOS_REVISAR_SEG = float(os.getenv("COMUNICADOS_REVISAR_SEG", "60"))
+DIFUSION_MSG_POR_SEG = float(os.getenv("DIFUSION_MSG_POR_SEG", "25"))  # Telegram: ~30 msg/s en total
+DIFUSION_SEG_POR_CHAT = 1.0   # Telegram: ~1 msg/s por chat
+DIFUSION_TRABAJADORES = 8
+DIFUSION_MAX_INTENTOS = 3
+
+_PATRON_COMUNICADO = re.compile(r"^\W*Semana\s+(\d+)", re.IGNORECASE)
+_comunicados = {"firma": None, "texto": "", "entradas": []}
+
+def comunicados_actuales() -> dict:
+    """{"texto": contenido completo, "entradas": [{"id", "semana", "texto", "hash"}]} con caché por mtime.
+    El id es la semana del encabezado y el orden dentro de esa semana ("semana-9-1"), no el
+    texto: corregir una errata no vuelve a difundir el comunicado. "hash" es el id anterior
+    (sha1 del texto), que solo sirve para reconocer lo que ya se había visto."""
+    try:
+        st = RUTA_COMUNICADOS.stat()
+    except FileNotFoundError:
+        return {"firma": None, "texto": "", "entradas": []}
+    firma = (st.st_size, st.st_mtime_ns)
+    if _comunicados["firma"] == firma:
+        return _comunicados
+    texto = RUTA_COMUNICADOS.read_text(encoding="utf-8").strip()
+    entradas = []
+    for linea in texto.splitlines():
+        if not linea.strip():
+            continue
+        m = _PATRON_COMUNICADO.match(linea)
+        if m or not entradas:
+            entradas.append({"semana": int(m.group(1)) if m else None, "texto": linea.strip()})
+        else:
+            entradas[-1]["texto"] += "\n" + linea.strip()
+    orden = {}
+    for e in entradas:
+        orden[e["semana"]] = orden.get(e["semana"], 0) + 1
+        e["id"] = f"semana-{e['semana'] if e['semana'] is not None else 'general'}-{orden[e['semana']]}"
+        e["hash"] = hashlib.sha1(e["texto"].encode("utf-8")).hexdigest()[:16]
+    _comunicados.update(firma=firma, texto=texto, entradas=entradas)
+    return _comunicados
+
+def _es_chat_inalcanzable(error) -> bool:
+    if isinstance(error, telegram.error.Forbidden):
+        return True  # bloqueó el bot / cuenta eliminada
+    return isinstance(error, telegram.error.BadRequest) and "chat not found" in str(error).lower()
+
+class Difusor:
+    """Registro de suscriptores y envío de comunicados con progreso guardado en SQLite
+    (si el proceso se reinicia a mitad de un envío, continúa donde quedó)."""
+
+    def __init__(self, ruta_db: Path):
+        self.ruta_db = ruta_db
+        self._con = None
+        self.cubeta = CubetaTokens(DIFUSION_MSG_POR_SEG, 1)  # sin ráfagas: ritmo parejo
+        self._ultimo_envio = {}  # chat_id → monotonic del último mensaje
+        self._pausa_hasta = 0.0  # tras un RetryAfter se detienen todos los envíos
+        self._en_curso = False
+        self.progreso = {}
+
+    def _conexion(self) -> sqlite3.Connection:
+        if self._con is None:
+            self._con = abrir_sqlite(self.ruta_db)
+            self._con.executescript(
+                "CREATE TABLE IF NOT EXISTS suscriptores (chat_id INTEGER PRIMARY KEY, alta REAL NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS comunicados_vistos (id TEXT PRIMARY KEY, visto REAL NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS difusion_meta (clave TEXT PRIMARY KEY, valor TEXT NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS difusion ("
+                " comunicado TEXT NOT NULL, chat_id INTEGER NOT NULL, estado TEXT NOT NULL DEFAULT 'pendiente',"
+                " intentos INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (comunicado, chat_id)) WITHOUT ROWID;"
+                "CREATE INDEX IF NOT EXISTS difusion_estado ON difusion (estado);"
+            )
+        return self._con
+
+    def suscribir(self, chat_id: int):
+        self._conexion().execute("INSERT OR IGNORE INTO suscriptores (chat_id, alta) VALUES (?, ?)",
+                                 (chat_id, time.time()))
+
+    def desuscribir(self, chat_id: int):
+        con = self._conexion()
+        con.execute("DELETE FROM suscriptores WHERE chat_id = ?", (chat_id,))
+        con.execute("UPDATE difusion SET estado = 'inalcanzable' WHERE chat_id = ? AND estado = 'pendiente'",
+                    (chat_id,))
+
+    def total_suscriptores(self) -> int:
+        return self._conexion().execute("SELECT COUNT(*) FROM suscriptores").fetchone()[0]
+
+    def detectar_nuevos(self) -> list:
+        """Encola para todos los suscriptores los comunicados que aún no se habían visto.
+        La primera vez solo marca los existentes como vistos (no reenvía el historial).
+        Esa primera vez queda registrada en difusion_meta aunque comunicados.txt esté vacío:
+        así el primer comunicado que se agregue después sí se difunde."""
+        con = self._conexion()
+        entradas = comunicados_actuales()["entradas"]
+        con.execute("BEGIN")
+        try:
+            vistos = {fila[0] for fila in con.execute("SELECT id FROM comunicados_vistos")}
+            inicializado = con.execute("SELECT 1 FROM difusion_meta WHERE clave = 'inicializado'").fetchone()
+            # Bases anteriores a difusion_meta: si ya hay comunicados vistos, ya se inicializó
+            primera_vez = inicializado is None and not vistos
+            nuevos = []
+            for e in entradas:
+                if e["id"] in vistos:
+                    continue
+                con.execute("INSERT INTO comunicados_vistos (id, visto) VALUES (?, ?)", (e["id"], time.time()))
+                if e["hash"] in vistos:
+                    continue  # visto con el id anterior (sha1 del texto): solo se registra el id nuevo
+                nuevos.append(e)
+                if not primera_vez:
+                    con.execute("INSERT OR IGNORE INTO difusion (comunicado, chat_id) "
+                                "SELECT ?, chat_id FROM suscriptores", (e["id"],))
+            con.execute("INSERT OR IGNORE INTO difusion_meta (clave, valor) VALUES ('inicializado', '1')")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return [] if primera_vez else nuevos
+
+    def comunicados_pendientes(self) -> list:
+        """Ids de los comunicados con envíos pendientes."""
+        return [fila[0] for fila in self._conexion().execute(
+            "SELECT DISTINCT comunicado FROM difusion WHERE estado = 'pendiente' ORDER BY comunicado")]
+
+    def pendientes(self) -> list:
+        return self._conexion().execute(
+            "SELECT comunicado, chat_id FROM difusion WHERE estado = 'pendiente' ORDER BY comunicado, chat_id"
+        ).fetchall()
+
+    def _marcar(self, comunicado: str, chat_id: int, estado: str, intentos: int = 0):
+        self._conexion().execute(
+            "UPDATE difusion SET estado = ?, intentos = intentos + ? WHERE comunicado = ? AND chat_id = ?",
+            (estado, intentos, comunicado, chat_id))
+
+    async def _enviar_uno(self, bot, comunicado: str, chat_id: int, texto: str):
+        intentos = 0
+        while True:
+            pausa = self._pausa_hasta - time.monotonic()
+            if pausa > 0:
+                await asyncio.sleep(pausa)
+            espera = self.cubeta.reservar()
+            ultimo = self._ultimo_envio.get(chat_id)
+            if ultimo is not None:
+                espera = max(espera, ultimo + DIFUSION_SEG_POR_CHAT - time.monotonic())
+            if espera > 0:
+                await asyncio.sleep(espera)
+            self._ultimo_envio[chat_id] = time.monotonic()
+            try:
+                await bot.send_message(chat_id, texto, disable_web_page_preview=True)
+                self._marcar(comunicado, chat_id, "enviado")
+                self.progreso["enviados"] += 1
+                return
+            except telegram.error.RetryAfter as e:
+                espera = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self.progreso["retry_after"] += 1
+                self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + espera)
+            except Exception as e:
+                if _es_chat_inalcanzable(e):
+                    self.desuscribir(chat_id)
+                    self.progreso["bloqueados"] += 1
+                    return
+                intentos += 1
+                if intentos >= DIFUSION_MAX_INTENTOS:
+                    print(f"⚠️ Comunicado no entregado a {chat_id}: {e!r}")
+                    self._marcar(comunicado, chat_id, "fallido", intentos)
+                    self.progreso["fallidos"] += 1
+                    return
+                await asyncio.sleep(2 ** intentos)
+
+    async def difundir(self, bot) -> dict:
+        """Detecta comunicados nuevos y envía todo lo pendiente. Devuelve el progreso."""
+        if self._en_curso:
+            return self.progreso
+        self._en_curso = True
+        try:
+            nuevos = self.detectar_nuevos()
+            trabajo = self.pendientes()
+            if not trabajo:
+                return {}
+            textos = {}
+            for e in comunicados_actuales()["entradas"]:
+                # Los pendientes de antes del cambio de id están guardados con el sha1 del texto
+                textos[e["id"]] = textos[e["hash"]] = "📢 Nuevo comunicado:\n\n" + e["texto"]
+            self.progreso = {"total": len(trabajo), "enviados": 0, "bloqueados": 0, "fallidos": 0,
+                             "retry_after": 0, "inicio": time.monotonic(), "fin": None}
+            print(f"[DIFUSION] {len(nuevos)} comunicados nuevos; {len(trabajo)} mensajes por enviar")
+            cola = asyncio.Queue()
+            for comunicado, chat_id in trabajo:
+                if comunicado in textos:
+                    cola.put_nowait((comunicado, chat_id))
+                else:  # el comunicado se borró del archivo antes de terminar
+                    self._marcar(comunicado, chat_id, "descartado")
+
+            async def trabajador():
+                while not cola.empty():
+                    comunicado, chat_id = cola.get_nowait()
+                    await self._enviar_uno(bot, comunicado, chat_id, textos[comunicado])
+
+            await asyncio.gather(*(trabajador() for _ in range(DIFUSION_TRABAJADORES)))
+            self.progreso["fin"] = time.monotonic()
+            print("[DIFUSION] " + self.resumen().replace("\n", " · "))
+            return self.progreso
+        finally:
+            self._en_curso = False
+
+    def resumen(self) -> str:
+        p = self.progreso
+        if not p:
+            return f"Suscriptores: {self.total_suscriptores()}\nSin envíos en esta sesión."
+        duracion = (p["fin"] or time.monotonic()) - p["inicio"]
+        hechos = p["enviados"] + p["bloqueados"] + p["fallidos"]
+        return (f"Suscriptores: {self.total_suscriptores()}\n"
+                f"{'Terminado' if p['fin'] else 'En curso'}: {hechos}/{p['total']} en {duracion:.1f}s "
+                f"({p['enviados'] / duracion if duracion else 0:.1f} msg/s)\n"
+                f"Enviados: {p['enviados']} · Bloqueados: {p['bloqueados']} · Fallidos: {p['fallidos']} · "
+                f"RetryAfter: {p['retry_after']}")
+
+difusor = Difusor(RUTA_ESTADO_DB)
+
+async def vigilar_comunicados(app: Application):
+    while True:
+        try:
+            await difusor.difundir(app.bot)
+        except Exception as e:
+            print(f"⚠️ Error difundiendo comunicados: {e!r}")
+        await asyncio.sleep(COMUNICADOS_REVISAR_SEG)
+
 # ──────────────────────────────────────────────────────────────────────────────
 # HANDLERS
 # ──────────────────────────────────────────────────────────────────────────────
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        difusor.suscribir(update.effective_chat.id)
+    except Exception as e:
+        print(f"⚠️ No se pudo registrar el suscriptor: {e!r}")
     await update.message.reply_text(
         "👋 Bienvenido al Asistente Virtual del curso. Elige una opción:",
         reply_markup=kb_menu_principal()
@@ -280,12 +2519,91 @@ async def tutor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(msg, reply_markup=kb_tutor_menu(), parse_mode="Markdown")
 
+async def curso_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/curso → elegir o cambiar el curso cuyas fichas se muestran."""
+    curso = curso_de(context.user_data)
+    texto = f"Tu curso: {curso.nombre}\nPuedes cambiarlo aquí:" if curso else "Selecciona tu curso:"
+    await update.message.reply_text(texto, reply_markup=kb_cursos())
+
+async def buscar_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/buscar <términos> → semanas y asignaturas donde aparece el tema."""
+    consulta = " ".join(context.args).strip()
+    if not consulta:
+        await update.message.reply_text("Uso: /buscar <términos>\nEjemplo: /buscar alternador")
+        return
+    curso = curso_de(context.user_data)
+    if curso is None:
+        await update.message.reply_text("Primero elige tu curso:", reply_markup=kb_cursos())
+        return
+    if not indice_fichas.docs:
+        await update.message.reply_text("⏳ El buscador se está preparando. Intenta de nuevo en un momento.")
+        return
+    mejores = {}
+    for puntaje, doc_id in indice_fichas.buscar(consulta, limite=40, curso=curso.codigo):
+        doc = indice_fichas.docs[doc_id]
+        mejores.setdefault((doc["semana"], doc["asign"]), doc_id)
+        if len(mejores) == 5:
+            break
+    if not mejores:
+        await update.message.reply_text(f"🔎 No encontré «{consulta}» en las fichas.")
+        return
+    lineas, botones = [f"🔎 Resultados para «{consulta}»:"], []
+    for (semana, asign), doc_id in mejores.items():
+        nombre = nombre_asignatura(asign)
+        lineas.append(f"\n• Semana {semana} · {nombre}\n  {indice_fichas.fragmento(doc_id, consulta)}")
+        botones.append([InlineKeyboardButton(f"📄 Semana {semana} · {nombre}",
+                                             callback_data=datos_boton("ficha", curso.codigo, semana, asign))])
+    await update.message.reply_text(partir_mensaje("\n".join(lineas))[0],
+                                    reply_markup=InlineKeyboardMarkup(botones),
+                                    disable_web_page_preview=True)
+
+async def estado_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/estado → cola del Tutor y caché de respuestas (solo admins)."""
+    if not es_admin(update):
+        return
+    await update.message.reply_text(
+        "📊 Cola del Tutor\n\n" + planificador.resumen()
+        + "\n\n🗃️ Caché de respuestas\n\n" + cache_respuestas.resumen()
+        + "\n\n📢 Difusión de comunicados\n\n" + difusor.resumen()
+    )
+
+async def difundir_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/difundir → envía ya los comunicados nuevos de comunicados.txt (solo admins)."""
+    if not es_admin(update):
+        return
+    await update.message.reply_text(f"📢 Revisando comunicados para {difusor.total_suscriptores()} suscriptores…")
+    difusor.detectar_nuevos()
+    por_enviar = set(difusor.comunicados_pendientes())
+    entradas = [e for e in comunicados_actuales()["entradas"] if e["id"] in por_enviar or e["hash"] in por_enviar]
+    if entradas:
+        await update.message.reply_text("📢 Se enviará:\n\n" + "\n\n".join(
+            e["texto"] if len(e["texto"]) <= 200 else e["texto"][:200] + "…" for e in entradas))
+    progreso = await difusor.difundir(context.bot)
+    if not progreso:
+        await update.message.reply_text("No hay comunicados nuevos por enviar.")
+        return
+    await update.message.reply_text("📢 " + difusor.resumen())
+
+async def cache_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/cache → estadísticas; /cache purgar [texto] → borra todo o lo que contenga el texto (solo admins)."""
+    if not es_admin(update):
+        return
+    if context.args and context.args[0].lower() == "purgar":
+        borradas = cache_respuestas.purgar(" ".join(context.args[1:]))
+        await update.message.reply_text(f"🧹 {borradas} respuestas eliminadas de la caché.")
+        return
+    await update.message.reply_text("🗃️ Caché de respuestas del Tutor\n\n" + cache_respuestas.resumen())
+
 async def on_error(update, context):
+    contar_error("handler", context.error)
     print("ERROR:", repr(context.error))
 
 async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    try:
+        await query.answer()
+    except telegram.error.BadRequest:
+        pass  # toque pendiente de cuando el bot dormía: ya no se puede responder, pero sí atender
     data = query.data
 
     if data in {"menu", "start", "back:main"}:
@@ -293,33 +2611,92 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("👋 Menú principal:", reply_markup=kb_menu_principal()); return
 
     if data in {"fichas", "back:weeks"}:
-        await query.edit_message_text("Selecciona la semana:", reply_markup=kb_semanas()); return
+        curso = curso_de(context.user_data)
+        if curso is None:
+            await query.edit_message_text("Selecciona tu curso:", reply_markup=kb_cursos()); return
+        await query.edit_message_text(texto_semanas(curso), reply_markup=kb_semanas(curso)); return
+
+    if data == "cursos":
+        await query.edit_message_text("Selecciona tu curso:", reply_markup=kb_cursos()); return
+
+    if data.startswith("curso:"):
+        curso = catalogo_fichas().cursos.get(data.split(":", 1)[1])
+        if curso is None:
+            await query.edit_message_text("Ese curso ya no está disponible. Selecciona tu curso:",
+                                          reply_markup=kb_cursos()); return
+        context.user_data["curso"] = curso.codigo
+        await query.edit_message_text(texto_semanas(curso), reply_markup=kb_semanas(curso)); return
 
     if data.startswith("sem:") or data.startswith("back:subjects:"):
-        semana = int(data.split(":")[1] if data.startswith("sem:") else data.split(":")[2])
-        encabezado = texto_encabezado_semana(semana)
-        await query.edit_message_text(encabezado, reply_markup=kb_asignaturas(semana)); return
+        partes = data.split(":")[1 if data.startswith("sem:") else 2:]
+        curso, (s,) = curso_de_boton(partes, 1, context.user_data)
+        if curso is None:
+            await query.edit_message_text("Selecciona tu curso:", reply_markup=kb_cursos()); return
+        semana = int(s)
+        encabezado = texto_encabezado_semana(curso, semana)
+        await query.edit_message_text(encabezado, reply_markup=kb_asignaturas(curso, semana)); return
 
     if data.startswith("ficha:"):
-        _, s, asign_key = data.split(":")
+        curso, (s, asign_key) = curso_de_boton(data.split(":")[1:], 2, context.user_data)
+        if curso is None:
+            await query.edit_message_text("Selecciona tu curso:", reply_markup=kb_cursos()); return
         semana = int(s)
-        nombre_asign = ASIGNATURAS.get(asign_key, "Asignatura")
-        rango = texto_rango_semana_solo_fecha(semana)
-        gp = f"{GRADO}º {PARALELO}"
-        caption = f"📄 Ficha Pedagógica\nSemana {semana} · {nombre_asign}\n{rango}\nCurso: {gp}"
-
-        pdf_path = ruta_pdf(semana, asign_key)
-        if pdf_path and pdf_path.exists():
+        nombre_asign = nombre_asignatura(asign_key)
+        pdf_path = ruta_pdf(curso, semana, asign_key)
+        if hay_pdf_disponible(curso, semana, asign_key):
+            caption = _caption_ficha_completa(curso, semana, asign_key)
+            previa = previa_de(pdf_path)
             try:
-                with pdf_path.open("rb") as f:
-                    await query.message.reply_document(document=f, filename=pdf_path.name, caption=caption)
+                if previa:
+                    # Primero la imagen de la primera página; el PDF, solo si lo pide
+                    await enviar_previa(query.message, previa, caption,
+                                        kb_descargar_pdf(curso, semana, asign_key, variante_ligera(pdf_path)))
+                else:
+                    await enviar_documento(query.message, variante_ligera(pdf_path), caption)
             except Exception as e:
+                contar_error("envio", e)
                 await query.message.reply_text(f"⚠️ No se pudo enviar el archivo: {e}")
         else:
             await query.message.reply_text(
                 f"⚠️ No se encontró el PDF para:\nSemana {semana} · {nombre_asign}\nRuta esperada:\n{pdf_path}"
             )
-        await query.edit_message_text("Selecciona otra asignatura o regresa:", reply_markup=kb_volver_asignaturas(semana))
+        await query.edit_message_text("Selecciona otra asignatura o regresa:",
+                                      reply_markup=kb_volver_asignaturas(curso, semana))
+        return
+
+    if data.startswith("pdf:"):
+        # Botón bajo la vista previa: se envía el PDF y el mensaje con la imagen queda como está
+        curso, (s, asign_key) = curso_de_boton(data.split(":")[1:], 2, context.user_data)
+        ruta = buscar_ficha(curso, int(s), asign_key) if curso is not None else None
+        if ruta is None:
+            await query.message.reply_text("⚠️ Esa ficha ya no está disponible.", reply_markup=kb_menu_principal()); return
+        try:
+            await query.message.chat.send_action(action="upload_document")
+        except Exception:
+            pass
+        try:
+            await enviar_documento(query.message, variante_ligera(ruta), _caption_ficha_completa(curso, int(s), asign_key))
+        except Exception as e:
+            contar_error("envio", e)
+            await query.message.reply_text(f"⚠️ No se pudo enviar el archivo: {e}")
+        return
+
+    if data.startswith("todo:"):
+        curso, (s,) = curso_de_boton(data.split(":")[1:], 1, context.user_data)
+        if curso is None:
+            await query.edit_message_text("Selecciona tu curso:", reply_markup=kb_cursos()); return
+        semana = int(s)
+        try:
+            await query.message.chat.send_action(action="upload_document")
+        except Exception:
+            pass
+        try:
+            await enviar_semana_completa(query.message, curso, semana)
+        except Exception as e:
+            contar_error("envio", e)
+            await query.message.reply_text(f"⚠️ No se pudieron enviar las fichas: {e}")
+        await query.edit_message_text("Selecciona otra asignatura o regresa:",
+                                      reply_markup=kb_volver_asignaturas(curso, semana))
         return
 
     if data == "comunicados":
@@ -360,6 +2737,9 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data == "tutor:reset":
         context.user_data["tutor_history"] = []
+        context.user_data.pop("tutor_resumen", None)
+        context.user_data.pop("tutor_ventana", None)
+        context.user_data.pop("tutor_contexto", None)
         await query.edit_message_text("🧹 Contexto del Tutor borrado. ¡Listo para empezar de nuevo!",
                                       reply_markup=kb_tutor_menu())
         return
@@ -382,58 +2762,451 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.chat.send_action(action="typing")
         except Exception:
             pass
-        respuesta = await ask_gpt(texto, context)
-        await update.message.reply_text(respuesta, disable_web_page_preview=True)
+        if TUTOR_CACHE and tutor_sin_contexto(context.user_data):
+            guardada = cache_respuestas.buscar(texto, codigo_curso(context.user_data))
+            if guardada:
+                M_TUTOR_RESPUESTAS.inc("cache")
+                _registrar_turno(context, texto, guardada)
+                for parte in partir_mensaje(guardada):
+                    await update.message.reply_text(parte, disable_web_page_preview=True)
+                return
+
+        async def avisar():
+            await update.message.reply_text("⏳ Tu consulta está en cola; te respondo en cuanto pueda.")
+
+        async def ejecutar():
+            primera = tutor_sin_contexto(context.user_data)
+            curso = codigo_curso(context.user_data)
+            if TUTOR_STREAMING:
+                respuesta = await responder_en_streaming(update.message, texto, context)
+            else:
+                respuesta = await ask_gpt(texto, context)
+                for parte in partir_mensaje(respuesta):
+                    await update.message.reply_text(parte, disable_web_page_preview=True)
+                if respuesta.startswith("⚠️"):
+                    respuesta = None
+            if TUTOR_CACHE and primera and respuesta:
+                cache_respuestas.guardar_respuesta(texto, respuesta, curso)
+            await compactar_historial(context)
+            return respuesta
+
+        # Consultas idénticas en curso: las primeras preguntas se comparten entre usuarios del
+        # mismo curso (el contexto de fichas es por curso), las de seguimiento solo con el mismo
+        # usuario (dependen de su historial).
+        sin_historial = tutor_sin_contexto(context.user_data)
+        quien = f"*{codigo_curso(context.user_data) or ''}" if sin_historial else update.effective_user.id
+        clave = (quien, normalizar_texto(texto))
+        respuesta, origen = await planificador.consulta(update.effective_user.id, clave, ejecutar, avisar)
+        M_TUTOR_RESPUESTAS.inc(origen)
+        if origen == "compartida":
+            if respuesta:
+                _registrar_turno(context, texto, respuesta)
+                await compactar_historial(context)
+                for parte in partir_mensaje(respuesta):
+                    await update.message.reply_text(parte, disable_web_page_preview=True)
+            else:
+                await update.message.reply_text("⚠️ Ocurrió un error consultando al Tutor. Intenta de nuevo.")
     else:
         await update.message.reply_text("Usa /start para ver el menú o toca “🤖 Tutor Virtual” para hacer consultas.")
 
+# ──────────────────────────────────────────────────────────────────────────────
+# CONCURRENCIA Y PROCESOS TRABAJADORES
+# ──────────────────────────────────────────────────────────────────────────────
+# Dentro de un proceso, los updates se atienden en paralelo (hasta UPDATES_CONCURRENTES),
+# pero los de un mismo usuario siempre uno tras otro y en orden de llegada.
+# Con TRABAJADORES > 1 (solo modo webhook) el proceso principal queda como "frente":
+# recibe el webhook y reenvía cada update al trabajador de su usuario
+# (user_id % TRABAJADORES), que escucha en 127.0.0.1:TRABAJADORES_PUERTO_BASE + i.
+# El estado (user_data, suscriptores, file_id) vive en la base SQLite compartida.
+UPDATES_CONCURRENTES = int(os.getenv("UPDATES_CONCURRENTES", "64"))  # 1 = secuencial
+TRABAJADORES = int(os.getenv("TRABAJADORES", "1"))
+TRABAJADORES_PUERTO_BASE = int(os.getenv("TRABAJADORES_PUERTO_BASE", str(PORT + 1)))
+TRABAJADOR_ID = os.getenv("TRABAJADOR_ID")  # lo define el frente al lanzar cada trabajador
+
+def es_proceso_principal() -> bool:
+    """Las tareas de mantenimiento (poda, difusión, zips) corren en un solo proceso."""
+    return TRABAJADOR_ID in (None, "0")
+
+def clave_orden(update) -> int:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.effective_chat.id if update.effective_chat is not None else None
+
+class ProcesadorPorUsuario(BaseUpdateProcessor):
+    """Procesa updates en paralelo manteniendo el orden por usuario (candado por usuario,
+    FIFO). Un update que espera a otro del mismo usuario ocupa un cupo, pero eso solo
+    pasa con toques seguidos de una misma persona."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._candados = {}    # clave → asyncio.Lock
+        self._pendientes = {}  # clave → updates esperando o en curso
+
+    async def do_process_update(self, update, coroutine):
+        clave = clave_orden(update)
+        if clave is None:
+            await coroutine
+            return
+        candado = self._candados.setdefault(clave, asyncio.Lock())
+        self._pendientes[clave] = self._pendientes.get(clave, 0) + 1
+        try:
+            async with candado:
+                await coroutine
+        finally:
+            self._pendientes[clave] -= 1
+            if not self._pendientes[clave]:
+                del self._pendientes[clave]
+                del self._candados[clave]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def trabajador_de(datos: dict) -> int:
+    """Índice del trabajador para un update crudo (JSON del webhook), según su usuario o chat."""
+    for valor in datos.values():
+        if isinstance(valor, dict):
+            origen = valor.get("from") or valor.get("user") or valor.get("chat") or {}
+            if "id" in origen:
+                return int(origen["id"]) % TRABAJADORES
+    return 0
+
+def _con_trabajador(muestra: str, i: int) -> str:
+    """'nombre{a="1"} 3' → 'nombre{trabajador="i",a="1"} 3'"""
+    nombre, valor = muestra.rsplit(" ", 1)
+    if nombre.endswith("}"):
+        base, _, etiquetas = nombre[:-1].partition("{")
+        return f'{base}{{trabajador="{i}",{etiquetas}}} {valor}'
+    return f'{nombre}{{trabajador="{i}"}} {valor}'
+
+def combinar_metricas(textos: list) -> str:
+    """Une el /metrics de cada trabajador agregando la etiqueta trabajador="i"
+    (cada familia de métricas queda contigua, como exige el formato)."""
+    familias = {}  # nombre → [líneas HELP/TYPE, muestras]
+    for i, texto in enumerate(textos):
+        actual = None
+        for linea in texto.splitlines():
+            if linea.startswith("# HELP "):
+                actual = linea.split(" ", 3)[2]
+                familias.setdefault(actual, [[], []])
+                if not familias[actual][0]:
+                    familias[actual][0].append(linea)
+            elif linea.startswith("# TYPE "):
+                if len(familias[actual][0]) < 2:
+                    familias[actual][0].append(linea)
+            elif linea and actual is not None:
+                familias[actual][1].append(_con_trabajador(linea, i))
+    return "\n".join(l for cabecera, muestras in familias.values() for l in cabecera + muestras) + "\n"
+
+async def ejecutar_frente():
+    """Proceso frente: lanza y vigila los trabajadores, registra el webhook y reparte los updates."""
+    import httpx
+    import tornado.web
+
+    def url_trabajador(i: int) -> str:
+        return f"http://127.0.0.1:{TRABAJADORES_PUERTO_BASE + i}"
+
+    def lanzar(i: int) -> subprocess.Popen:
+        entorno = {**os.environ, "TRABAJADOR_ID": str(i)}
+        return subprocess.Popen([sys.executable, str(Path(__file__).resolve())], env=entorno)
+
+    procesos = {i: lanzar(i) for i in range(TRABAJADORES)}
+    cliente = httpx.AsyncClient(timeout=httpx.Timeout(10.0),
+                                limits=httpx.Limits(max_connections=32 * TRABAJADORES,
+                                                    max_keepalive_connections=32 * TRABAJADORES))
+
+    async def consultar_todos(ruta: str) -> list:
+        async def uno(i):
+            try:
+                return await cliente.get(url_trabajador(i) + ruta)
+            except httpx.HTTPError:
+                return None
+        return await asyncio.gather(*(uno(i) for i in range(TRABAJADORES)))
+
+    class Webhook(tornado.web.RequestHandler):
+        async def post(self):
+            try:
+                i = trabajador_de(json.loads(self.request.body))
+            except (ValueError, TypeError, AttributeError):
+                raise tornado.web.HTTPError(400)
+            try:
+                r = await cliente.post(url_trabajador(i) + "/webhook", content=self.request.body,
+                                       headers={"Content-Type": "application/json"})
+            except httpx.HTTPError:
+                raise tornado.web.HTTPError(503)  # Telegram reintenta más tarde
+            self.set_status(r.status_code)
+            self.finish()
+
+    class Salud(tornado.web.RequestHandler):
+        async def get(self):
+            respuestas = await consultar_todos("/healthz")
+            listos = sum(1 for r in respuestas if r is not None and r.status_code == 200)
+            if listos < TRABAJADORES:
+                self.set_status(503)
+            self.finish(f"{listos}/{TRABAJADORES} trabajadores listos")
+
+    class Metricas(tornado.web.RequestHandler):
+        async def get(self):
+            respuestas = await consultar_todos("/metrics")
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.finish(combinar_metricas([r.text if r is not None else "" for r in respuestas]))
+
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, detener.set)
+
+    servidor = tornado.web.Application([
+        (r"/webhook/?", Webhook), (r"/healthz", Salud), (r"/metrics", Metricas),
+    ]).listen(PORT, address="0.0.0.0")
+    try:
+        # El webhook se registra cuando todos los trabajadores responden
+        for _ in range(120):
+            if all(r is not None and r.status_code == 200 for r in await consultar_todos("/healthz")):
+                break
+            await asyncio.sleep(0.5)
+        full_webhook = f"{WEBHOOK_URL.rstrip('/')}/webhook"
+        kwargs = {}
+        if TELEGRAM_API_URL:
+            base = TELEGRAM_API_URL.rstrip("/")
+            kwargs = {"base_url": f"{base}/bot", "base_file_url": f"{base}/file/bot"}
+        async with telegram.Bot(TOKEN, **kwargs) as bot:
+            await bot.set_webhook(url=full_webhook, drop_pending_updates=PENDIENTES_MAX_EDAD_SEG <= 0)
+        print(f"🌐 Frente en modo WEBHOOK en {full_webhook} (puerto {PORT}) con {TRABAJADORES} trabajadores")
+
+        while not detener.is_set():
+            for i, proceso in procesos.items():
+                if proceso.poll() is not None:
+                    print(f"⚠️ El trabajador {i} terminó (código {proceso.returncode}); se relanza")
+                    procesos[i] = lanzar(i)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(detener.wait(), timeout=2)
+        print("[BOOT] Señal de término recibida; cerrando trabajadores…")
+    finally:
+        servidor.stop()
+        for proceso in procesos.values():
+            if proceso.poll() is None:
+                proceso.terminate()
+        for proceso in procesos.values():
+            try:
+                await asyncio.to_thread(proceso.wait, 20)
+            except subprocess.TimeoutExpired:
+                proceso.kill()
+        await cliente.aclose()
+
 # ──────────────────────────────────────────────────────────────────────────────
 # EJECUCIÓN
 # ──────────────────────────────────────────────────────────────────────────────
-def main():
+_tareas_fondo = set()
+
+def lanzar_en_fondo(coro, nombre: str) -> asyncio.Task:
+    """Tareas de mantenimiento en segundo plano; las que sigan vivas se cancelan en post_shutdown."""
+    tarea = asyncio.get_running_loop().create_task(coro, name=nombre)
+    _tareas_fondo.add(tarea)
+    tarea.add_done_callback(_tareas_fondo.discard)
+    return tarea
+
+async def precalentar():
+    """Lo que no hace falta para atender el primer update se prepara después, ya con el bot
+    respondiendo: catálogo y teclados, caché de respuestas, SDK de OpenAI, tiktoken y,
+    al final, el índice de búsqueda (lo más pesado; solo lo construye el proceso principal)."""
+    t0 = time.perf_counter()
+    await asyncio.to_thread(catalogo_fichas)  # escanea las carpetas de fichas del manifiesto
+    precalentar_teclados()
+    if TUTOR_CACHE:
+        cache_respuestas.cargar()
+    await asyncio.to_thread(_importar_openai)
+    iniciar_openai()
+    await asyncio.to_thread(contar_tokens, "")  # carga tiktoken (puede descargar su tabla) fuera del loop
+    print(f"[BOOT] Precalentamiento listo en {time.perf_counter() - t0:.2f}s")
+    if es_proceso_principal():
+        lanzar_en_fondo(vigilar_indice_fichas(), "indice_fichas")
+    else:
+        lanzar_en_fondo(seguir_indice_fichas(), "indice_fichas")
+
+async def post_init(app: Application):
+    lanzar_en_fondo(precalentar(), "precalentar")
+    if not es_proceso_principal():
+        return
+    if app.persistence is not None:
+        lanzar_en_fondo(podar_estado(app), "podar_estado")
+    if COMUNICADOS_DIFUSION:
+        lanzar_en_fondo(vigilar_comunicados(app), "comunicados")
+    if FICHAS_ZIP:
+        lanzar_en_fondo(preparar_zips(), "zips")
+    if FICHAS_LIGERAS:
+        lanzar_en_fondo(preprocesar_en_fondo(), "fichas_ligeras")
+
+async def post_shutdown(app: Application):
+    tareas = list(_tareas_fondo)
+    for tarea in tareas:
+        tarea.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
+    if cache_respuestas.pendiente:
+        cache_respuestas.guardar()  # el lote que no alcanzó a escribirse
+    await cerrar_openai()
+
+def crear_aplicacion() -> Application:
+    """Construye la Application con todos sus handlers (también la usan los benchmarks)."""
+    request = HTTPXRequest(
+        connect_timeout=20.0,
+        read_timeout=60.0,
+        write_timeout=60.0,
+        pool_timeout=10.0,
+        connection_pool_size=max(8, min(UPDATES_CONCURRENTES, 64)),  # por defecto PTB usa 1
+    )
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if UPDATES_CONCURRENTES > 1:
+        builder = builder.concurrent_updates(ProcesadorPorUsuario(UPDATES_CONCURRENTES))
+    if TELEGRAM_API_URL:
+        base = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+    if PERSISTENCIA:
+        builder = builder.persistence(PersistenciaSQLite(RUTA_ESTADO_DB, PERSISTENCIA_INTERVALO))
+    app = builder.build()
+
+    # Handlers (cada uno envuelto con medir_handler para /metrics)
+    app.add_error_handler(on_error)
+    app.add_handler(TypeHandler(Update, registrar_llegada), group=-1)
+    app.add_handler(CommandHandler("start", medir_handler(start, "start")))
+    app.add_handler(CommandHandler("tutor", medir_handler(tutor_cmd, "tutor")))  # acceso directo
+    app.add_handler(CommandHandler("curso", medir_handler(curso_cmd, "curso")))
+    app.add_handler(CommandHandler("buscar", medir_handler(buscar_cmd, "buscar")))
+    app.add_handler(CommandHandler("cache", medir_handler(cache_cmd, "cache")))  # solo ADMIN_IDS
+    app.add_handler(CommandHandler("estado", medir_handler(estado_cmd, "estado")))  # solo ADMIN_IDS
+    app.add_handler(CommandHandler("difundir", medir_handler(difundir_cmd, "difundir"), block=False))  # solo ADMIN_IDS
+    app.add_handler(CallbackQueryHandler(medir_handler(on_button, "boton")))
+    # block=False: las consultas al Tutor no frenan los botones de los demás;
+    # el orden por usuario lo garantiza el planificador.
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, medir_handler(on_text, "texto"), block=False))
+    Medidor("bot_updates_en_cola", "Updates recibidos que aún no empiezan a procesarse.", app.update_queue.qsize)
+    return app
+
+def iniciar_servidor_http(app: Application, puerto: int, ruta_webhook: str = None, direccion: str = "0.0.0.0"):
+    """Servidor HTTP con /metrics y /healthz. En modo webhook también recibe los updates
+    en /<ruta_webhook> (reemplaza al servidor de run_webhook para compartir el puerto)."""
+    import tornado.web  # viene con python-telegram-bot[webhooks]
+
+    class Metricas(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.finish(exponer_metricas())
+
+    class Salud(tornado.web.RequestHandler):
+        def get(self):
+            if not app.running:
+                self.set_status(503)
+            self.finish("ok" if app.running else "iniciando")
+
+    class Webhook(tornado.web.RequestHandler):
+        async def post(self):
+            try:
+                update = Update.de_json(json.loads(self.request.body), app.bot)
+            except (ValueError, TypeError, KeyError):
+                update = None
+            if update is None:
+                raise tornado.web.HTTPError(400)
+            _llegadas[update.update_id] = time.perf_counter()
+            await app.update_queue.put(update)
+            self.finish()
+
+    rutas = [(r"/metrics", Metricas), (r"/healthz", Salud)]
+    if ruta_webhook:
+        rutas.append((rf"/{ruta_webhook}/?", Webhook))
+    servidor = tornado.web.Application(rutas).listen(puerto, address=direccion)
+    print(f"[BOOT] HTTP en el puerto {puerto}: {', '.join(r for r, _ in rutas)}")
+    return servidor
+
+async def ejecutar(app: Application):
+    """Ciclo de vida de la Application (equivale a run_webhook/run_polling, con nuestro servidor HTTP).
+    El puerto se abre antes que nada (Render lo detecta y los updates esperan en la cola),
+    y los pendientes se atienden en lugar de descartarse (ver PENDIENTES_MAX_EDAD_SEG)."""
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, detener.set)
+
+    descartar_pendientes = PENDIENTES_MAX_EDAD_SEG <= 0
+    servidor = None
+    if TRABAJADOR_ID is not None:
+        # Trabajador: el frente le reenvía los updates de sus usuarios
+        puerto = TRABAJADORES_PUERTO_BASE + int(TRABAJADOR_ID)
+        print(f"🧩 Trabajador {TRABAJADOR_ID} escuchando en 127.0.0.1:{puerto}")
+        servidor = iniciar_servidor_http(app, puerto, ruta_webhook="webhook", direccion="127.0.0.1")
+    elif WEBHOOK_URL:
+        servidor = iniciar_servidor_http(app, PORT, ruta_webhook="webhook")
+    elif METRICAS_PUERTO:
+        servidor = iniciar_servidor_http(app, METRICAS_PUERTO)
+    marcar_arranque("servidor http")
+
+    await app.initialize()
     try:
-        request = HTTPXRequest(
-            connect_timeout=20.0,
-            read_timeout=60.0,
-            write_timeout=60.0
-        )
-        app = Application.builder().token(TOKEN).request(request).build()
+        marcar_arranque("initialize")
+        await post_init(app)
+        await app.start()
+        marcar_arranque("listo")
+        if TRABAJADOR_ID is None and WEBHOOK_URL:
+            full_webhook = f"{WEBHOOK_URL.rstrip('/')}/webhook"
+            print(f"🌐 Iniciando en modo WEBHOOK en {full_webhook} (puerto {PORT})")
+            await app.bot.set_webhook(url=full_webhook, drop_pending_updates=descartar_pendientes)
+            marcar_arranque("set_webhook")
+        elif TRABAJADOR_ID is None:
+            print("📡 Iniciando en modo POLLING...")
+            await app.updater.start_polling(drop_pending_updates=descartar_pendientes)
+            marcar_arranque("start_polling")
+        print(f"[BOOT] Tiempos de arranque: {resumen_arranque()}")
+        await detener.wait()
+        print("[BOOT] Señal de término recibida; cerrando…")
+    finally:
+        if servidor is not None:
+            servidor.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await post_shutdown(app)
+        await app.shutdown()
 
-        # Handlers
-        app.add_error_handler(on_error)
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("tutor", tutor_cmd))  # acceso directo
-        app.add_handler(CallbackQueryHandler(on_button))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+def main():
+    # Se valida aquí y no al importar: preprocesar_fichas.py importa este módulo sin token
+    if not TOKEN:
+        raise RuntimeError("Falta BOT_TOKEN en variables de entorno.")
+    try:
+        if TRABAJADORES > 1 and TRABAJADOR_ID is None:
+            if WEBHOOK_URL:
+                asyncio.run(ejecutar_frente())
+                return
+            print("⚠️ TRABAJADORES > 1 solo aplica en modo webhook; se usa un solo proceso.")
+        app = crear_aplicacion()
+        marcar_arranque("aplicación")
 
         # Debug
         print(f"[DEBUG] WEBHOOK_URL env = {WEBHOOK_URL!r}")
         print(f"[DEBUG] PORT env = {PORT}")
         print(f"[DEBUG] OPENAI_MODEL = {OPENAI_MODEL!r}")
 
-        if WEBHOOK_URL:
-            # WEBHOOK
-            path = "webhook"
-            full_webhook = f"{WEBHOOK_URL.rstrip('/')}/{path}"
-            print(f"🌐 Iniciando en modo WEBHOOK en {full_webhook} (puerto {PORT})")
-            app.run_webhook(
-                listen="0.0.0.0",
-                port=PORT,
-                url_path=path,
-                webhook_url=full_webhook,
-                drop_pending_updates=True
-            )
-        else:
-            # POLLING
-            print("📡 Iniciando en modo POLLING...")
-            app.run_polling(drop_pending_updates=True)
+        asyncio.run(ejecutar(app))
 
     except Exception as e:
-        import traceback, time
+        import traceback
         print("[FATAL] El proceso se cayó en main():", repr(e))
         traceback.print_exc()
         # pequeña espera para alcanzar a leer logs en Render si crashea
         time.sleep(10)
 
+marcar_arranque("módulo")
+
 if __name__ == "__main__":
     main()
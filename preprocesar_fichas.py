@@ -0,0 +1,236 @@
+"""
+Versiones ligeras de las fichas: un PDF optimizado y una imagen de la primera página
+(vista previa) por ficha, para ahorrar datos a los estudiantes y subidas a Telegram.
+
+Uso:
+    python preprocesar_fichas.py [--procesos N] [--forzar] [--dpi-previa 90] [--prioridad 0]
+
+Toma las fichas del catálogo (catalogo.json) y deja los resultados en FICHAS_LIGERAS_DIR
+(por defecto CACHE_DIR/ligeras):
+
+    manifiesto.json                  ficha original → hash de su contenido, tamaños y semana
+    <hash>/<nombre original>.pdf     PDF optimizado (solo si pesa bastante menos que el original)
+    <hash>/previa.jpg                primera página
+
+Es incremental: una ficha con el mismo tamaño y fecha que en la corrida anterior no se
+vuelve a leer, y una con el mismo contenido (mismo hash) no se vuelve a procesar. El trabajo
+se reparte en un pool de procesos. Al final informa los bytes ahorrados por semana.
+El bot lo ejecuta en segundo plano al arrancar y cuando cambian las fichas (FICHAS_LIGERAS=1).
+
+Requiere PyMuPDF. Sin PyMuPDF no se genera nada y el bot envía los PDF originales.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
+
+VERSION_MANIFIESTO = 1
+NOMBRE_MANIFIESTO = "manifiesto.json"
+NOMBRE_PREVIA = "previa.jpg"
+
+PREVIA_CALIDAD = 70            # JPEG
+IMAGENES_DPI_UMBRAL = 150      # imágenes con más resolución que esto se reducen…
+IMAGENES_DPI_DESTINO = 120     # …a esta resolución
+IMAGENES_CALIDAD = 70
+AHORRO_MINIMO = 0.05           # si el PDF optimizado no ahorra al menos esto, se usa el original
+
+
+def hay_pymupdf() -> bool:
+    return importlib.util.find_spec("pymupdf") is not None  # sin importarlo (pesa ~30 MB)
+
+
+def ajustes(dpi_previa: int) -> dict:
+    """Parámetros que afectan el resultado: si cambian, se reprocesa todo."""
+    return {"dpi_previa": dpi_previa, "previa_calidad": PREVIA_CALIDAD,
+            "imagenes": [IMAGENES_DPI_UMBRAL, IMAGENES_DPI_DESTINO, IMAGENES_CALIDAD]}
+
+
+def hash_archivo(ruta: Path) -> str:
+    h = hashlib.sha256()
+    with ruta.open("rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def firma_archivo(ruta: Path) -> str:
+    st = ruta.stat()
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def _escribir(destino: Path, datos: bytes):
+    tmp = destino.with_name(f".{destino.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(datos)
+    os.replace(tmp, destino)
+
+
+def procesar_ficha(origen: str, carpeta: str, dpi_previa: int) -> dict:
+    """Se ejecuta en un proceso del pool: genera la previa y el PDF optimizado de una ficha."""
+    import pymupdf
+    pymupdf.TOOLS.mupdf_display_errors(False)  # avisos de recursos faltantes en PDF de Word
+    origen, carpeta = Path(origen), Path(carpeta)
+    carpeta.mkdir(parents=True, exist_ok=True)
+    with pymupdf.open(origen) as doc:
+        previa = doc[0].get_pixmap(dpi=dpi_previa).tobytes("jpeg", jpg_quality=PREVIA_CALIDAD)
+        _escribir(carpeta / NOMBRE_PREVIA, previa)
+        doc.rewrite_images(dpi_threshold=IMAGENES_DPI_UMBRAL, dpi_target=IMAGENES_DPI_DESTINO,
+                           quality=IMAGENES_CALIDAD)
+        doc.subset_fonts()
+        pdf = doc.tobytes(garbage=4, deflate=True, deflate_images=True, deflate_fonts=True,
+                          clean=True, use_objstms=1)
+    original = origen.stat().st_size
+    if len(pdf) <= original * (1 - AHORRO_MINIMO):
+        _escribir(carpeta / origen.name, pdf)
+        optimizado = len(pdf)
+    else:
+        optimizado = None
+    return {"original": original, "pdf": optimizado, "previa": len(previa)}
+
+
+def rutas_salida(destino: Path, entrada: dict) -> tuple:
+    """(pdf optimizado o None, previa o None) de una entrada del manifiesto."""
+    carpeta = destino / entrada["hash"][:16]
+    pdf = carpeta / entrada["nombre"] if entrada.get("pdf") else None
+    previa = carpeta / NOMBRE_PREVIA if entrada.get("previa") else None
+    return pdf, previa
+
+
+def cargar_manifiesto(destino: Path) -> dict:
+    try:
+        datos = json.loads((destino / NOMBRE_MANIFIESTO).read_text(encoding="utf-8"))
+        if datos.get("version") == VERSION_MANIFIESTO:
+            return datos
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Manifiesto de fichas ligeras ilegible, se regenera: {e!r}")
+    return {"version": VERSION_MANIFIESTO, "ajustes": None, "fichas": {}}
+
+
+def _completa(destino: Path, entrada: dict) -> bool:
+    return all(r is None or r.exists() for r in rutas_salida(destino, entrada))
+
+
+def procesar(fichas: list, destino: Path, procesos: int = None, forzar: bool = False,
+             dpi_previa: int = 90) -> dict:
+    """fichas: [(clave, ruta, semana)]. Actualiza destino y devuelve el resumen de la corrida."""
+    destino.mkdir(parents=True, exist_ok=True)
+    vigentes_ajustes = ajustes(dpi_previa)
+    anterior = cargar_manifiesto(destino)
+    previas = {} if forzar or anterior["ajustes"] != vigentes_ajustes else anterior["fichas"]
+    por_hash = {e["hash"]: e for e in previas.values() if _completa(destino, e)}
+
+    nuevas, pendientes = {}, {}  # clave → entrada; hash → (ruta, claves)
+    omitidas = 0
+    for clave, ruta, semana in fichas:
+        try:
+            firma = firma_archivo(ruta)
+        except FileNotFoundError:
+            continue
+        previa = previas.get(clave)
+        if previa and previa["firma"] == firma and _completa(destino, previa):
+            nuevas[clave] = {**previa, "semana": semana}
+            omitidas += 1
+            continue
+        contenido = hash_archivo(ruta)
+        igual = por_hash.get(contenido)
+        if igual and igual["nombre"] == ruta.name:
+            nuevas[clave] = {**igual, "firma": firma, "semana": semana}
+            omitidas += 1
+            continue
+        nuevas[clave] = {"hash": contenido, "firma": firma, "semana": semana, "nombre": ruta.name}
+        pendientes.setdefault((contenido, ruta.name), (ruta, []))[1].append(clave)
+
+    errores = 0
+    t0 = time.perf_counter()
+    if pendientes:
+        procesos = max(1, min(procesos or os.cpu_count() or 1, len(pendientes)))
+        # spawn: los procesos del pool solo importan este módulo (no el bot que lo lanzó)
+        with ProcessPoolExecutor(max_workers=procesos, mp_context=get_context("spawn")) as pool:
+            trabajos = {pool.submit(procesar_ficha, str(ruta), str(destino / contenido[:16]), dpi_previa): claves
+                        for (contenido, _nombre), (ruta, claves) in pendientes.items()}
+            for trabajo in as_completed(trabajos):
+                claves = trabajos[trabajo]
+                try:
+                    tamaños = trabajo.result()
+                except Exception as e:
+                    errores += 1
+                    print(f"⚠️ No se pudo procesar {nuevas[claves[0]]['nombre']}: {e!r}")
+                    for clave in claves:
+                        del nuevas[clave]
+                    continue
+                for clave in claves:
+                    nuevas[clave].update(tamaños)
+                print(f"[FICHAS] {nuevas[claves[0]]['nombre']}: {_kib(tamaños['original'])} → "
+                      f"{_kib(tamaños['pdf'] or tamaños['original'])} (previa {_kib(tamaños['previa'])})")
+
+    manifiesto = {"version": VERSION_MANIFIESTO, "ajustes": vigentes_ajustes, "fichas": nuevas}
+    _escribir(destino / NOMBRE_MANIFIESTO, json.dumps(manifiesto, ensure_ascii=False, indent=1).encode())
+    # Resultados que ya no usa ninguna ficha (archivos cambiados o eliminados)
+    vigentes = {e["hash"][:16] for e in nuevas.values()}
+    for carpeta in destino.iterdir():
+        if carpeta.is_dir() and carpeta.name not in vigentes:
+            shutil.rmtree(carpeta, ignore_errors=True)
+    return {"procesadas": len(pendientes), "omitidas": omitidas, "errores": errores,
+            "segundos": time.perf_counter() - t0, "por_semana": resumen_por_semana(nuevas)}
+
+
+def resumen_por_semana(entradas: dict) -> dict:
+    """semana → {fichas, original, enviado, previas}; "enviado" es lo que se sube al pedir el PDF."""
+    semanas = {}
+    for e in entradas.values():
+        fila = semanas.setdefault(e["semana"], {"fichas": 0, "original": 0, "enviado": 0, "previas": 0})
+        fila["fichas"] += 1
+        fila["original"] += e["original"]
+        fila["enviado"] += e["pdf"] or e["original"]
+        fila["previas"] += e["previa"] or 0
+    return dict(sorted(semanas.items()))
+
+
+def _kib(n: int) -> str:
+    return f"{n / 1024:.0f} KiB"
+
+
+def imprimir_reporte(resumen: dict):
+    print(f"{'semana':>6}{'fichas':>8}{'original':>12}{'optimizado':>12}{'ahorro':>9}{'previas':>11}")
+    total = {"fichas": 0, "original": 0, "enviado": 0, "previas": 0}
+    for semana, fila in resumen["por_semana"].items():
+        for k in total:
+            total[k] += fila[k]
+        ahorro = 1 - fila["enviado"] / fila["original"] if fila["original"] else 0
+        print(f"{semana:>6}{fila['fichas']:>8}{_kib(fila['original']):>12}{_kib(fila['enviado']):>12}"
+              f"{ahorro:>9.0%}{_kib(fila['previas']):>11}")
+    if total["original"]:
+        print(f"{'total':>6}{total['fichas']:>8}{_kib(total['original']):>12}{_kib(total['enviado']):>12}"
+              f"{1 - total['enviado'] / total['original']:>9.0%}{_kib(total['previas']):>11}")
+    print(f"[FICHAS] {resumen['procesadas']} procesadas, {resumen['omitidas']} sin cambios, "
+          f"{resumen['errores']} con error ({resumen['segundos']:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--procesos", type=int, default=None, help="procesos del pool (por defecto, uno por CPU)")
+    parser.add_argument("--forzar", action="store_true", help="reprocesa todo aunque no haya cambios")
+    parser.add_argument("--dpi-previa", type=int, default=int(os.getenv("FICHAS_PREVIA_DPI", "90")))
+    parser.add_argument("--prioridad", type=int, default=0, help="incremento de nice (el bot usa 10)")
+    args = parser.parse_args()
+    if args.prioridad:
+        os.nice(args.prioridad)  # lo heredan los procesos del pool
+    if not hay_pymupdf():
+        print("⚠️ PyMuPDF no está instalado (pip install PyMuPDF): no se generan fichas ligeras.")
+        sys.exit(1)
+
+    import bot  # solo en el proceso principal: el catálogo y las rutas salen de bot.py
+    resumen = procesar(bot.inventario_fichas(), bot.FICHAS_LIGERAS_DIR, args.procesos, args.forzar, args.dpi_previa)
+    imprimir_reporte(resumen)
+
+
+if __name__ == "__main__":
+    main()